@@ -0,0 +1,200 @@
+#
+# module for managing the persistent cache of target gene annotations
+#
+
+
+import hashlib
+import logging
+import nucleotides
+import os
+import sqlite3
+import threading
+import time
+from common import *
+from pathlib import Path
+from Bio.SeqRecord import SeqRecord
+
+
+
+# the genomic coordinates and sequence of each target gene retrieved by
+# annotate are kept across runs in an on-disk SQLite database, by genome
+# build and RefSeq ID. Sequences are packed (see nucleotides), and stored once
+# by content (SHA-256), as different RefSeq IDs can share the same genomic
+# range. When the stored sequences exceed the cache size, the least recently
+# used genes are evicted.
+# Databases of an earlier version are emptied
+ANNOTATIONS_DB = "annotations.db"
+ANNOTATIONS_TIMEOUT = 600
+ANNOTATIONS_VERSION = 1
+
+
+# logger
+logger = logging.getLogger("annotations")
+
+
+
+# persistent cache of target gene annotations, shared by all workers (and all
+# runs) through file locking. Each process (and each thread) opens its own
+# connection
+#
+class AnnotationCache(object):
+    """
+    On-disk, size-bounded, least recently used cache of target genes'
+    genomic coordinates and sequences.
+    """
+
+    def __init__(self, size, path=None):
+        self.path = Path(path or Path(FILE_PATH).joinpath(ANNOTATIONS_DB))
+        self.size = size
+        self.pid = None
+        self.dbs = {}
+
+        # per-process statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        db = self.connection()
+
+        # drop the tables of an earlier version
+        if db.execute("PRAGMA user_version").fetchone()[0] < ANNOTATIONS_VERSION:
+            db.executescript("""
+                DROP TABLE IF EXISTS genes;
+                DROP TABLE IF EXISTS sequences;
+                PRAGMA user_version = %d;
+            """ % ANNOTATIONS_VERSION)
+
+        # create the database schema
+        db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS genes (
+                genome TEXT, id TEXT,
+                chromosome TEXT, start INTEGER, end INTEGER, strand TEXT,
+                sequence TEXT, used REAL,
+                PRIMARY KEY (genome, id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS genes_used ON genes (used);
+            CREATE INDEX IF NOT EXISTS genes_sequence ON genes (sequence);
+            CREATE TABLE IF NOT EXISTS sequences (
+                hash TEXT PRIMARY KEY, data BLOB, size INTEGER) WITHOUT ROWID;
+        """)
+
+    def __getstate__(self):
+        return dict(self.__dict__, pid=None, dbs={})
+
+    def connection(self):
+        # connections cannot be shared by forked processes, nor used by
+        # other threads
+        if self.pid != os.getpid():
+            self.dbs = {}
+            self.pid = os.getpid()
+        db = self.dbs.get(threading.get_ident())
+        if db is None:
+            db = self.dbs[threading.get_ident()] = sqlite3.connect(
+                str(self.path), timeout=ANNOTATIONS_TIMEOUT, isolation_level=None)
+        return db
+
+    def get(self, genome, ids):
+        """
+        Returns a dictionary mapping each of the given RefSeq IDs of the
+        given genome build found in the cache to its Bio.SeqRecord, whose
+        sequence is a nucleotides.PackedSequence.
+        """
+
+        db = self.connection()
+        result = {}
+
+        for first in range(0, len(ids), 500):
+            batch = ids[first:(first + 500)]
+            rows = db.execute(
+                "SELECT g.id, g.chromosome, g.start, g.end, g.strand, s.data \
+                FROM genes g JOIN sequences s ON s.hash = g.sequence \
+                WHERE g.genome = ? AND g.id IN (%s)" % ", ".join(["?"] * len(batch)),
+                [genome] + list(batch)).fetchall()
+
+            # sequences are returned packed, and only unpacked when read
+            for name, chromosome, start, end, strand, data in rows:
+                bio_seq = SeqRecord(nucleotides.PackedSequence.from_bytes(data),
+                    id=name)
+                bio_seq.annotations[REF_GENOME]   = genome
+                bio_seq.annotations[REF_CHR]      = chromosome
+                bio_seq.annotations[REF_TX_START] = start
+                bio_seq.annotations[REF_TX_END]   = end
+                bio_seq.annotations[REF_STRAND]   = strand
+                result[name] = bio_seq
+
+        # refresh the last use of the genes found
+        if result:
+            db.executemany("UPDATE genes SET used = ? WHERE genome = ? AND id = ?",
+                [(time.time(), genome, name) for name in result])
+
+        self.hits += len(result)
+        self.misses += len(ids) - len(result)
+
+        return result
+
+    def put(self, bio_seqs):
+        """
+        Stores the given annotated Bio.SeqRecords, and evicts the least
+        recently used genes if the cache exceeds its size.
+        """
+
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+
+        try:
+            for bio_seq in bio_seqs:
+
+                sequence = str(bio_seq.seq)
+                digest = hashlib.sha256(sequence.encode("ascii")).hexdigest()
+
+                if not db.execute("SELECT 1 FROM sequences WHERE hash = ?",
+                        (digest,)).fetchone():
+                    data = nucleotides.PackedSequence.pack(sequence).to_bytes()
+                    db.execute("INSERT INTO sequences VALUES (?, ?, ?)",
+                        (digest, data, len(data)))
+
+                db.execute("INSERT OR REPLACE INTO genes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                    bio_seq.annotations[REF_GENOME], bio_seq.id,
+                    bio_seq.annotations[REF_CHR],
+                    bio_seq.annotations[REF_TX_START],
+                    bio_seq.annotations[REF_TX_END],
+                    bio_seq.annotations[REF_STRAND],
+                    digest, time.time()))
+
+            self.evict(db)
+            db.execute("COMMIT")
+
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def evict(self, db):
+        """
+        Removes the least recently used genes (and their sequences, unless
+        shared) until the stored sequences fit in the cache size.
+        """
+
+        excess = db.execute("SELECT total(size) FROM sequences").fetchone()[0] - self.size
+
+        while excess > 0:
+
+            rows = db.execute(
+                "SELECT genome, id, sequence FROM genes ORDER BY used LIMIT 100").fetchall()
+            if not rows:
+                break
+
+            for genome, name, digest in rows:
+
+                db.execute("DELETE FROM genes WHERE genome = ? AND id = ?",
+                    (genome, name))
+                self.evictions += 1
+
+                if not db.execute("SELECT 1 FROM genes WHERE sequence = ? LIMIT 1",
+                        (digest,)).fetchone():
+                    size = db.execute("SELECT size FROM sequences WHERE hash = ?",
+                        (digest,)).fetchone()
+                    db.execute("DELETE FROM sequences WHERE hash = ?", (digest,))
+                    excess -= size[0] if size else 0
+
+                if excess <= 0:
+                    break
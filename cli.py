@@ -19,6 +19,33 @@ OPT_EXE_EXT   = str("--" + OPT_EXE[:])
 OPT_DB       = "db"
 OPT_DB_SHORT = str("-" + OPT_DB[:1])
 OPT_DB_EXT   = str("--" + OPT_DB)
+OPT_BATCH       = "batch"
+OPT_BATCH_SHORT = str("-" + OPT_BATCH[:1])
+OPT_BATCH_EXT   = str("--" + OPT_BATCH)
+OPT_ENGINE     = "engine"
+OPT_ENGINE_EXT = str("--" + OPT_ENGINE)
+OPT_LAYOUT     = "layout"
+OPT_LAYOUT_EXT = str("--" + OPT_LAYOUT)
+OPT_PAIRS     = "pairs"
+OPT_PAIRS_EXT = str("--" + OPT_PAIRS)
+OPT_SCHEDULE     = "schedule"
+OPT_SCHEDULE_EXT = str("--" + OPT_SCHEDULE)
+OPT_REF     = "ref"
+OPT_REF_EXT = str("--" + OPT_REF)
+OPT_ANNOTATIONS     = "annotations"
+OPT_ANNOTATIONS_EXT = str("--" + OPT_ANNOTATIONS)
+OPT_CONCURRENCY     = "concurrency"
+OPT_CONCURRENCY_EXT = str("--" + OPT_CONCURRENCY)
+OPT_RATE     = "rate"
+OPT_RATE_EXT = str("--" + OPT_RATE)
+OPT_WINDOW     = "window"
+OPT_WINDOW_EXT = str("--" + OPT_WINDOW)
+OPT_PUBLISH     = "publish"
+OPT_PUBLISH_EXT = str("--" + OPT_PUBLISH)
+OPT_METRICS     = "metrics"
+OPT_METRICS_EXT = str("--" + OPT_METRICS)
+OPT_PROFILE     = "profile"
+OPT_PROFILE_EXT = str("--" + OPT_PROFILE)
 
 
 # operation arguments
@@ -39,6 +66,29 @@ OPT_ANNOTATE         = "annotate"
 OPT_ANNOTATE_SHORT   = str("-" + OPT_ANNOTATE[:1])
 OPT_ANNOTATE_EXT     = str("--" + OPT_ANNOTATE)
 
+# modes
+OPT_MODE    = "mode"
+MODE_WORKER = "worker"
+
+# filtrate engines
+ENGINE_COMBINATIONS = "combinations"
+ENGINE_SWEEP        = "sweep"
+ENGINE_NUMPY        = "numpy"
+ENGINE_LUA          = "lua"
+
+# cache layouts
+LAYOUT_FULL = "full"
+LAYOUT_LEAN = "lean"
+
+# duplex pair outputs
+PAIRS_LIST   = "list"
+PAIRS_PACKED = "packed"
+PAIRS_BOTH   = "both"
+
+# filtrate schedules
+SCHEDULE_COST   = "cost"
+SCHEDULE_RANDOM = "random"
+
 # all operations
 #
 # NOTE: ADD NEW NAMESPACES-SPECIFIC-OPERATIONS IN THE FOLLOWING DICTIONARY
@@ -121,7 +171,159 @@ def triplexer_parser():
         OPT_DB_EXT,
         metavar="DB",
         default="redis:6379",
-        help="set %(metavar)s as intermediate results database")
+        help=str("set %(metavar)s as intermediate results database\n"
+            + "supported %(metavar)s (default \"%(default)s\"):\n"
+            + "- HOST:PORT or redis://HOST:PORT/N: redis instance\n"
+            + "- memory://: in-process database, lost at the end of the run\n"
+            + "- sqlite:///PATH: on-disk SQLite database"))
+
+    # cache batching
+    parser.add_argument(
+        OPT_BATCH_SHORT,
+        OPT_BATCH_EXT,
+        metavar="BATCH",
+        default="1000",
+        help="set %(metavar)s as number of entries per cache round trip")
+
+    # filtrate engine
+    parser.add_argument(
+        OPT_ENGINE_EXT,
+        metavar="ENGINE",
+        default=ENGINE_SWEEP,
+        choices=[ENGINE_SWEEP, ENGINE_COMBINATIONS, ENGINE_NUMPY, ENGINE_LUA],
+        help=str("set %(metavar)s as duplex-pair comparison engine\n"
+            + "supported %(metavar)s (default \"%(default)s\"):\n"
+            + "- " + ENGINE_SWEEP + ": compare duplexes sorted by binding site\n"
+            + "- " + ENGINE_COMBINATIONS + ": compare all duplex pairs\n"
+            + "- " + ENGINE_NUMPY + ": compare all duplexes at once (vectorized,\n"
+            + "  not with " + OPT_PUBLISH_EXT + ")\n"
+            + "- " + ENGINE_LUA + ": compare duplexes within redis (server-side)"))
+
+    # cache layout
+    parser.add_argument(
+        OPT_LAYOUT_EXT,
+        metavar="LAYOUT",
+        default=LAYOUT_FULL,
+        choices=[LAYOUT_FULL, LAYOUT_LEAN],
+        help=str("set %(metavar)s as cache layout of read duplexes\n"
+            + "supported %(metavar)s (default \"%(default)s\"):\n"
+            + "- " + LAYOUT_FULL + ": cache all duplex fields\n"
+            + "- " + LAYOUT_LEAN + ": cache the fields used by filtrate only,\n"
+            + "  and read all others from the input file"))
+
+    # duplex pair output
+    parser.add_argument(
+        OPT_PAIRS_EXT,
+        metavar="PAIRS",
+        default=PAIRS_LIST,
+        choices=[PAIRS_LIST, PAIRS_PACKED, PAIRS_BOTH],
+        help=str("set %(metavar)s as cache output of filtrated duplex pairs\n"
+            + "supported %(metavar)s (default \"%(default)s\"):\n"
+            + "- " + PAIRS_LIST + ": list of duplex ids of each target\n"
+            + "- " + PAIRS_PACKED + ": packed (line, line, distance) records\n"
+            + "  of each target\n"
+            + "- " + PAIRS_BOTH + ": both of the above"))
+
+    # filtrate schedule
+    parser.add_argument(
+        OPT_SCHEDULE_EXT,
+        metavar="SCHEDULE",
+        default=SCHEDULE_COST,
+        choices=[SCHEDULE_COST, SCHEDULE_RANDOM],
+        help=str("set %(metavar)s as order of the targets compared by filtrate\n"
+            + "supported %(metavar)s (default \"%(default)s\"):\n"
+            + "- " + SCHEDULE_COST + ": largest targets first, batching small\n"
+            + "  targets and splitting large ones across workers\n"
+            + "- " + SCHEDULE_RANDOM + ": one target at a time, in random order\n"
+            + "(ignored by the " + ENGINE_NUMPY + " engine)"))
+
+    # local reference genomes
+    parser.add_argument(
+        OPT_REF_EXT,
+        metavar="REF",
+        default=None,
+        help=str("set %(metavar)s as directory of local reference data,\n"
+            + "used by annotate instead of the UCSC servers:\n"
+            + "- BUILD.2bit, or BUILD.fa indexed by BUILD.fa.fai\n"
+            + "  (e.g. hg19.2bit) for genomic sequences\n"
+            + "- BUILD.refGene.txt[.gz], and optionally\n"
+            + "  BUILD.knownToRefSeq.txt[.gz], for genomic coordinates"))
+
+    # annotation cache
+    parser.add_argument(
+        OPT_ANNOTATIONS_EXT,
+        metavar="MB",
+        default="1024",
+        help=str("set %(metavar)s as size of the on-disk cache of annotated\n"
+            + "target genes, kept across runs (0 to disable)"))
+
+    # asyncio annotate engine
+    parser.add_argument(
+        OPT_CONCURRENCY_EXT,
+        metavar="N",
+        default="0",
+        help=str("set %(metavar)s as number of UCSC requests kept in flight\n"
+            + "by annotate, from a single event loop instead of\n"
+            + "EXE processes (default %(default)s: use EXE processes)"))
+
+    # UCSC request rate limit
+    parser.add_argument(
+        OPT_RATE_EXT,
+        metavar="RATE",
+        default="1",
+        help=str("set %(metavar)s as maximum number of UCSC requests per\n"
+            + "second sent by annotate with " + OPT_CONCURRENCY_EXT + "\n"
+            + "(default %(default)s, 0 for no limit)"))
+
+    # binding-site windows
+    parser.add_argument(
+        OPT_WINDOW_EXT,
+        metavar="PAD",
+        default=None,
+        help=str("fetch only the binding sites of the duplex pairs found by\n"
+            + "filtrate, padded by %(metavar)s nt., instead of the whole\n"
+            + "target gene sequences (default: whole target genes)"))
+
+    # distributed workers
+    parser.add_argument(
+        OPT_PUBLISH_EXT,
+        action="store_true",
+        default=False,
+        help=str("publish filtrate and annotate as jobs for the workers\n"
+            + "started with \"" + TRIPLEXER + " " + MODE_WORKER + "\" on any host\n"
+            + "sharing the redis cache, and wait for them to complete"))
+
+    # run metrics
+    parser.add_argument(
+        OPT_METRICS_EXT,
+        metavar="FILE",
+        default=None,
+        help=str("write the metrics of all processes and workers of the\n"
+            + "run (counters, rates, and latency histograms of cache,\n"
+            + "MySQL, and DAS requests) to %(metavar)s at the end of the\n"
+            + "run, in JSON if %(metavar)s ends with \".json\", or in\n"
+            + "the Prometheus text format otherwise"))
+
+    # operation profiles
+    parser.add_argument(
+        OPT_PROFILE_EXT,
+        action="store_true",
+        default=False,
+        help=str("profile each operation, and each of its workers, with\n"
+            + "cProfile, and report its hottest functions and the peak\n"
+            + "RSS of its processes (statistics written under\n"
+            + FILE_PATH + "/" + TRIPLEXER + ".profile)"))
+
+    # worker mode
+    parser.add_argument(
+        OPT_MODE,
+        metavar="MODE",
+        nargs="?",
+        default=None,
+        choices=[MODE_WORKER],
+        help=str("set %(metavar)s as mode of the invocation:\n"
+            + "- " + MODE_WORKER + ": run the jobs published with " + OPT_PUBLISH_EXT + ",\n"
+            + "  with EXE processes, until interrupted"))
     #
     # system setting arguments end
 
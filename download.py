@@ -0,0 +1,291 @@
+#
+# module for downloading namespace source files
+#
+
+
+import hashlib
+import json
+import logging
+import re
+import requests
+import time
+from common import *
+from pathlib import Path
+
+
+
+# downloads are streamed to a partial file, which is renamed once complete
+# and verified. The SHA-256 checksum of a complete download is recorded next
+# to it, along with its size and modification time: the file is only hashed
+# again when these change
+DOWNLOAD_EXT_PART = ".part"
+DOWNLOAD_EXT_META = ".meta.json"
+
+DOWNLOAD_CHUNK   = 1 << 20
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+
+CHECKSUM_CHUNK = 1 << 20
+
+# byte range of a partial response
+CONTENT_RANGE = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+
+# logger
+logger = logging.getLogger("download")
+
+
+
+# error raised when a file cannot be downloaded
+#
+class DownloadError(Exception):
+    """
+    Error raised when a source file cannot be downloaded or verified.
+    """
+    pass
+
+
+
+# return the SHA-256 checksum of the given file
+#
+def checksum(path):
+    """
+    Returns the hexadecimal SHA-256 checksum of the given file.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(CHECKSUM_CHUNK), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+
+# return the metadata recorded for the given download (its checksum, size
+# and modification time), or None if it is not a complete download
+#
+def read_meta(path):
+    """
+    Returns the metadata recorded for the given download, or None.
+    """
+
+    try:
+        with open(str(path) + DOWNLOAD_EXT_META, 'r') as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        return None
+
+
+
+# record the given checksum of the given download, along with its current
+# size and modification time
+#
+def write_meta(path, digest):
+    """
+    Records the checksum and file attributes of the given download.
+    """
+
+    stat = Path(path).stat()
+
+    with open(str(path) + DOWNLOAD_EXT_META, 'w') as dst:
+        json.dump({
+            "sha256": digest,
+            "size":   stat.st_size,
+            "mtime":  stat.st_mtime_ns
+        }, dst)
+
+
+
+# return the SHA-256 checksum of the given file. The checksum recorded at
+# download time is trusted as long as the file size and modification time are
+# unchanged
+#
+def get_checksum(path):
+    """
+    Returns the hexadecimal SHA-256 checksum of the given file, hashing it
+    only if it is not a download with unchanged attributes.
+    """
+
+    meta = read_meta(path)
+    stat = Path(path).stat()
+
+    if meta and (meta["size"], meta["mtime"]) == (stat.st_size, stat.st_mtime_ns):
+        return meta["sha256"]
+
+    return checksum(path)
+
+
+
+# return whether the given file is a complete and verified download. The file
+# is only hashed again if its size or modification time changed since it was
+# downloaded, in which case its checksum must match the recorded one
+#
+def is_cached(path):
+    """
+    Returns True if the given file was completely downloaded, and its content
+    is unchanged.
+    """
+
+    path = Path(path)
+    meta = read_meta(path)
+
+    if not (meta and path.is_file()):
+        return False
+
+    stat = path.stat()
+
+    if (meta["size"], meta["mtime"]) == (stat.st_size, stat.st_mtime_ns):
+        return True
+
+    if (meta["size"] != stat.st_size) or (meta["sha256"] != checksum(path)):
+        logger.info("Cached file %s does not match its checksum", path.name)
+        return False
+
+    # same content
+    # ==> refresh the file attributes
+    write_meta(path, meta["sha256"])
+
+    return True
+
+
+
+# stream the given URL into the given file, and yield each downloaded chunk
+# from the beginning of the file.
+# The download is written to a partial file first: a previous partial file is
+# resumed with an HTTP Range request (its content is yielded first), and
+# dropped connections are resumed the same way. Once complete, the download is
+# verified against the expected checksum (if given), and renamed
+#
+def stream(url, path, expected=None):
+    """
+    Downloads the given URL into the given file, resuming any partial
+    download, and yields all file chunks in order.
+    """
+
+    path = Path(path)
+    path_part = Path(str(path) + DOWNLOAD_EXT_PART)
+
+    digest = hashlib.sha256()
+    size = 0
+
+    # resume a previous partial download
+    if path_part.is_file():
+
+        logger.info("Resuming download of %s", path.name)
+
+        with open(path_part, 'rb') as src:
+            for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK), b""):
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+    retries = 0
+
+    with open(path_part, 'ab') as dst:
+
+        while True:
+
+            headers = {"Range": "bytes=%d-" % size} if size else {}
+
+            try:
+                with requests.get(url, headers=headers, stream=True,
+                        timeout=DOWNLOAD_TIMEOUT) as response:
+
+                    content_range = CONTENT_RANGE.match(
+                        response.headers.get("Content-Range", ""))
+
+                    # the partial file is already complete
+                    if response.status_code == 416:
+                        if response.headers.get("Content-Range") != "bytes */%d" % size:
+                            raise DownloadError(
+                                "Server rejected the range of " + str(size) + " bytes")
+                        break
+
+                    if response.status_code not in (200, 206):
+                        raise DownloadError(
+                            "Server returned " + str(response.status_code))
+
+                    if response.status_code == 206 and content_range is None:
+                        raise DownloadError("Server returned no content range")
+
+                    # the server ignored the range request, or returned a
+                    # range starting before the downloaded bytes
+                    # ==> skip the bytes that were already downloaded
+                    skip = size - (int(content_range.group(1))
+                        if response.status_code == 206 else 0)
+
+                    if skip < 0:
+                        raise DownloadError(
+                            "Server returned a range starting at "
+                            + content_range.group(1) + ", after " + str(size) + " bytes")
+
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK):
+
+                        if skip:
+                            skipped = min(skip, len(chunk))
+                            chunk, skip = chunk[skipped:], (skip - skipped)
+                            if not chunk:
+                                continue
+
+                        dst.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                        retries = 0
+                        yield chunk
+
+                break
+
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as error:
+
+                retries += 1
+                if retries > DOWNLOAD_RETRIES:
+                    raise DownloadError(str(error))
+
+                logger.info("Download of %s interrupted after %d bytes. Resuming (attempt %d of %d)",
+                    path.name, size, retries, DOWNLOAD_RETRIES)
+                dst.flush()
+                time.sleep(2 ** retries)
+
+    # verify the complete download
+    actual = digest.hexdigest()
+
+    if expected and actual != expected:
+        path_part.unlink()
+        raise DownloadError(
+            "Checksum mismatch for " + path.name + " (expected " + expected
+            + ", found " + actual + ")")
+
+    path_part.rename(path)
+    write_meta(path, actual)
+
+    logger.info("Downloaded %s (%d bytes, sha256 %s)", path.name, size, actual)
+
+
+
+# yield each (byte offset, line) pair found in the given stream of chunks.
+# Lines keep their line terminator
+#
+def lines(chunks):
+    """
+    Yields the byte offset and content of each line in the given stream of
+    chunks.
+    """
+
+    offset = 0
+    carry = b""
+
+    for chunk in chunks:
+
+        chunk_lines = (carry + chunk).split(b"\n")
+        carry = chunk_lines.pop()
+
+        for line in chunk_lines:
+            yield offset, line + b"\n"
+            offset += len(line) + 1
+
+    if carry:
+        yield offset, carry
+
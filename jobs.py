@@ -0,0 +1,353 @@
+#
+# module for distributing operations to workers on other hosts
+#
+
+
+import json
+import logging
+import metrics
+import profiler
+import queues
+import signal
+import socket
+import storage
+import sys
+import threading
+import time
+from cli import *
+from common import *
+from multiprocessing.connection import wait
+
+
+
+# a coordinator (an invocation of filtrate or annotate with OPT_PUBLISH)
+# publishes its operation as a job: the job is stored in the JOBS_KEY hash of
+# the cache, and announced on the JOBS_CHANNEL channel. Workers (invocations
+# of the worker mode, on any host sharing the cache) run each stored job once,
+# draining the same queue as the processes of the coordinator, and the
+# coordinator removes the job once its queue is drained.
+# Workers running a job are listed in its JOBS_RUNNING set until the job
+# returns (i.e. until they saved their metrics), so that the coordinator
+# reports the job once all its live workers acknowledged its completion.
+# Workers register a heartbeat in the JOBS_WORKERS hash every JOBS_HEARTBEAT
+# seconds, and are considered dead when their heartbeat is older than
+# JOBS_TIMEOUT seconds. The coordinator reports the progress of its job every
+# JOBS_REPORT seconds, and fails when neither its processes nor any live
+# worker are left to drain its queue for JOBS_TIMEOUT seconds
+JOBS_KEY       = str(TRIPLEXER + ":jobs")
+JOBS_CHANNEL   = str(TRIPLEXER + ":jobs")
+JOBS_WORKERS   = str(TRIPLEXER + ":workers")
+JOBS_RUNNING   = str(":running")
+JOBS_HEARTBEAT = 5
+JOBS_TIMEOUT   = 3 * JOBS_HEARTBEAT
+JOBS_REPORT    = 10
+
+# options of a job taken from the command line of each worker, rather than
+# from the coordinator
+JOBS_LOCAL_OPTIONS = [OPT_DB, OPT_EXE, OPT_REF, OPT_ANNOTATIONS]
+
+
+# logger
+logger = logging.getLogger("jobs")
+
+
+
+# return the live workers, as a dictionary mapping each worker to its last
+# heartbeat
+#
+def get_workers(cache):
+    """
+    Returns the last heartbeat of each live worker.
+    """
+
+    now = time.time()
+    workers = {}
+
+    for worker, value in cache.hgetall(JOBS_WORKERS).items():
+        heartbeat = json.loads(value)
+        if now - heartbeat["time"] <= JOBS_TIMEOUT:
+            workers[worker] = heartbeat
+
+    return workers
+
+
+
+# return the set of the workers running the given job
+#
+def get_running_key(job_id):
+    """
+    Returns the key of the set of the workers running the given job.
+    """
+
+    return str(JOBS_KEY + SEPARATOR + job_id + JOBS_RUNNING)
+
+
+
+# return the number of processes of all live workers
+#
+def get_capacity(cache):
+    """
+    Returns the number of processes of all live workers.
+    """
+
+    return sum(int(heartbeat["exe"]) for heartbeat in get_workers(cache).values())
+
+
+
+# publish the given operation, whose work items are held by the given queue,
+# to the live workers and to the workers started later. Jobs of earlier
+# coordinators on the same queue (e.g. interrupted runs) are replaced. Return
+# the job
+#
+def publish(cache, options, operation, queue, ordered=False):
+    """
+    Publishes the given operation and options as a job for the workers, and
+    returns the job.
+    """
+
+    if not storage.is_redis(cache):
+        logger.error("Publishing jobs requires a redis cache. Exiting")
+        sys.exit(2)
+
+    # options which are not plain values (e.g. open files) are not published
+    job = {
+        "id": str(queues.get_worker() + SEPARATOR + repr(time.time())),
+        "operation": operation,
+        "options": {
+            key: value for key, value in options.items()
+            if isinstance(value, (str, int, float, bool, type(None)))
+        },
+        "queue": queue,
+        "ordered": ordered,
+    }
+
+    for job_id, value in cache.hgetall(JOBS_KEY).items():
+        if json.loads(value)["queue"] == queue:
+            cache.hdel(JOBS_KEY, job_id)
+
+    cache.hset(JOBS_KEY, job["id"], json.dumps(job))
+    cache.publish(JOBS_CHANNEL, job["id"])
+
+    workers = get_workers(cache)
+    logger.info("  Published job %s to %d live workers (%d processes)",
+        job["id"], len(workers),
+        sum(int(heartbeat["exe"]) for heartbeat in workers.values()))
+
+    return job
+
+
+
+# return the number of pending, claimed, and completed items of the queue of
+# the given job
+#
+def get_progress(cache, job):
+    """
+    Returns the number of pending, claimed, and completed items of the given
+    job.
+    """
+
+    leases, done = queues.get_keys(job["queue"])
+
+    pipe = cache.pipeline(transaction=False)
+    if job["ordered"]:
+        pipe.llen(job["queue"])
+    else:
+        pipe.scard(job["queue"])
+    pipe.zcard(leases)
+    pipe.scard(done)
+
+    return pipe.execute()
+
+
+
+# wait for the given processes of the coordinator and for the workers to
+# drain the queue of the given job, reporting its progress, and remove the
+# job once its live workers completed it. Exit when the queue is left
+# without processes nor live workers for JOBS_TIMEOUT seconds (its items are
+# recovered by the next run)
+#
+def monitor(cache, job, procs):
+    """
+    Waits for the given job to be completed by the given processes and by
+    the workers, and reports its progress.
+    """
+
+    time_start = time.time()
+    time_report = time_start
+    time_workers = time_start
+    done_start = get_progress(cache, job)[2]
+
+    while True:
+
+        alive = [p.sentinel for p in procs if p.is_alive()]
+        pending, claimed, done = get_progress(cache, job)
+
+        if not alive and not pending and not claimed:
+            break
+
+        if alive or get_workers(cache):
+            time_workers = time.time()
+        elif time.time() - time_workers > JOBS_TIMEOUT:
+            logger.error(
+                "  Job %s: %d items pending and %d claimed, but no live workers for %d seconds. Exiting",
+                job["id"], pending, claimed, JOBS_TIMEOUT)
+            cache.hdel(JOBS_KEY, job["id"])
+            cache.publish(JOBS_CHANNEL, job["id"])
+            sys.exit(2)
+
+        if time.time() - time_report >= JOBS_REPORT:
+            time_report = time.time()
+            logger.info(
+                "  Job %s: %d items pending, %d claimed, %d completed (%.1f items/s), %d live workers",
+                job["id"], pending, claimed, done,
+                (done - done_start) / (time_report - time_start),
+                len(get_workers(cache)))
+
+        if alive:
+            wait(alive, timeout=queues.QUEUE_POLL)
+        else:
+            time.sleep(queues.QUEUE_POLL)
+
+    cache.hdel(JOBS_KEY, job["id"])
+    cache.publish(JOBS_CHANNEL, job["id"])
+
+    # workers which claimed no item of the queue still save their metrics
+    # before acknowledging the job
+    running = get_running_key(job["id"])
+    while True:
+        workers = get_workers(cache)
+        unacknowledged = [
+            worker for worker in cache.smembers(running)
+            if worker in workers
+        ]
+        if not unacknowledged:
+            break
+        time.sleep(queues.QUEUE_POLL)
+
+    cache.delete(running)
+
+    time_elapsed = time.time() - time_start
+    done = get_progress(cache, job)[2] - done_start
+
+    logger.info("  Job %s completed: %d items in %.2f seconds (%.1f items/s)",
+        job["id"], done, time_elapsed,
+        done / time_elapsed if time_elapsed > 0 else 0)
+
+
+
+# register the heartbeat of the given worker every JOBS_HEARTBEAT seconds,
+# until the given event is set. The heartbeat holds the host, the number of
+# processes, and the running job of the worker
+#
+def beat(options, worker, state, stop):
+    """
+    Registers the heartbeat of the given worker until stopped.
+    """
+
+    # the heartbeats have their own connection, not shared with the processes
+    # forked by the worker
+    cache = storage.connect(options[OPT_DB])
+
+    while True:
+        cache.hset(JOBS_WORKERS, worker, json.dumps({
+            "time": time.time(),
+            "host": socket.gethostname(),
+            "exe": options[OPT_EXE],
+            "job": state.get("job"),
+        }))
+
+        if stop.wait(JOBS_HEARTBEAT):
+            break
+
+    cache.hdel(JOBS_WORKERS, worker)
+
+
+
+# run each job published by the coordinators, with the operations of the
+# given launch table (namespace, operation), until interrupted
+#
+def serve(cache, options, launch):
+    """
+    Runs the jobs published by the coordinators, with the given operations,
+    until interrupted.
+    """
+
+    if not storage.is_redis(cache):
+        logger.error("Worker mode requires a redis cache. Exiting")
+        sys.exit(2)
+
+    worker = queues.get_worker()
+
+    # stop on SIGTERM (e.g. when the container stops) as on SIGINT
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, interrupt)
+
+    state = {}
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=beat, args=(options, worker, state, stop))
+    heartbeat.start()
+
+    # new jobs wake the worker up; jobs published before it started are
+    # found in the jobs hash
+    pubsub = cache.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(JOBS_CHANNEL)
+
+    logger.info("Worker %s waiting for jobs", worker)
+
+    completed = set()
+
+    try:
+        while True:
+
+            for job_id, value in sorted(cache.hgetall(JOBS_KEY).items()):
+                if job_id in completed:
+                    continue
+
+                job = json.loads(value)
+                completed.add(job_id)
+
+                # local options given to the worker override those of the
+                # coordinator
+                job_options = dict(job["options"])
+                job_options.update(
+                    (key, options[key]) for key in JOBS_LOCAL_OPTIONS
+                    if options.get(key) is not None)
+
+                ns = NAMESPACES[job_options[OPT_NAMESPACE]][NS_LABEL].split(SEPARATOR)[0]
+
+                # the processes of the worker record their metrics along with
+                # those of the coordinator, and are profiled on this host if
+                # the coordinator is
+                metrics.enable(job_options.get(OPT_METRICS) is not None)
+                profiler.enable(bool(job_options.get(OPT_PROFILE)))
+
+                logger.info("Job %s: operation \"%s\" started", job_id, job["operation"])
+                state["job"] = job_id
+                time_start = time.time()
+
+                # (profiles are kept apart from those of a coordinator on the
+                # same host)
+                running = get_running_key(job_id)
+                cache.sadd(running, worker)
+                try:
+                    profiler.start(str(job["operation"] + "." + worker))
+                    launch[ns][job["operation"]](cache, job_options)
+                    profiler.stop()
+                finally:
+                    cache.srem(running, worker)
+
+                state["job"] = None
+                logger.info("Job %s: operation \"%s\" completed in %.2f seconds",
+                    job_id, job["operation"], time.time() - time_start)
+
+            pubsub.get_message(timeout=JOBS_HEARTBEAT)
+
+    except KeyboardInterrupt:
+        logger.info("Worker %s interrupted", worker)
+
+    finally:
+        pubsub.close()
+        stop.set()
+        heartbeat.join()
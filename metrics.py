@@ -0,0 +1,315 @@
+#
+# module for collecting the performance metrics of a run
+#
+
+
+import bisect
+import json
+import logging
+import os
+import queues
+import threading
+import time
+from common import *
+from contextlib import contextmanager
+
+
+
+# each process records its own metrics:
+# - counters (e.g. lines read, duplex pairs compared), whose names start with
+#   the operation they refer to
+# - gauges (e.g. the duration of each operation, as OPERATION_seconds)
+# - latency histograms (e.g. of cache round trips, MySQL queries, and DAS
+#   requests), with the upper bounds METRICS_BUCKETS (in seconds)
+# Processes save their metrics in the METRICS_KEY hash of the cache (one field
+# per process, see queues.get_worker), so that the metrics of all workers,
+# including the workers of other hosts, are aggregated at the end of the run.
+# Metrics of forked processes start empty
+METRICS_KEY = str(TRIPLEXER + ":metrics")
+METRICS_BUCKETS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+]
+METRICS_PERCENTILES = [50, 95, 99]
+
+# metrics written in JSON (or otherwise in the Prometheus text format)
+METRICS_JSON = ".json"
+METRICS_PREFIX = TRIPLEXER
+
+
+# logger
+logger = logging.getLogger("metrics")
+
+
+# metrics of the current process, recorded only once enabled (enabled
+# processes fork enabled processes)
+registry = None
+lock = threading.Lock()
+enabled = False
+
+
+
+# enable (or disable) the metrics of the current process
+#
+def enable(flag=True):
+    """
+    Enables or disables the metrics of the current process.
+    """
+
+    global enabled
+
+    enabled = flag
+
+
+
+# return the metrics of the current process
+#
+def get_registry():
+    """
+    Returns the metrics of the current process.
+    """
+
+    global registry
+
+    # forked processes start with empty metrics
+    if registry is None or registry["pid"] != os.getpid():
+        registry = {
+            "pid": os.getpid(),
+            "counters": {},
+            "gauges": {},
+            "histograms": {},
+        }
+
+    return registry
+
+
+
+# add the given value to the given counter
+#
+def count(name, value=1):
+    """
+    Adds the given value to the given counter.
+    """
+
+    if not enabled:
+        return
+
+    with lock:
+        counters = get_registry()["counters"]
+        counters[name] = counters.get(name, 0) + value
+
+
+
+# set the given gauge to the given value
+#
+def gauge(name, value):
+    """
+    Sets the given gauge to the given value.
+    """
+
+    if not enabled:
+        return
+
+    with lock:
+        get_registry()["gauges"][name] = value
+
+
+
+# record the given number of seconds in the given latency histogram. Each
+# histogram holds the number of values of each bucket (the last one holding
+# the values above all METRICS_BUCKETS), their sum, and their number
+#
+def observe(name, seconds):
+    """
+    Records the given latency in the given histogram.
+    """
+
+    if not enabled:
+        return
+
+    with lock:
+        histograms = get_registry()["histograms"]
+
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {
+                "buckets": [0] * (len(METRICS_BUCKETS) + 1),
+                "sum": 0.0,
+                "count": 0,
+            }
+
+        histogram["buckets"][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+
+# record the duration of the enclosed block in the given latency histogram
+#
+@contextmanager
+def timer(name):
+    """
+    Records the duration of the enclosed block in the given histogram.
+    """
+
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - time_start)
+
+
+
+# save the metrics of the current process in the given cache
+#
+def save(cache):
+    """
+    Saves the metrics of the current process in the given cache.
+    """
+
+    if not enabled:
+        return
+
+    with lock:
+        value = json.dumps(get_registry())
+
+    cache.hset(METRICS_KEY, queues.get_worker(), value)
+
+
+
+# remove the metrics saved by an earlier run
+#
+def reset(cache):
+    """
+    Removes the metrics saved in the given cache.
+    """
+
+    cache.delete(METRICS_KEY)
+
+
+
+# return the metrics saved by all processes, aggregated. Counters and
+# histograms are summed, while gauges keep their largest value. Each counter
+# also has a rate, given the duration of its operation
+#
+def aggregate(cache):
+    """
+    Returns the aggregated metrics of all processes.
+    """
+
+    result = {
+        "processes": 0,
+        "counters": {},
+        "gauges": {},
+        "rates": {},
+        "histograms": {},
+    }
+
+    for value in cache.hgetall(METRICS_KEY).values():
+        metrics = json.loads(value)
+        result["processes"] += 1
+
+        for name, value in metrics["counters"].items():
+            result["counters"][name] = result["counters"].get(name, 0) + value
+
+        for name, value in metrics["gauges"].items():
+            result["gauges"][name] = max(result["gauges"].get(name, value), value)
+
+        for name, histogram in metrics["histograms"].items():
+            total = result["histograms"].setdefault(name, {
+                "buckets": [0] * (len(METRICS_BUCKETS) + 1),
+                "sum": 0.0,
+                "count": 0,
+            })
+            total["buckets"] = [x + y for x, y in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+    for name, value in result["counters"].items():
+        seconds = result["gauges"].get(name.split("_")[0] + "_seconds")
+        if seconds:
+            result["rates"][name] = value / seconds
+
+    # estimate the percentiles of each histogram (upper bound of the bucket)
+    for name, histogram in result["histograms"].items():
+        for percentile in METRICS_PERCENTILES:
+            histogram["p" + str(percentile)] = get_percentile(histogram, percentile)
+
+    return result
+
+
+
+# return the upper bound of the bucket holding the given percentile of the
+# given histogram (None if above all buckets, or if empty)
+#
+def get_percentile(histogram, percentile):
+    """
+    Returns an upper bound of the given percentile of the given histogram.
+    """
+
+    rank = histogram["count"] * percentile / 100
+    total = 0
+
+    for bound, count in zip(METRICS_BUCKETS, histogram["buckets"]):
+        total += count
+        if count and total >= rank:
+            return bound
+
+    return None
+
+
+
+# return the given aggregated metrics in the Prometheus text format. Rates
+# and percentiles are left to Prometheus
+#
+def get_prometheus(metrics):
+    """
+    Returns the given aggregated metrics in the Prometheus text format.
+    """
+
+    lines = []
+
+    for name, value in sorted(metrics["counters"].items()):
+        name = METRICS_PREFIX + "_" + name + "_total"
+        lines += ["# TYPE " + name + " counter", name + " " + repr(value)]
+
+    for name, value in sorted(metrics["gauges"].items()):
+        name = METRICS_PREFIX + "_" + name
+        lines += ["# TYPE " + name + " gauge", name + " " + repr(value)]
+
+    for name, histogram in sorted(metrics["histograms"].items()):
+        name = METRICS_PREFIX + "_" + name
+        lines.append("# TYPE " + name + " histogram")
+
+        total = 0
+        for bound, count in zip(METRICS_BUCKETS + ["+Inf"], histogram["buckets"]):
+            total += count
+            lines.append(name + "_bucket{le=\"" + str(bound) + "\"} " + str(total))
+
+        lines.append(name + "_sum " + repr(histogram["sum"]))
+        lines.append(name + "_count " + str(histogram["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+
+# write the metrics of all processes to the given file, in JSON if its name
+# ends with METRICS_JSON, or in the Prometheus text format otherwise (e.g. for
+# the textfile collector of the node exporter)
+#
+def report(cache, path):
+    """
+    Writes the aggregated metrics of all processes to the given file.
+    """
+
+    save(cache)
+    metrics = aggregate(cache)
+
+    with open(path, "w") as out:
+        if path.endswith(METRICS_JSON):
+            json.dump(metrics, out, indent=2, sort_keys=True)
+        else:
+            out.write(get_prometheus(metrics))
+
+    logger.info("Metrics of %d processes written to %s",
+        metrics["processes"], path)
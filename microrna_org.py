@@ -3,15 +3,32 @@
 #
 
 
-import itertools
+import annotations
+import asyncio
+import bisect
+import download
+import functools
+import jobs
 import logging
+import metrics
+import nucleotides
+import numpy
+import pairstore
+import profiler
+import queues
 import redis
-import requests
+import reference
+import refgene
+import scheduler
+import snapshot
+import storage
 import sys
+import time
 import ucsc
 from cli import *
 from common import *
-from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Array, Process, Value
 from pathlib import Path
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
@@ -68,16 +85,72 @@ duplex = {
 }
 
 
+# microrna.org duplex field types, as stored in snapshots
+SNAPSHOT_FIELDS = [
+    (MIRNA_ACCESSION,       snapshot.FIELD_STR),
+    (MIRNA_NAME,            snapshot.FIELD_STR),
+    (TARGET_GENE_ID,        snapshot.FIELD_STR),
+    (TARGET_GENE_SYMBOL,    snapshot.FIELD_STR),
+    (TRANSCRIPT_ID,         snapshot.FIELD_STR),
+    (TRANSCRIPT_ID_EXT,     snapshot.FIELD_STR),
+    (ALIGNMENT,             snapshot.FIELD_STR),
+    (ALIGNMENT_MIRNA,       snapshot.FIELD_STR),
+    (ALIGNMENT_GENE,        snapshot.FIELD_STR),
+    (ALIGNMENT_MIRNA_START, snapshot.FIELD_INT),
+    (ALIGNMENT_MIRNA_END,   snapshot.FIELD_INT),
+    (ALIGNMENT_GENE_START,  snapshot.FIELD_INT),
+    (ALIGNMENT_GENE_END,    snapshot.FIELD_INT),
+    (ALIGNMENT_SCORE,       snapshot.FIELD_INT),
+    (GENOME_COORDINATES,    snapshot.FIELD_STR),
+    (CONSERVATION,          snapshot.FIELD_FLOAT),
+    (SEED_TYPE,             snapshot.FIELD_INT),
+    (ENERGY,                snapshot.FIELD_FLOAT),
+    (MIRSRV_SCORE,          snapshot.FIELD_FLOAT)
+]
+
+
+# duplex fields cached by the lean layout (only those used by filtrate).
+# The lean layout does not cache one hash per duplex: the values of these
+# fields are joined in one string, and cached in a hash holding LAYOUT_BUCKET
+# consecutive lines of the input file, so that redis keeps each hash in its
+# compact encoding (see hash-max-listpack-entries). All other fields are read
+# from the input file, at the line offsets recorded by its snapshot.
+# NOTE: LUA_ALLOWED_COMPARISONS expects this field order
+LAYOUT_FIELDS = [ALIGNMENT_GENE_START, TRANSCRIPT_ID_EXT]
+LAYOUT_BUCKET = 100
+
+# number of read duplexes whose memory usage is sampled
+LAYOUT_SAMPLE = 1000
+
+
 # logger
 logger = logging.getLogger("microrna.org")
 
 
-# UCSC crawl operations
+# UCSC crawl operations, run in order. Steps can be replaced by local
+# alternatives (see get_crawl_steps)
+CRAWL_COORDINATES = "coordinates"
+CRAWL_SEQUENCE    = "sequence"
+
 crawl_ucsc = {
-    0: ucsc.genomic_coordinates,
-    1: ucsc.genomic_sequence,
+    CRAWL_COORDINATES: ucsc.genomic_coordinates,
+    CRAWL_SEQUENCE:    ucsc.genomic_sequence,
 }
 
+# asyncio annotate engine: number of target genes per UCSC request, number of
+# retries of failed requests, and delay before the first retry (in seconds,
+# doubled at each retry)
+ASYNC_BATCH   = ucsc.DAS_BATCH
+ASYNC_RETRIES = 3
+ASYNC_BACKOFF = 1.0
+
+# binding-site windows fetched instead of whole target genes (see
+# cache_windows). Each window is represented as CHROMOSOME:START-END:STRAND
+# (1-based counting, inclusive), and the windows of a target gene are joined
+# by WINDOW_SEPARATOR. Each candidate triplex (duplex pair) is identified by
+# the line numbers of its duplexes, LINE1:LINE2
+WINDOW_SEPARATOR = ";"
+
 
 
 # annotate each duplex with their gene's transcript sequences.
@@ -89,15 +162,74 @@ def annotate(cache, options):
     """
     Retrieves each target gene's transcript sequence from the UCSC.
     """
-    # crawl the UCSC to retrieve each target gene's genomic sequence (using
-    # their RefSeq IDs)
-    procs = [
-        Process(
-            target=retrieve_genomice_sequences,
-            args=(cache, options, x)
-        ) for x in range(int(options[OPT_EXE]))
-    ]
-    [px.start() for px in procs]
+
+    target_genes = str(NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL] + ":target" + ":genes")
+
+    # target genes claimed by an interrupted run are crawled again
+    queues.recover(cache, target_genes)
+
+    # only fetch the binding-site windows of each target gene, whose genomic
+    # coordinates are given by the duplexes
+    if options.get(OPT_WINDOW) is not None:
+        cache_windows(cache, options)
+
+    # let the workers on other hosts crawl the target genes too (see jobs)
+    job = None
+    if options.get(OPT_PUBLISH):
+        job = jobs.publish(cache, options, OPT_ANNOTATE, target_genes)
+
+    annotate_target_genes(cache, options, job)
+
+
+
+# crawl the target genes of the queue of the given namespace, with as many
+# processes as number of given cores (or from a single event loop), until the
+# queue is drained. This is the part of annotate run by the workers of a
+# published job (see jobs)
+#
+def annotate_target_genes(cache, options, job=None):
+    """
+    Retrieves the transcript sequences of the claimed target genes from the
+    UCSC, until none is left.
+    """
+
+    # crawl the UCSC (or the local alternatives) to retrieve each target
+    # gene's genomic sequence (using their RefSeq IDs). Local indexes are
+    # loaded once, and shared by all workers
+    crawl_steps = get_crawl_steps(options,
+        NAMESPACES[options[OPT_NAMESPACE]][NS_GENOME])
+
+    # the genomic coordinates of binding-site windows are already known
+    if options.get(OPT_WINDOW) is not None:
+        crawl_steps = {CRAWL_SEQUENCE: crawl_steps[CRAWL_SEQUENCE]}
+
+    # target genes annotated by earlier runs are taken from the annotation
+    # cache
+    annotation_cache = None
+    if int(options[OPT_ANNOTATIONS]) > 0:
+        annotation_cache = annotations.AnnotationCache(
+            int(options[OPT_ANNOTATIONS]) * 2**20)
+
+    procs = []
+
+    # keep UCSC requests in flight from a single event loop
+    if int(options[OPT_CONCURRENCY]) > 0:
+        asyncio.run(retrieve_genomice_sequences_async(
+            cache, options, crawl_steps, annotation_cache))
+
+    else:
+        procs = [
+            Process(
+                target=profiler.profile(retrieve_genomice_sequences),
+                args=(cache, options, crawl_steps, annotation_cache, x)
+            ) for x in range(int(options[OPT_EXE]))
+        ]
+        [px.start() for px in procs]
+
+    # wait for the workers of the published job
+    if job is not None:
+        jobs.monitor(cache, job, procs)
+
     [px.join()  for px in procs]
     [px.close() for px in procs]
 
@@ -107,80 +239,714 @@ def annotate(cache, options):
 
 
 
-# crawl UCSC to retrieve the genomic sequence of a cached target gene:
-# - fetch the next target gene
-# - create a Bio.SeqRecord object to store its RefSeq ID and genome build
-# - annotate the Bio.SeqRecord with the gene's genomice coordinates (UCSC)
-# - annotate the Bio.SeqRecord with the gene's genomice sequence (DAS)
+# crawl UCSC to retrieve the genomic sequence of cached target genes:
+# - fetch the next batch of target genes
+# - create a Bio.SeqRecord object for each of them, to store its RefSeq ID and
+#   genome build
+# - annotate the Bio.SeqRecords with the genes' genomice coordinates (UCSC)
+# - annotate the Bio.SeqRecords with the genes' genomice sequences (DAS)
+# Each crawl step of the given step table handles the whole batch at once
+# (e.g. with batched queries over a pooled connection).
+# Target genes found in the given annotation cache (if any) are not crawled,
+# and crawled target genes are added to it.
+# With OPT_WINDOW, only the binding-site windows of each target gene (found by
+# cache_windows) are crawled, and their genomic coordinates are already known
 #
-def retrieve_genomice_sequences(cache, options, core):
+def retrieve_genomice_sequences(cache, options, crawl_steps, annotation_cache, core):
     """
-    Retrieves a target gene's genomic coordinates from the UCSC and its
-    corresponding genomic sequence from the DAS server.
+    Retrieves target genes' genomic coordinates from the UCSC and their
+    corresponding genomic sequences from the DAS server.
     """
 
     namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
-    genome    = NAMESPACES[options[OPT_NAMESPACE]][NS_GENOME]
+    batch     = int(options[OPT_BATCH])
+
+    # target genes are claimed in adaptive chunks, of at least one UCSC
+    # request each
+    chunk = queues.Chunk(batch, min(batch, ucsc.DAS_BATCH))
 
     # per-worker summary statistics
     statistics_target_genes = 0
     statistics_target_genes_pass = 0
     statistics_target_genes_fail = 0
+    statistics_bases = 0
+    statistics_claims = 0
+    statistics_time_claim = 0
+    statistics_time_process = 0
+    statistics_time_flush = 0
+
+    # cache locations
+    target_genes = str(namespace + ":target" + ":genes")
 
     # work until there are available targets :)
     while True:
 
-        # cache locations
-        target_genes = str(namespace + ":target" + ":genes")
-        target_genes_pass = str(namespace + ":target" + ":genes" + ":pass")
-        target_genes_fail = str(namespace + ":target" + ":genes" + ":fail")
+        # claim the next target genes' RefSeq IDs
+        time_claim = time.time()
+        target_gene_batch = queues.claim(cache, target_genes, chunk.size)
+        statistics_time_claim += time.time() - time_claim
+
+        if not target_gene_batch:
+            if queues.wait(cache, target_genes):
+                continue
+            break
+
+        time_process = time.time()
+        statistics_claims += 1
+        statistics_target_genes += len(target_gene_batch)
+
+        # retrieve the target genes' genomice coordinates from the UCSC
+        logger.debug("  Worker %d: Retrieved %d target genes. Obtaining genomic coordinates from UCSC...",
+            core, len(target_gene_batch))
+
+        # handle each target gene's attributes (or the attributes of each of
+        # its binding-site windows) with Bio.SeqRecord objects. Those found
+        # in the annotation cache are not crawled
+        records, annotated, bio_seqs = get_target_gene_records(
+            cache, options, annotation_cache, target_gene_batch)
+
+        # update the target genes' attributes with the information
+        # retrieved from the UCSC
+        if bio_seqs:
+            for crawl_step in crawl_steps.values():
+
+                bio_seqs = crawl_step(bio_seqs, core)
+
+        time_flush = time.time()
+        statistics_time_process += time_flush - time_process
+
+        passed, failed, bases = cache_target_gene_records(cache, options,
+            annotation_cache, target_gene_batch, records, annotated, bio_seqs, core)
+
+        statistics_time_flush += time.time() - time_flush
+
+        # size the next chunk after the processing time of this one
+        chunk.update(len(target_gene_batch), time.time() - time_process)
+
+        statistics_target_genes_pass += passed
+        statistics_target_genes_fail += failed
+        statistics_bases += bases
+
+    ucsc.close_connections()
+
+    metrics.count("annotate_genes", statistics_target_genes)
+    metrics.count("annotate_genes_retrieved", statistics_target_genes_pass)
+    metrics.count("annotate_genes_failed", statistics_target_genes_fail)
+    metrics.count("annotate_bases", statistics_bases)
+    metrics.save(cache)
+
+    logger.info(
+        "  Worker %d: Requested genomic sequences of %d target genes. Retrieved %d (%d failed), %d nt. crawled",
+        core, statistics_target_genes,
+        statistics_target_genes_pass,
+        statistics_target_genes_fail,
+        statistics_bases
+    )
+    logger.info(
+        "  Worker %d: Claimed %d chunks (%d items at last) in %.2f seconds, processed them in %.2f seconds, and flushed them in %.2f seconds",
+        core, statistics_claims, chunk.size, statistics_time_claim,
+        statistics_time_process, statistics_time_flush
+    )
+
+    if annotation_cache:
+        logger.info(
+            "  Worker %d: Found %d target genes in the annotation cache (%d misses, %d evicted)",
+            core, annotation_cache.hits, annotation_cache.misses,
+            annotation_cache.evictions
+        )
+
+
+
+# crawl UCSC to retrieve the genomic sequence of cached target genes, as
+# retrieve_genomice_sequences, from a single event loop:
+# - batches of target genes are fetched and crawled concurrently, keeping up
+#   to OPT_CONCURRENCY batches (thus UCSC requests) in flight
+# - each batch holds ASYNC_BATCH target genes, so that each crawl step sends
+#   a single UCSC request (or a few, with OPT_WINDOW)
+# - crawl steps, and the reads and writes of the caches, are blocking, and
+#   run in a pool of threads. Each UCSC request (MySQL query, or DAS request)
+#   goes through a token bucket rate limit (OPT_RATE requests per second), and
+#   failed crawl steps are retried with exponential backoff
+#
+async def retrieve_genomice_sequences_async(cache, options, crawl_steps, annotation_cache):
+    """
+    Retrieves target genes' genomic coordinates from the UCSC and their
+    corresponding genomic sequences from the DAS server, with concurrent
+    rate-limited requests.
+    """
+
+    namespace   = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    batch       = min(int(options[OPT_BATCH]), ASYNC_BATCH)
+    concurrency = int(options[OPT_CONCURRENCY])
+
+    # summary statistics
+    statistics_target_genes = 0
+    statistics_target_genes_pass = 0
+    statistics_target_genes_fail = 0
+    statistics_bases = 0
+    statistics_retries = 0
+
+    # cache locations
+    target_genes = str(namespace + ":target" + ":genes")
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    bucket = ucsc.limit(float(options[OPT_RATE]))
+
+    # run the given crawl step on the given Bio.SeqRecords. UCSC requests are
+    # rate-limited, and retried on failure
+    async def crawl(step, bio_seqs):
+
+        nonlocal statistics_retries
+
+        crawl_step = crawl_steps[step]
+
+        # local alternatives do not send requests
+        if crawl_step not in crawl_ucsc.values():
+            return await loop.run_in_executor(executor, crawl_step, bio_seqs, 0)
+
+        for retry in range(ASYNC_RETRIES + 1):
+
+            try:
+                return await loop.run_in_executor(executor,
+                    functools.partial(crawl_step, bio_seqs, 0, strict=True))
+
+            except ucsc.UCSC_ERRORS as error:
+
+                if retry == ASYNC_RETRIES:
+                    logger.error("  Unable to send UCSC request after %d retries: %s",
+                        ASYNC_RETRIES, str(error))
+                    return [None] * len(bio_seqs)
+
+                delay = ASYNC_BACKOFF * 2**retry
+                logger.warning("  UCSC request failed (%s). Retrying in %.1f seconds...",
+                    str(error), delay)
+                statistics_retries += 1
+
+                await asyncio.sleep(delay)
+
+    # crawl the given batch of target genes, and record the outcome
+    async def crawl_batch(target_gene_batch):
+
+        nonlocal statistics_target_genes_pass, statistics_target_genes_fail
+        nonlocal statistics_bases
+
+        records, annotated, bio_seqs = await loop.run_in_executor(executor,
+            get_target_gene_records,
+            cache, options, annotation_cache, target_gene_batch)
+
+        if bio_seqs:
+            for step in crawl_steps:
+
+                bio_seqs = await crawl(step, bio_seqs)
+
+        passed, failed, bases = await loop.run_in_executor(executor,
+            cache_target_gene_records, cache, options,
+            annotation_cache, target_gene_batch, records, annotated, bio_seqs, 0)
+
+        statistics_target_genes_pass += passed
+        statistics_target_genes_fail += failed
+        statistics_bases += bases
+
+    time_start = time.time()
+
+    # work until there are available targets, with up to OPT_CONCURRENCY
+    # batches in flight :)
+    tasks = set()
+
+    while True:
 
-        # retrieve the next target gene's RefSeq ID
-        target_gene = cache.spop(target_genes)
+        # (this process is the only worker: all other claimed target genes
+        # are in flight)
+        target_gene_batch = queues.claim(cache, target_genes, batch)
 
-        if not target_gene:
+        if not target_gene_batch:
             break
 
-        else:
-            statistics_target_genes += 1
+        statistics_target_genes += len(target_gene_batch)
+        tasks.add(asyncio.ensure_future(crawl_batch(target_gene_batch)))
 
-            # retrieve the target gene's genomice coordinates from the UCSC
-            logger.debug("  Worker %d: Retrieved target gene %s. Obtaining genomic coordinates from UCSC...",
-                core, target_gene)
+        if len(tasks) >= concurrency:
+            done, tasks = await asyncio.wait(tasks,
+                return_when=asyncio.FIRST_COMPLETED)
+            [task.result() for task in done]
+
+    if tasks:
+        done, tasks = await asyncio.wait(tasks)
+        [task.result() for task in done]
+
+    time_elapsed = time.time() - time_start
+
+    executor.shutdown()
+    ucsc.close_connections()
+    ucsc.limit(None)
+
+    statistics_requests = bucket.taken
+
+    metrics.count("annotate_genes", statistics_target_genes)
+    metrics.count("annotate_genes_retrieved", statistics_target_genes_pass)
+    metrics.count("annotate_genes_failed", statistics_target_genes_fail)
+    metrics.count("annotate_bases", statistics_bases)
+    metrics.count("annotate_requests", statistics_requests)
+    metrics.count("annotate_retries", statistics_retries)
+
+    logger.info(
+        "  Requested genomic sequences of %d target genes. Retrieved %d (%d failed), %d nt. crawled",
+        statistics_target_genes,
+        statistics_target_genes_pass,
+        statistics_target_genes_fail,
+        statistics_bases
+    )
+
+    logger.info(
+        "  Annotated %.1f target genes/s (%.2f seconds), with %.1f UCSC requests/s (%d requests, %d retried)",
+        statistics_target_genes / max(time_elapsed, 1e-9), time_elapsed,
+        statistics_requests / max(time_elapsed, 1e-9),
+        statistics_requests, statistics_retries
+    )
 
-            # handle the target gene's attributes with a Bio.SeqRecord object
+    if annotation_cache:
+        logger.info(
+            "  Found %d target genes in the annotation cache (%d misses, %d evicted)",
+            annotation_cache.hits, annotation_cache.misses,
+            annotation_cache.evictions
+        )
+
+
+
+# return the Bio.SeqRecords of the given batch of target genes:
+# - by target gene, the records of its attributes: one record holding its
+#   RefSeq ID, or (with OPT_WINDOW) one record per binding-site window,
+#   holding the window's genomic coordinates
+# - by record id, the records found in the given annotation cache (if any)
+# - the records to crawl (those not found in the annotation cache)
+#
+def get_target_gene_records(cache, options, annotation_cache, target_gene_batch):
+    """
+    Returns the Bio.SeqRecords of each of the given target genes, those
+    annotated by earlier runs, and those to crawl.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    genome    = NAMESPACES[options[OPT_NAMESPACE]][NS_GENOME]
+
+    records = {}
+
+    if options.get(OPT_WINDOW) is None:
+        for target_gene in target_gene_batch:
             bio_seq = SeqRecord(seq="", id=target_gene)
             bio_seq.annotations[REF_GENOME] = genome
+            records[target_gene] = [bio_seq]
+
+    else:
+        windows = cache.hmget(str(namespace + ":target" + ":genes" + ":windows"),
+            target_gene_batch)
+
+        for target_gene, target_gene_windows in zip(target_gene_batch, windows):
+            records[target_gene] = []
+
+            for window in (target_gene_windows or "").split(WINDOW_SEPARATOR):
+                if not window:
+                    continue
+                chromosome, start, end, strand = get_window(window)
+                bio_seq = SeqRecord(seq="", id=window)
+                bio_seq.annotations[REF_GENOME]   = genome
+                bio_seq.annotations[REF_CHR]      = chromosome
+                bio_seq.annotations[REF_TX_START] = start
+                bio_seq.annotations[REF_TX_END]   = end
+                bio_seq.annotations[REF_STRAND]   = strand
+                records[target_gene].append(bio_seq)
+
+    # records shared by several target genes are crawled once
+    bio_seqs = list({
+        bio_seq.id: bio_seq
+        for target_gene in target_gene_batch
+        for bio_seq in records[target_gene]
+    }.values())
+
+    # records annotated by earlier runs
+    annotated = {}
+    if annotation_cache:
+        annotated = annotation_cache.get(genome,
+            [bio_seq.id for bio_seq in bio_seqs])
+
+    bio_seqs = [bio_seq for bio_seq in bio_seqs if bio_seq.id not in annotated]
+
+    return records, annotated, bio_seqs
+
+
+
+# cache the outcome of the crawl of the given batch of target genes, given
+# their records (see get_target_gene_records) and the crawled records (None
+# for failed crawls): a target gene is kept if all its records were
+# retrieved. With OPT_WINDOW, the packed sequence (see nucleotides) of the
+# window of each candidate of a kept target gene is sliced out of the
+# retrieved windows, and cached in a hash of the gene.
+# Crawled records are added to the given annotation cache (if any).
+# Return the number of kept and discarded target genes, and the number of
+# crawled nucleotides
+#
+def cache_target_gene_records(cache, options, annotation_cache, target_gene_batch,
+        records, annotated, bio_seqs, core):
+    """
+    Caches the kept and discarded target genes of the given batch, and
+    returns their number along with the number of crawled nucleotides.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+
+    # cache locations
+    target_genes_pass = str(namespace + ":target" + ":genes" + ":pass")
+    target_genes_fail = str(namespace + ":target" + ":genes" + ":fail")
+
+    crawled = [bio_seq for bio_seq in bio_seqs if bio_seq]
+
+    if annotation_cache:
+        annotation_cache.put(crawled)
+
+    annotated = dict(annotated)
+    annotated.update((bio_seq.id, bio_seq) for bio_seq in crawled)
+
+    passed = 0
+    failed = 0
+
+    # windows of the candidates of each target gene (see cache_windows)
+    if options.get(OPT_WINDOW) is not None:
+        pipe = cache.pipeline(transaction=False)
+        for target_gene in target_gene_batch:
+            pipe.hgetall(str(namespace + ":target" + ":gene:" + target_gene + ":candidates"))
+        candidates = dict(zip(target_gene_batch, pipe.execute()))
+
+    # acknowledge the target genes along with their outcome
+    pipe = cache.pipeline(transaction=False)
+    queues.ack(pipe, str(namespace + ":target" + ":genes"), target_gene_batch)
+
+    for target_gene in target_gene_batch:
+
+        target_gene_seqs = [
+            annotated.get(bio_seq.id) for bio_seq in records[target_gene]
+        ]
+
+        # a UCSC crawl operation fails
+        # ==> report error
+        if not target_gene_seqs or not all(target_gene_seqs):
+            failed += 1
+            pipe.sadd(target_genes_fail, target_gene)
+            logger.error("  Worker %d:   Could not fetch genomic attributes. Target gene %s discarded",
+                core, target_gene)
+
+        else:
+            passed += 1
+            pipe.sadd(target_genes_pass, target_gene)
+            logger.debug("  Worker %d:   Target gene %s kept",
+                core, target_gene)
+
+            if options.get(OPT_WINDOW) is not None:
+                target_gene_windows = str(namespace + ":target" + ":gene:" + target_gene + ":windows")
+                candidate_seqs = get_candidate_sequences(
+                    candidates[target_gene], target_gene_seqs)
+                pipe.delete(target_gene_windows)
+                if candidate_seqs:
+                    pipe.hset(target_gene_windows, mapping=candidate_seqs)
+
+    flush(pipe)
+
+    return passed, failed, sum(len(bio_seq) for bio_seq in crawled)
+
+
+
+# return the packed sequence (see nucleotides) of each of the given
+# candidates, given their windows, sliced out of the given retrieved windows
+# (Bio.SeqRecords) which cover them. Packed windows are sliced as they are
+#
+def get_candidate_sequences(candidates, window_seqs):
+    """
+    Returns a dictionary mapping each of the given candidates to the
+    serialized packed sequence of its window.
+    """
+
+    # retrieved windows by chromosome and strand, sorted by start position
+    windows = {}
+    for bio_seq in sorted(window_seqs, key=lambda bio_seq: bio_seq.annotations[REF_TX_START]):
+        sequence = bio_seq.seq
+        if not isinstance(sequence, nucleotides.PackedSequence):
+            sequence = nucleotides.PackedSequence.pack(sequence)
+        windows.setdefault(
+            (bio_seq.annotations[REF_CHR], bio_seq.annotations[REF_STRAND]), []).append(
+            (bio_seq.annotations[REF_TX_START], sequence))
+
+    starts = {
+        key: [start for start, sequence in key_windows]
+        for key, key_windows in windows.items()
+    }
+
+    result = {}
+
+    for candidate, window in candidates.items():
+
+        chromosome, start, end, strand = get_window(window)
+
+        # the last retrieved window starting before the candidate window
+        # covers it, as retrieved windows are merged from candidate windows
+        window_start, sequence = windows[(chromosome, strand)][
+            bisect.bisect_right(starts[(chromosome, strand)], start) - 1]
+
+        result[candidate] = \
+            sequence[(start - window_start):(end - window_start + 1)].to_bytes()
+
+    return result
+
+
+
+# return the crawl operations of the given genome build. Genomic coordinates
+# and sequences are read from the local refGene index and reference genome of
+# the build, if any, rather than from the UCSC MySQL interface and DAS server
+#
+def get_crawl_steps(options, genome):
+    """
+    Returns the crawl operations retrieving the genomic attributes of target
+    genes of the given genome build.
+    """
+
+    crawl_steps = dict(crawl_ucsc)
+
+    genome_refgene = refgene.find(options.get(OPT_REF), genome)
+
+    if genome_refgene:
+        crawl_steps[CRAWL_COORDINATES] = genome_refgene.genomic_coordinates
+
+    genome_reference = reference.find(options.get(OPT_REF), genome)
+
+    if genome_reference:
+        crawl_steps[CRAWL_SEQUENCE] = genome_reference.genomic_sequence
+
+    return crawl_steps
+
+
+
+# cache the binding-site windows of each target gene: the genomic range of
+# each candidate (duplex pair binding within range, from its duplexes' genome
+# coordinates), padded by OPT_WINDOW nt. on each side. The window of each
+# candidate is cached in a hash of its target gene, while the windows of each
+# target gene, merged when they overlap or are adjacent, are cached in a hash
+# of the namespace mapping each target gene to the windows to retrieve
+#
+def cache_windows(cache, options):
+    """
+    Caches the merged, padded, binding-site windows of the duplex pairs of
+    each target gene.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    batch     = int(options[OPT_BATCH])
+    padding   = int(options[OPT_WINDOW])
 
-            # update the target gene's attributes with the information
-            # retrieved from the UCSC
-            for step in range(len(crawl_ucsc.keys())):
+    target_genes_windows = str(namespace + ":target" + ":genes" + ":windows")
 
-                bio_seq = crawl_ucsc[step](bio_seq, core)
+    logger.info("  Finding the binding-site windows of each target gene (%d nt. padding) ...",
+        padding)
 
-            # a UCSC crawl operation fails
-            # ==> report error
-            if not bio_seq:
-                statistics_target_genes_fail += 1
-                cache.sadd(target_genes_fail, target_gene)
-                logger.error("  Worker %d:   Could not fetch genomic attributes. Target gene %s discarded",
-                    core, target_gene)
+    # windows of the candidates of each target gene
+    windows = {}
+    statistics_duplex_pairs = 0
+
+    pairs = []
+    for target, target_pairs in get_duplex_pairs(cache, namespace, batch):
+
+        pairs += target_pairs
+
+        if len(pairs) < batch:
+            continue
+
+        statistics_duplex_pairs += len(pairs)
+        add_windows(cache, options, windows, pairs, padding)
+        pairs = []
+
+    if pairs:
+        statistics_duplex_pairs += len(pairs)
+        add_windows(cache, options, windows, pairs, padding)
+
+    # cache the merged windows of each target gene
+    cache.delete(target_genes_windows)
+
+    target_genes = sorted(windows.keys())
+    statistics_candidates = 0
+    statistics_windows = 0
+    statistics_bases = 0
+
+    for x in range(0, len(target_genes), batch):
+
+        pipe = cache.pipeline(transaction=False)
+
+        for target_gene in target_genes[x:(x + batch)]:
+
+            target_gene_candidates = str(namespace + ":target" + ":gene:" + target_gene + ":candidates")
+            pipe.delete(target_gene_candidates)
+            pipe.hset(target_gene_candidates, mapping=dict(
+                (candidate, get_window_id(*window))
+                for candidate, window in windows[target_gene].items()
+            ))
+
+            target_gene_windows = merge_windows(windows[target_gene].values())
+
+            statistics_candidates += len(windows[target_gene])
+            statistics_windows += len(target_gene_windows)
+            statistics_bases += sum(
+                end - start + 1 for chromosome, start, end, strand in target_gene_windows)
 
-            else:
-                statistics_target_genes_pass += 1
-                cache.sadd(target_genes_pass, target_gene)
-                logger.debug("  Worker %d:   Target gene %s kept",
-                    core, target_gene)
+            pipe.hset(target_genes_windows, target_gene, WINDOW_SEPARATOR.join(
+                get_window_id(*window) for window in target_gene_windows))
+
+        flush(pipe)
 
     logger.info(
-        "  Worker %d: Requested genomic sequences of %d target genes. Retrieved %d (%d failed)",
-        core, statistics_target_genes,
-        statistics_target_genes_pass,
-        statistics_target_genes_fail
+        "  Found %d binding-site windows (%d nt.) of %d target genes, covering %d candidates from %d duplex pairs",
+        statistics_windows, statistics_bases, len(target_genes),
+        statistics_candidates, statistics_duplex_pairs
     )
 
 
 
+# yield each target with duplex pairs binding within range, and the list of
+# its pairs of duplex ids, read from the packed pair store if filtrate
+# filled it, or from the pair list of each target otherwise
+#
+def get_duplex_pairs(cache, namespace, batch):
+    """
+    Yields each target and the duplex id pairs binding within range.
+    """
+
+    if cache.exists(pairstore.get_key(namespace)):
+
+        for target, records in pairstore.read(cache, namespace, batch):
+            yield target, [
+                (namespace + ":duplex:line" + str(line1),
+                    namespace + ":duplex:line" + str(line2))
+                for line1, line2 in zip(records["line1"].tolist(), records["line2"].tolist())
+            ]
+
+        return
+
+    targets = sorted(cache.smembers(
+        str(namespace + ":targets:with_mirna_pair_in_allowed_binding_range")))
+
+    for x in range(0, len(targets), batch):
+
+        pipe = cache.pipeline(transaction=False)
+
+        for target in targets[x:(x + batch)]:
+            pipe.lrange((target + ":with_mirna_pair_in_allowed_binding_range"), 0, -1)
+
+        for target, duplexes in zip(targets[x:(x + batch)], pipe.execute()):
+            yield target, list(zip(duplexes[0::2], duplexes[1::2]))
+
+
+
+# add the padded genomic range of each of the given duplex pairs to the
+# windows of the candidates of its target gene
+#
+def add_windows(cache, options, windows, pairs, padding):
+    """
+    Adds the padded binding-site window of each given duplex pair to the
+    given dictionary of candidate windows by target gene.
+    """
+
+    duplex_hashes = get_duplex_hashes(cache, options,
+        set(duplex for pair in pairs for duplex in pair))
+
+    for duplex1, duplex2 in pairs:
+
+        sites = [
+            get_site(duplex_hashes[duplex][GENOME_COORDINATES])
+            for duplex in (duplex1, duplex2)
+        ]
+
+        # both duplexes bind the same transcript, thus the same chromosome
+        # and strand
+        chromosome, start, end, strand = sites[0]
+
+        candidate = str(get_line_number(duplex1)) + SEPARATOR + str(get_line_number(duplex2))
+
+        windows.setdefault(duplex_hashes[duplex1][TRANSCRIPT_ID_EXT], {})[candidate] = (
+            chromosome,
+            max(min(start, sites[1][1]) - padding, 1),
+            max(end, sites[1][2]) + padding,
+            strand
+        )
+
+
+
+# return the (chromosome, start, end, strand) genomic range of the given
+# duplex genome coordinates, e.g. [hg19:8:39771521-39771528,39775394-39775407:+]
+# (1-based counting, inclusive). Binding sites spanning several exons are
+# given as several ranges, and are covered by a single range
+#
+def get_site(genome_coordinates):
+    """
+    Returns the genomic range of the given duplex genome coordinates.
+    """
+
+    genome, chromosome, ranges, strand = genome_coordinates.strip("[]").split(SEPARATOR)
+
+    positions = [
+        int(position)
+        for section in ranges.split(",")
+        for position in section.split("-")
+    ]
+
+    return "chr" + chromosome, min(positions), max(positions), strand
+
+
+
+# return the (chromosome, start, end, strand) genomic range of the given
+# binding-site window
+#
+def get_window(window):
+    """
+    Returns the genomic range of the given window.
+    """
+
+    chromosome, section, strand = window.rsplit(SEPARATOR, 2)
+    start, end = section.split("-")
+
+    return chromosome, int(start), int(end), strand
+
+
+
+# return the binding-site window of the given genomic range
+#
+def get_window_id(chromosome, start, end, strand):
+    """
+    Returns the window of the given genomic range.
+    """
+
+    return chromosome + SEPARATOR + str(start) + "-" + str(end) + SEPARATOR + strand
+
+
+
+# return the given genomic ranges, sorted, and merged when they overlap or
+# are adjacent
+#
+def merge_windows(windows):
+    """
+    Returns the sorted union of the given genomic ranges.
+    """
+
+    result = []
+
+    for chromosome, start, end, strand in sorted(windows):
+
+        if result and result[-1][0] == chromosome and result[-1][3] == strand \
+                and start <= (result[-1][2] + 1):
+            result[-1][2] = max(result[-1][2], end)
+
+        else:
+            result.append([chromosome, start, end, strand])
+
+    return [tuple(window) for window in result]
+
+
+
 # read the microrna.org target prediction file and cache all putative triplexes
 #
 def read(cache, options):
@@ -189,144 +955,649 @@ def read(cache, options):
     within it.
     """
 
-    count_lines    = 0
-    count_duplexes = 0
+    ns_source = NAMESPACES[options[OPT_NAMESPACE]][NS_SOURCE]
+
+    in_file, in_file_cached = get_input_file(options)
+
+    # input namespace
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+
+    logger.info("  Reading putative triplexes from microrna.org file \"%s\" ...", in_file)
+    logger.info("  Namespace \"%s\"", namespace)
+
+
+    # setup a redis set to contain all duplex's targets
+    targets = str(namespace + ":targets")
+
+    # the targets read now are compared again by filtrate, including those
+    # completed (or scheduled) by an earlier run
+    queues.reset(cache, targets)
+    scheduler.reset(cache, namespace)
+
+    # record the cache layout of the read duplexes
+    logger.info("  Caching duplexes with the \"%s\" layout", options[OPT_LAYOUT])
+    cache.hset(str(namespace + ":layout"), OPT_LAYOUT, options[OPT_LAYOUT])
+
+    used_memory = get_used_memory(cache)
+
+    # lines and duplexes read by all workers
+    count_lines    = Value("i", 0)
+    count_duplexes = Value("i", 0)
+
+    time_start = time.time()
+
+    snap = snapshot.load(ns_source, in_file) if in_file_cached else None
+    from_snapshot = snap is not None
+
+    # the input file is not cached
+    # ==> download it, and read each line as soon as it is downloaded. The
+    #     download is resumed if interrupted, and verified once complete
+    if not in_file_cached:
+
+        logger.info("Downloading target prediction file from " + ns_source)
+
+        shards = [None]
+        procs = []
+
+        try:
+            read_lines(cache, options,
+                download.lines(download.stream(ns_source, in_file)),
+                1, snapshot.get_part_path(in_file, 0), 0,
+                count_lines, count_duplexes)
+
+        except download.DownloadError as error:
+            logger.error("Error retrieving target prediction file. " + str(error))
+            sys.exit(1)
+
+    # the input file was read before, and its snapshot is still valid
+    # ==> split the snapshot rows in as many shards as number of given cores,
+    #     and cache each shard in parallel, without parsing the input file
+    elif snap:
+
+        logger.info("  Using snapshot %s", snap.path)
+
+        exe = int(options[OPT_EXE])
+        shards = [
+            ((snap.rows * x) // exe, (snap.rows * (x + 1)) // exe)
+            for x in range(exe)
+        ]
+
+        procs = [
+            Process(
+                target=profiler.profile(read_snapshot_shard),
+                args=(cache, options, snap.path, shards[x], x,
+                    count_duplexes)
+            ) for x in range(len(shards))
+        ]
+
+    # the input file is cached, but has no valid snapshot
+    # ==> split the input file in as many shards as number of given cores,
+    #     and read each shard in parallel. Each worker also writes a part of
+    #     the snapshot
+    else:
+
+        shards = get_shards(in_file, int(options[OPT_EXE]))
+
+        logger.info("  Reading %d shards in parallel ...", len(shards))
+
+        procs = [
+            Process(
+                target=profiler.profile(read_shard),
+                args=(cache, options, in_file, shards[x], x,
+                    count_lines, count_duplexes)
+            ) for x in range(len(shards))
+        ]
+
+    [p.start() for p in procs]
+    [p.join() for p in procs]
+    [p.close() for p in procs]
+
+    time_elapsed = time.time() - time_start
+
+    # merge the snapshot parts written by all workers
+    if not snap:
+        time_snapshot = time.time()
+        snap = snapshot.merge(ns_source, in_file, SNAPSHOT_FIELDS, [
+            snapshot.get_part_path(in_file, x) for x in range(len(shards))
+        ])
+        logger.info("  Saved snapshot %s in %.2f seconds",
+            snap.path, time.time() - time_snapshot)
+
+    # record the number of duplexes of each target, to schedule filtrate
+    scheduler.cache_costs(cache, namespace, int(options[OPT_BATCH]))
+
+    metrics.count("read_lines", count_lines.value)
+    metrics.count("read_duplexes", count_duplexes.value)
+
+    logger.info(
+        "  Found %s RNA duplexes across %s target genes",
+        str(count_duplexes.value), str(cache.scard(targets))
+    )
+
+    # snapshots hold the duplexes of the input file, not its lines
+    if from_snapshot:
+        logger.info(
+            "  Read %d duplexes from snapshot in %.2f seconds (%.0f duplexes/s)",
+            count_duplexes.value, time_elapsed,
+            count_duplexes.value / time_elapsed if time_elapsed > 0 else 0
+        )
+    else:
+        logger.info(
+            "  Read %d lines in %.2f seconds (%.0f lines/s)",
+            count_lines.value, time_elapsed,
+            count_lines.value / time_elapsed if time_elapsed > 0 else 0
+        )
+
+    if used_memory is not None:
+        report_memory(cache, options, snap, count_duplexes.value, used_memory)
+
+
+
+# return the memory used by the given cache, or None if the cache does not
+# report it (i.e. it is not a redis instance, or INFO is disabled)
+#
+def get_used_memory(cache):
+    """
+    Returns the number of bytes used by the given redis cache, or None for
+    other databases.
+    """
+
+    if not storage.is_redis(cache):
+        return None
+
+    try:
+        return cache.info("memory")["used_memory"]
+
+    except redis.ResponseError:
+        return None
+
+
+
+# report the memory taken by the read duplexes, in the layout they were
+# cached with.
+# The memory usage of the duplexes is measured on a sample of the keys read
+# (the duplex hashes, or the buckets holding them in the lean layout), and
+# extrapolated to all read duplexes. Nothing is written to the cache
+#
+def report_memory(cache, options, snap, duplexes, used_memory):
+    """
+    Logs the redis memory taken by the read duplexes, in the cache layout
+    they were read with.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    layout = get_layout(cache, namespace)
+
+    logger.info("  Cache memory grew by %.1f MB while reading",
+        (get_used_memory(cache) - used_memory) / 2**20)
+
+    # sampled duplex hashes, or the buckets holding the sampled duplexes
+    keys = [
+        str(namespace + ":duplex:line" + str(line_number))
+        for line_number in snap.lines()[:LAYOUT_SAMPLE].tolist()
+    ]
+    if layout == LAYOUT_LEAN:
+        keys = sorted(set(get_bucket(key)[0] for key in keys))
+
+    pipe = cache.pipeline(transaction=False)
+
+    try:
+        for key in keys:
+            pipe.memory_usage(key)
+            if layout == LAYOUT_LEAN:
+                pipe.hlen(key)
+        usage = pipe.execute()
+
+    except redis.ResponseError:
+        logger.info("  Cache memory usage by layout not available")
+        return
+
+    # buckets also hold the duplexes following the sample
+    if layout == LAYOUT_LEAN:
+        usage, sampled = usage[0::2], sum(usage[1::2])
+    else:
+        sampled = sum(1 for key_usage in usage if key_usage is not None)
+
+    if not sampled:
+        return
+
+    # bytes per duplex
+    usage = sum(key_usage for key_usage in usage if key_usage is not None) / sampled
+
+    logger.info(
+        "  Duplex hashes take about %.1f MB in the \"%s\" layout (%.0f bytes per duplex, sampled on %d duplexes)",
+        usage * duplexes / 2**20, layout, usage, sampled
+    )
 
-    in_file = None
 
 
-    # download the input file that is relative to the current namespace.
-    # However, avoid downloading more than once
+# return the input file that is relative to the current namespace, and
+# whether it can be read. Downloaded files can only be read once they are
+# complete and verified
+#
+def get_input_file(options):
+    """
+    Returns the path of the microrna.org target prediction file of the current
+    namespace, and whether the file is available (test data, or a verified
+    download).
+    """
 
     ns_source = NAMESPACES[options[OPT_NAMESPACE]][NS_SOURCE]
+    ns_file = get_input_path(options)
 
     # the requested file is within the known test data path
     # ==> use it
     if Path(TEST_PATH) in Path(ns_source).parents:
 
         logger.info("Using \"test data\" target prediction file " + ns_source)
-        in_file = Path(ns_source)
+        return ns_file, True
 
     # the requested file is not within the known test data path
-    # ==> download it, or use its local copy
-    else:
+    # ==> use its local copy, unless it has to be downloaded
+    if download.is_cached(ns_file):
+
+        logger.info("Using cached target prediction file " + ns_file.name)
+        return ns_file, True
+
+    return ns_file, False
 
-        ns_file = Path(FILE_PATH).joinpath(ns_source.split('/')[-1])
 
-        # file is not there
-        # ==> download it
-        if not ns_file.is_file():
 
-            logger.info("Downloading target prediction file from " + ns_source)
-            response = requests.get(ns_source)
-            if response.status_code == 200:
-                with open(ns_file, 'wb') as dst:
-                    dst.write(response.content)
-            else:
-                logger.error("Error retrieving target prediction file. Server returned "
-                    + str(response.status_code))
-                sys.exit(1)
+# return the path of the input file that is relative to the current namespace:
+# test data are read in place, while all other files are downloaded in
+# FILE_PATH
+#
+def get_input_path(options):
+    """
+    Returns the local path of the microrna.org target prediction file of the
+    current namespace.
+    """
+
+    ns_source = NAMESPACES[options[OPT_NAMESPACE]][NS_SOURCE]
+
+    if Path(TEST_PATH) in Path(ns_source).parents:
+        return Path(ns_source)
+
+    return Path(FILE_PATH).joinpath(ns_source.split('/')[-1])
+
+
+
+# return the snapshot of the input file that is relative to the current
+# namespace, or None if the file was never read (or changed since)
+#
+def get_snapshot(options):
+    """
+    Returns the memory-mapped snapshot of the microrna.org target prediction
+    file of the current namespace, or None if there is no valid snapshot.
+    """
+
+    ns_source = NAMESPACES[options[OPT_NAMESPACE]][NS_SOURCE]
+    in_file = get_input_path(options)
+
+    if not in_file.is_file():
+        return None
+
+    return snapshot.load(ns_source, in_file)
+
+
+
+# split the given file in (at most) the given number of byte-range shards.
+# Each shard starts at the beginning of a line, and ends at the beginning of
+# the next shard. Return a list of (start byte, end byte, start line number)
+# triples.
+# Line numbers are counted from 1, as in a serial read of the file
+#
+def get_shards(in_file, count):
+    """
+    Returns the byte ranges and starting line numbers of the given number of
+    line-aligned shards of the provided file.
+    """
+
+    size = Path(in_file).stat().st_size
+
+    # find the shard boundaries by moving each evenly-spaced offset to the
+    # beginning of its next line
+    boundaries = [0]
+
+    with open(in_file, 'rb') as src:
+
+        for x in range(1, max(count, 1)):
+
+            src.seek(max((size * x) // count - 1, 0))
+            src.readline()
+            boundary = min(src.tell(), size)
+
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+
+        boundaries.append(size)
+
+        # count the lines preceding each boundary. Since each boundary
+        # follows a line terminator, this is the number of line terminators
+        # found in the previous shards
+        line_numbers = [1]
+        src.seek(0)
+
+        for start, end in zip(boundaries[:-2], boundaries[1:-1]):
+
+            lines = 0
+            remaining = end - start
+
+            while remaining > 0:
+                chunk = src.read(min(remaining, 1 << 20))
+                lines += chunk.count(b"\n")
+                remaining -= len(chunk)
+
+            line_numbers.append(line_numbers[-1] + lines)
+
+    shards = [
+        (boundaries[x], boundaries[x+1], line_numbers[x])
+        for x in range(len(boundaries) - 1)
+        if boundaries[x] < boundaries[x+1]
+    ]
+
+    return shards
+
+
+
+# read a shard of the microrna.org target prediction file, and cache all its
+# duplexes
+#
+def read_shard(cache, options, in_file, shard, core,
+        count_lines, count_duplexes):
+    """
+    Reads the given byte-range shard of the microrna.org target prediction
+    file, and caches all duplexes within it.
+    """
+
+    start, end, line_number = shard
+
+    with open(in_file, 'rb') as src:
+
+        src.seek(start)
+
+        read_lines(cache, options, get_lines(src, start, end), line_number,
+            snapshot.get_part_path(in_file, core), core,
+            count_lines, count_duplexes)
+
+
+
+# yield each (byte offset, line) pair of the given file, between the given
+# byte offsets
+#
+def get_lines(src, start, end):
+    """
+    Yields the byte offset and content of each line of the given file between
+    the given byte offsets.
+    """
+
+    position = start
+
+    while position < end:
+
+        line = src.readline()
+        if not line:
+            break
+
+        yield position, line
+        position += len(line)
+
+
+
+# read the given (byte offset, line) pairs of the microrna.org target
+# prediction file, starting at the given line number, and cache all their
+# duplexes.
+# Each line represents a duplex, holding a target id, a miRNA id, and all
+# attributes related to the complex.
+# Multiple lines can refer to the same target.
+# Store each duplex in a target-specific redis set.
+# Cache commands are queued in a redis pipeline, and sent to the cache every
+# "batch" duplexes, to avoid one round trip per command.
+# Parsed lines are also written to the given snapshot part
+#
+def read_lines(cache, options, lines, line_number, part, core,
+        count_lines, count_duplexes):
+    """
+    Reads the given lines of the microrna.org target prediction file, and
+    caches all duplexes within them.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    layout = options[OPT_LAYOUT]
+    batch = int(options[OPT_BATCH])
+
+    # snapshot part of these lines
+    writer = snapshot.Writer(part, SNAPSHOT_FIELDS)
+
+    # per-worker summary statistics
+    statistics_lines = 0
+    statistics_duplexes = 0
+
+    time_start = time.time()
+
+    pipe = cache.pipeline(transaction=False)
+
+    for offset, line in lines:
+
+        line = line.decode("utf-8")
+
+        if not line.startswith(CHAR_HEADING):
+
+            statistics_duplexes += 1
+
+            # create a redis hash to hold all attributes of the current
+            # duplex line.
+            # Each redis hash represents a duplex.
+            # Multiple duplexes can be relative to a same target.
+            logger.debug("    Worker %d: Reading duplex on line %d",
+                core, line_number)
+
+            target_hash = get_hash(line)
+
+            cache_duplex(pipe, namespace, layout, target_hash, line_number)
+            writer.append(line_number, offset, target_hash)
+
+            # flush the queued commands
+            if statistics_duplexes % batch == 0:
+                flush(pipe)
+
+            # in a late processing step, "workers" will take each target,
+            # and compare each hash with each others to spot for miRNA
+            # binding in close proximity.
+            # The comparison problem will be quadratic.
+
+        line_number += 1
+        statistics_lines += 1
+
+    flush(pipe)
+
+    writer.close()
+
+    time_elapsed = time.time() - time_start
+
+    with count_lines.get_lock():
+        count_lines.value += statistics_lines
+
+    with count_duplexes.get_lock():
+        count_duplexes.value += statistics_duplexes
+
+    metrics.save(cache)
+
+    logger.info(
+        "  Worker %d: Read %d lines (%d duplexes) in %.2f seconds (%.0f lines/s)",
+        core, statistics_lines, statistics_duplexes, time_elapsed,
+        statistics_lines / time_elapsed if time_elapsed > 0 else 0
+    )
+
+
+
+# cache all duplexes found between the given rows of the snapshot of the
+# microrna.org target prediction file
+#
+def read_snapshot_shard(cache, options, snap_path, shard, core,
+        count_duplexes):
+    """
+    Caches all duplexes found in the given row range of the snapshot of the
+    microrna.org target prediction file.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    layout = options[OPT_LAYOUT]
+    batch = int(options[OPT_BATCH])
+
+    snap = snapshot.Snapshot(snap_path)
+
+    # per-worker summary statistics
+    statistics_duplexes = 0
+
+    time_start = time.time()
+
+    pipe = cache.pipeline(transaction=False)
+
+    # convert the snapshot rows to hashes one batch at a time
+    for start in range(shard[0], shard[1], batch):
+
+        for line_number, target_hash in snap.hashes(start, min(start + batch, shard[1])):
+
+            statistics_duplexes += 1
+
+            logger.debug("    Worker %d: Reading duplex on line %d",
+                core, line_number)
+
+            cache_duplex(pipe, namespace, layout, target_hash, line_number)
+
+        flush(pipe)
+
+    time_elapsed = time.time() - time_start
+
+    with count_duplexes.get_lock():
+        count_duplexes.value += statistics_duplexes
+
+    metrics.save(cache)
+
+    logger.info(
+        "  Worker %d: Read %d duplexes from snapshot in %.2f seconds (%.0f duplexes/s)",
+        core, statistics_duplexes, time_elapsed,
+        statistics_duplexes / time_elapsed if time_elapsed > 0 else 0
+    )
+
 
-        # file is there
-        # ==> use it
-        else:
 
-            logger.info("Using cached target prediction file " + ns_file.name)
+# queue the cache commands storing the given duplex hash (read from the given
+# line number) with the given cache layout:
+# - the duplex hash (full layout), or its filtrate fields in the hash of its
+#   line bucket (lean layout)
+# - the duplex reference, in the set of duplexes sharing the same target
+# - the target reference, in the set of targets
+#
+def cache_duplex(pipe, namespace, layout, target_hash, line_number):
+    """
+    Queues in the given redis pipeline all commands caching the provided
+    duplex hash, read from the given line number.
+    """
 
-        in_file = ns_file
+    duplex = str(
+        namespace +
+        ":duplex:line" +
+        str(line_number)
+    )
 
+    target = str(
+        namespace +
+        ":target:" +
+        target_hash[TRANSCRIPT_ID]
+    )
 
-    # input namespace
-    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    target_duplexes = str(
+        namespace +
+        ":target:" +
+        target_hash[TRANSCRIPT_ID] +
+        ":duplexes"
+    )
 
-    logger.info("  Reading putative triplexes from microrna.org file \"%s\" ...", in_file)
-    logger.info("  Namespace \"%s\"", namespace)
+    # cache the dictionary representation of the current duplex in a redis
+    # hash, or only its filtrate fields in the hash of its line bucket
+    if layout == LAYOUT_LEAN:
+        bucket, field = get_bucket(duplex)
+        pipe.hset(bucket, field, CHAR_FIELD_SEPARATOR.join(
+            target_hash[x] for x in LAYOUT_FIELDS))
+    else:
+        pipe.hset(duplex, mapping=target_hash)
+    logger.debug(
+        "      Cached key-value pair duplex %s with attributes from line %d",
+        duplex, line_number
+    )
 
+    # cache the redis hash reference in a redis set of duplexes sharing the
+    # same target
+    pipe.sadd(target_duplexes, duplex)
+    logger.debug(
+        "      Cached duplex id %s as relative to target %s",
+        duplex, target
+    )
 
-    # each line represents a duplex, holding a target id, a miRNA id, and all
-    # attributes related to the complex.
-    # Multiple lines can refer to the same target.
-    # Store each duplex in a target-specific redis set.
+    # cache the target in a redis set
+    pipe.sadd(str(namespace + ":targets"), target)
+    logger.debug("      Cached target id %s", target)
 
-    with open(in_file, 'r') as in_file:
 
-        # setup a redis set to contain all duplex's targets
-        targets = str(namespace + ":targets")
 
-        for line in in_file:
+# return the hash (and field within it) holding the given duplex in the lean
+# layout. Each hash holds the duplexes of LAYOUT_BUCKET consecutive lines
+#
+def get_bucket(duplex):
+    """
+    Returns the lean layout bucket and field of the given duplex id.
+    """
 
-            count_lines += 1
+    namespace, line_number = duplex.rsplit(":duplex:line", 1)
 
-            if not line.startswith(CHAR_HEADING):
+    bucket = str(
+        namespace +
+        ":duplexes:bucket" +
+        str(int(line_number) // LAYOUT_BUCKET)
+    )
 
-                count_duplexes += 1
+    return bucket, line_number
 
-                # create a redis hash to hold all attributes of the current
-                # duplex line.
-                # Each redis hash represents a duplex.
-                # Multiple duplexes can be relative to a same target.
-                logger.debug("    Reading duplex on line %d",
-                    count_lines)
 
-                target_hash = get_hash(line)
 
-                duplex = str(
-                    namespace +
-                    ":duplex:line" +
-                    str(count_lines)
-                )
+# return the input file line number of the given duplex id
+#
+def get_line_number(duplex):
+    """
+    Returns the line number of the given duplex id.
+    """
 
-                target = str(
-                    namespace +
-                    ":target:" +
-                    target_hash[TRANSCRIPT_ID]
-                )
+    return int(duplex.rsplit(":duplex:line", 1)[1])
 
-                target_duplexes = str(
-                    namespace +
-                    ":target:" +
-                    target_hash[TRANSCRIPT_ID] +
-                    ":duplexes"
-                )
 
-                # cache
-                try:
-                    # cache the dictionary representation of the current duplex
-                    # in a redis hash
-                    cache.hmset(duplex, target_hash)
-                    logger.debug(
-                        "      Cached key-value pair duplex %s with attributes from line %d",
-                        duplex, count_lines
-                    )
 
-                    # cache the redis hash reference in a redis set of duplexes
-                    # sharing the same target
-                    cache.sadd(target_duplexes, duplex)
-                    logger.debug(
-                        "      Cached duplex id %s as relative to target %s",
-                        duplex, target
-                    )
+# return the cache layout of the duplexes of the given namespace
+#
+def get_layout(cache, namespace):
+    """
+    Returns the cache layout recorded by the read operation of the given
+    namespace.
+    """
 
-                    # cache the target in a redis set
-                    cache.sadd(targets, target)
-                    logger.debug("      Cached target id %s", target)
+    return cache.hget(str(namespace + ":layout"), OPT_LAYOUT) or LAYOUT_FULL
 
-                except redis.ConnectionError:
-                    logger.error("    Redis cache not running. Exiting")
-                    sys.exit(1)
 
 
-                # in a late processing step, "workers" will take each target,
-                # and compare each hash with each others to spot for miRNA
-                # binding in close proximity.
-                # The comparison problem will be quadratic.
+# send all commands queued in the given redis pipeline to the cache
+#
+def flush(pipe):
+    """
+    Executes all commands queued in the given redis pipeline.
+    """
 
-    in_file.close()
+    try:
+        pipe.execute()
 
-    logger.info(
-        "  Found %s RNA duplexes across %s target genes",
-        str(count_duplexes), str(cache.scard(targets))
-    )
+    except redis.ConnectionError:
+        logger.error("    Redis cache not running. Exiting")
+        sys.exit(1)
 
 
 
@@ -384,24 +1655,116 @@ def filtrate(cache, options):
 
     logger.info("  Finding allowed duplex-pair comparisons among each target's duplex ...")
 
+    # caching namespace
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+
+    # targets claimed by an interrupted run are compared again
+    queues.recover(cache, str(namespace + ":targets"))
+
+    # the target genes found now are crawled again by annotate, including
+    # those completed by an earlier run
+    queues.reset(cache, str(namespace + ":target" + ":genes"))
+
+    # the vectorized engine compares all targets at once, in this process. It
+    # does not claim the units scheduled by an interrupted run (whose targets
+    # are no longer pending), which must be resumed with their engine
+    if options[OPT_ENGINE] == ENGINE_NUMPY:
+        queue = scheduler.get_key(namespace)
+        queues.recover(cache, queue, ordered=True)
+        if cache.llen(queue):
+            logger.error("Engine \"%s\" cannot resume the %d units scheduled by an interrupted run. Exiting",
+                ENGINE_NUMPY, cache.llen(queue))
+            sys.exit(2)
+        generate_allowed_comparisons_vectorized(cache, options)
+        return
+
+    # the lua engine compares the duplexes of each target within redis
+    if options[OPT_ENGINE] == ENGINE_LUA and not storage.is_redis(cache):
+        logger.error("Engine \"%s\" requires a redis cache. Exiting",
+            ENGINE_LUA)
+        sys.exit(2)
+
+    # processes of this host, and of the workers on other hosts (see jobs)
+    processes = int(options[OPT_EXE])
+    if options.get(OPT_PUBLISH):
+        processes += jobs.get_capacity(cache)
+
+    # schedule the targets largest first (see scheduler)
+    scheduled = options[OPT_SCHEDULE] == SCHEDULE_COST
+    if scheduled:
+        scheduler.schedule(cache, namespace, processes, int(options[OPT_BATCH]))
+
+    # let the workers on other hosts compare the targets too
+    job = None
+    if options.get(OPT_PUBLISH):
+        job = jobs.publish(cache, options, OPT_FILTRATE,
+            scheduler.get_key(namespace) if scheduled else str(namespace + ":targets"),
+            scheduled)
+
+    time_start = time.time()
+
+    busy = compare_targets(cache, options, job)
+
+    time_elapsed = time.time() - time_start
+
+    # merge the duplex pairs of the targets split across workers
+    if options[OPT_SCHEDULE] == SCHEDULE_COST and options[OPT_PAIRS] != PAIRS_LIST:
+        scheduler.merge(cache, namespace)
+
+    # the tail of the run is the time the least busy worker spent idle
+    logger.info(
+        "  Compared duplexes in %.2f seconds. Workers busy for %.2f seconds at most, %.2f seconds at least (%.0f%% busy on average)",
+        time_elapsed, max(busy, default=0), min(busy, default=0),
+        100 * sum(busy) / (len(busy) * time_elapsed) if busy and time_elapsed > 0 else 0
+    )
+
+
+
+# compare the duplexes of the targets (or units of targets) of the queue of
+# the given namespace, with as many processes as number of given cores, until
+# the queue is drained. Return the seconds spent by each process comparing
+# duplexes. This is the part of filtrate run by the workers of a published
+# job (see jobs)
+#
+def compare_targets(cache, options, job=None):
+    """
+    Compares the duplexes of the claimed targets, until none is left, and
+    returns the busy time of each process.
+    """
+
+    # the lua engine compares the duplexes of each target within redis
+    worker = generate_allowed_comparisons
+    if options[OPT_ENGINE] == ENGINE_LUA:
+        worker = generate_allowed_comparisons_lua
+
+    # seconds spent by each worker comparing duplexes
+    busy = Array("d", int(options[OPT_EXE]))
+
     # generate all comparison jobs in parallel, assigning the same job to as
     # many processes as number of given cores
     procs = [
         Process(
-            target=generate_allowed_comparisons,
-            args=(cache, options, x)
+            target=profiler.profile(worker),
+            args=(cache, options, x, busy)
         ) for x in range(int(options[OPT_EXE]))
     ]
     [p.start() for p in procs]
+
+    # wait for the workers of the published job
+    if job is not None:
+        jobs.monitor(cache, job, procs)
+
     [p.join() for p in procs]
     [p.close() for p in procs]
 
+    return list(busy)
+
 
 
 # generate the allowed duplex-pair comparison list
 # TODO: this function must be source-agnostic, i.e. comparisons should be made
 # regardless the data is from microrna.org, TargetScan, etc.
-def generate_allowed_comparisons(cache, options, core):
+def generate_allowed_comparisons(cache, options, core, busy=None):
     """
     Takes each target gene's cached duplex, and compares them all to spot
     duplexes whose miRNA binds the mutual target within the seed binding range
@@ -413,98 +1776,121 @@ def generate_allowed_comparisons(cache, options, core):
     # caching namespace
     namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
 
+    # duplex-pair comparison engine
+    duplex_pairs_within_range = comparison_engines[options[OPT_ENGINE]]
+
+    # cache layout of the duplexes
+    layout = get_layout(cache, namespace)
+
+    # queue of the targets, or of their scheduled units (see scheduler),
+    # claimed in adaptive chunks
+    scheduled = options[OPT_SCHEDULE] == SCHEDULE_COST
+    queue = scheduler.get_key(namespace) if scheduled else str(namespace + ":targets")
+    chunk = queues.Chunk(int(options[OPT_BATCH]))
+
     # per-worker summary statistics
     statistics_targets = 0
     statistics_targets_with_duplex_pairs_within_range = 0
     statistics_duplex_pairs = 0
     statistics_duplex_pairs_binding_within_range = 0
     statistics_genes   = 0
+    statistics_round_trips = 0
+    statistics_round_trips_max = 0
+    statistics_claims = 0
+    statistics_time_claim = 0
+    statistics_time_process = 0
+    statistics_time_flush = 0
 
     # work until there are available targets :)
     while True:
 
-        # get the next available target, and create all duplex-pairs from its
-        # associated duplex set. Regardless of the miRNA IDs (the same miRNA
-        # can in fact bind the same target at different positions), test
-        # whether the miRNA binding distance is within the range outlined by
-        # Saetrom et al. (2007)
-
-        target = cache.spop( (namespace + str(":targets")) )
+        # get the next available chunk of targets (or units of targets), and
+        # find all duplex-pairs from the associated duplex set of each target
+        # whose miRNA binding distance is within the range outlined by
+        # Saetrom et al. (2007), regardless of the miRNA IDs (the same miRNA
+        # can in fact bind the same target at different positions)
 
-        # (popped targets will be cached in another set to allow further
+        # (claimed targets will be cached in another set to allow further
         # operations, or ignored in case they do not form any allowed RNA
-        # triplex)
+        # triplex. Either way, they are acknowledged along with the results)
+        round_trips = storage.round_trips
 
-        if target:
+        time_claim = time.time()
+        units = queues.claim(cache, queue, chunk.size, ordered=scheduled)
+        statistics_time_claim += time.time() - time_claim
 
-            statistics_targets += 1
+        if not units and queues.wait(cache, queue):
+            continue
 
-            logger.debug(
-                "    Worker %d: Computing allowed triplexes for target %s",
-                core, target)
+        if units:
 
-            # compute all possible duplex-pairs
+            time_process = time.time()
+            statistics_claims += 1
 
-            target_duplexes = cache.smembers( (target + ":duplexes"))
+            items = [
+                item
+                for unit in units
+                for item in (scheduler.get_items(unit) if scheduled else [(unit, None, None)])
+            ]
 
-            logger.debug(
-                "    Worker %d:   Target found in %d duplexes",
-                core, len(target_duplexes)
-            )
+            # get the duplexes of all targets of the chunk, and then the
+            # miRNA-target binding start position and the target gene of each
+            # duplex, in two round trips
+            pipe = cache.pipeline(transaction=False)
 
-            duplex_pairs = list(
-                itertools.combinations(target_duplexes, 2)
-            )
+            targets = list(dict.fromkeys(target for target, first, last in items))
+            for target in targets:
+                pipe.smembers(target + ":duplexes")
 
-            # keep a record
-            statistics_duplex_pairs += len(duplex_pairs)
+            targets_duplexes = dict(zip(targets, pipe.execute()))
 
-            duplex_pairs_binding_within_range = 0
+            duplex_fields = get_duplex_fields(cache, [
+                duplex
+                for target_duplexes in targets_duplexes.values()
+                for duplex in target_duplexes
+            ], [ALIGNMENT_GENE_START, TRANSCRIPT_ID_EXT], layout)
 
-            logger.debug(
-                "    Worker %d:   Target %s has %d duplex pairs",
-                core, target, len(duplex_pairs)
-            )
+            # cache all allowed duplex-pair comparisons of the chunk, and
+            # acknowledge its targets, in one round trip
+            pipe = cache.pipeline(transaction=False)
 
-            for duplex_pair in duplex_pairs:
+            for target, first, last in items:
 
-                # get the miRNA-target binding start position for duplex1
-                duplex1 = duplex_pair[0]
-                duplex1_alignment_start = int(
-                    cache.hget(duplex1, ALIGNMENT_GENE_START)
-                )
-                #logger.debug(
-                #    "    Worker %d:     Duplex %s aligns at %s",
-                #    core, duplex1, duplex1_alignment_start
-                #)
-
-                # get the miRNA-target binding start position for duplex2
-                duplex2 = duplex_pair[1]
-                duplex2_alignment_start = int(
-                    cache.hget(duplex2, ALIGNMENT_GENE_START)
+                # ranges of a split target count as one target
+                statistics_targets += not first
+
+                logger.debug(
+                    "    Worker %d: Computing allowed triplexes for target %s",
+                    core, scheduler.get_item(target, first, last))
+
+                target_duplexes = targets_duplexes[target]
+
+                logger.debug(
+                    "    Worker %d:   Target found in %d duplexes",
+                    core, len(target_duplexes)
                 )
-                #logger.debug(
-                #    "    Worker %d:     Duplex %s aligns at %s",
-                #    core, duplex2, duplex2_alignment_start
-                #)
-
-                # compute the binding distance
-                binding = abs(
-                    duplex1_alignment_start - duplex2_alignment_start
+
+                duplex_starts = [
+                    (duplex, int(duplex_fields[duplex][0]))
+                    for duplex in target_duplexes
+                ]
+
+                # keep a record of the number of duplex pairs
+                duplex_pairs = scheduler.get_pairs(len(duplex_starts),
+                    first or 0, last)
+                statistics_duplex_pairs += duplex_pairs
+
+                duplex_pairs_binding_within_range = []
+                duplex_pairs_lines = ([], [], [])
+                target_genes = set()
+
+                logger.debug(
+                    "    Worker %d:   Target %s has %d duplex pairs",
+                    core, target, duplex_pairs
                 )
-                #logger.debug(
-                #    "    Worker %d:     Duplex binding range is %s",
-                #    core, binding
-                #)
-
-                # putative triplexes have their miRNAs binding a mutual target
-                # gene within 13-35 seed distance range (Saetrom et al. 2007).
-                # Before proper statistical validation, a candidate triplex
-                # conserves this experimentally validated property.
-                # ==> Test whether the binding distance is within the allowed
-                #     distance range, and if so, keep the duplex-pair
-                #     comparison
-                if (SEED_MAX_DISTANCE >= binding) and (binding >= SEED_MIN_DISTANCE):
+
+                for duplex1, duplex2, binding in duplex_pairs_within_range(
+                        duplex_starts, first or 0, last):
 
                     logger.debug(
                         "    Worker %d:   Target %s duplex pair :%s and :%s bind within the allowed range (%d >= %d >= %d). Duplex pair kept",
@@ -514,22 +1900,15 @@ def generate_allowed_comparisons(cache, options, core):
                         SEED_MAX_DISTANCE, binding, SEED_MIN_DISTANCE
                     )
 
-                    # cache the duplex pairs whose seed site distance is within
+                    # keep the duplex pairs whose seed site distance is within
                     # the allowed range
-                    cache.lpush(
-                        (target + ":with_mirna_pair_in_allowed_binding_range"),
-                        duplex1
-                    )
-                    cache.lpush(
-                        (target + ":with_mirna_pair_in_allowed_binding_range"),
-                        duplex2
-                    )
-
-                    # keep a record of the number of binding-within-range
-                    # duplex pairs
-                    duplex_pairs_binding_within_range += 1
-                    statistics_duplex_pairs_binding_within_range += 1
+                    duplex_pairs_binding_within_range += [duplex1, duplex2]
 
+                    # keep the line numbers and binding distance of the duplex
+                    # pairs, for the packed pair store
+                    duplex_pairs_lines[0].append(get_line_number(duplex1))
+                    duplex_pairs_lines[1].append(get_line_number(duplex2))
+                    duplex_pairs_lines[2].append(binding)
 
                     # NOTE that cached targets refers to gene *transcripts*,
                     # which can in turn putatively bind with cooperating miRNA
@@ -546,47 +1925,785 @@ def generate_allowed_comparisons(cache, options, core):
                     #     RefSeq ID to retrieve the original genomic sequence,
                     #     and transcript sequence at specified nt. ranges.
 
-                    target_genes = str(namespace + ":target" + ":genes")
-                    target_gene  = cache.hget(duplex1, TRANSCRIPT_ID_EXT)
-                    cache.sadd(target_genes, target_gene)
-                    logger.debug("    Worker %d:   caching Target gene %s",
-                        core, target_gene)
+                    target_genes.add(duplex_fields[duplex1][1])
+
+                # keep a record of the number of binding-within-range duplex
+                # pairs
+                statistics_duplex_pairs_binding_within_range += len(duplex_pairs_binding_within_range) // 2
+
+                logger.debug(
+                    "    Worker %d:   Target %s found in %d duplex pairs, of which %d comply with the allowed binding range constraint",
+                    core, target, duplex_pairs,
+                    len(duplex_pairs_binding_within_range) // 2
+                )
+
+                # ranges of a split target count as one target with duplex
+                # pairs within range, that of its first range, which also
+                # looks for a pair past its own range
+                if not first and (duplex_pairs_binding_within_range or (last is not None
+                        and next(duplex_pairs_by_sweep(duplex_starts, last), None))):
+                    statistics_targets_with_duplex_pairs_within_range += 1
+
+                if duplex_pairs_binding_within_range:
+
+                    # cache the duplex pairs whose seed site distance is
+                    # within the allowed range. The packed pairs of the ranges
+                    # of a split target are merged once all are compared
+                    if options[OPT_PAIRS] != PAIRS_PACKED:
+                        pipe.lpush(
+                            (target + ":with_mirna_pair_in_allowed_binding_range"),
+                            *duplex_pairs_binding_within_range
+                        )
+                    if options[OPT_PAIRS] != PAIRS_LIST:
+                        if first is None:
+                            pipe.hset(pairstore.get_key(namespace), target,
+                                pairstore.pack(*duplex_pairs_lines))
+                        else:
+                            pipe.hset(scheduler.get_parts_key(namespace),
+                                scheduler.get_item(target, first, last),
+                                pairstore.pack(*duplex_pairs_lines))
+
+                    # cache the target genes
+                    pipe.sadd(str(namespace + ":target" + ":genes"), *target_genes)
+                    logger.debug("    Worker %d:   caching Target genes %s",
+                        core, ", ".join(target_genes))
+
+                    # cache the popped target in a set of allowed seed
+                    # binding range targets
+                    pipe.sadd((namespace + ":targets:with_mirna_pair_in_allowed_binding_range"), target)
 
-                else:
                     logger.debug(
-                        "    Worker %d:   Target %s duplex pair :%s and :%s bind outside the allowed range. Duplex pair discarded",
-                        core, target,
-                        duplex1.split(SEPARATOR)[-1],
-                        duplex2.split(SEPARATOR)[-1]
+                        "    Worker %d:   Target %s cached",
+                        core, target
                     )
 
+            time_flush = time.time()
+            statistics_time_process += time_flush - time_process
 
-            logger.debug(
-                "    Worker %d:   Target %s found in %d duplex pairs, of which %d comply with the allowed binding range constraint",
-                core, target, len(duplex_pairs),
-                duplex_pairs_binding_within_range
-            )
+            queues.ack(pipe, queue, units)
+            flush(pipe)
 
-            # cache all allowed duplex-pair comparisons
-            if duplex_pairs_binding_within_range > 0:
-                statistics_targets_with_duplex_pairs_within_range += 1
+            statistics_time_flush += time.time() - time_flush
 
-                # cache the popped target in a set of allowed seed
-                # binding range targets
-                cache.sadd((namespace + ":targets:with_mirna_pair_in_allowed_binding_range"), target)
+            # size the next chunk after the processing time of this one
+            chunk.update(len(units), time.time() - time_process)
 
-                logger.debug(
-                    "    Worker %d:   Target %s cached",
-                    core, target
-                )
+            # keep a record of the number of cache round trips
+            round_trips = storage.round_trips - round_trips
+            statistics_round_trips += round_trips
+            statistics_round_trips_max = max(statistics_round_trips_max, round_trips)
 
         else:
             break
 
+    metrics.count("filtrate_targets", statistics_targets)
+    metrics.count("filtrate_targets_within_range",
+        statistics_targets_with_duplex_pairs_within_range)
+    metrics.count("filtrate_pairs", statistics_duplex_pairs)
+    metrics.count("filtrate_pairs_within_range",
+        statistics_duplex_pairs_binding_within_range)
+    metrics.save(cache)
+
+    if busy is not None:
+        busy[core] = statistics_time_process + statistics_time_flush
+
+    logger.info(
+        "  Worker %d: Examined %d targets and %d duplex pairs. Found %d targets with miRNA pairs binding within range, and %d putatively cooperating miRNA pairs",
+        core, statistics_targets, statistics_duplex_pairs,
+        statistics_targets_with_duplex_pairs_within_range,
+        statistics_duplex_pairs_binding_within_range
+    )
+    logger.info(
+        "  Worker %d: Performed %.2f cache round trips per target (%d at most per claim)",
+        core, statistics_round_trips / max(statistics_targets, 1),
+        statistics_round_trips_max
+    )
+    logger.info(
+        "  Worker %d: Claimed %d chunks (%d items at last) in %.2f seconds, processed them in %.2f seconds, and flushed them in %.2f seconds",
+        core, statistics_claims, chunk.size, statistics_time_claim,
+        statistics_time_process, statistics_time_flush
+    )
+
+
+
+# generate the allowed duplex-pair comparison list within redis.
+# Pop targets in batches, and let a server-side lua script compare the
+# duplexes of each target and cache the allowed duplex pairs. Only target ids
+# and summary statistics travel between this worker and redis
+# TODO: this function must be source-agnostic, i.e. comparisons should be made
+# regardless the data is from microrna.org, TargetScan, etc.
+def generate_allowed_comparisons_lua(cache, options, core, busy=None):
+    """
+    Takes batches of targets, and lets redis compare their cached duplexes to
+    spot duplexes whose miRNA binds the mutual target within the seed binding
+    range outlined by Saetrom et al. (2007), using a server-side lua script.
+    Duplex pairs that conserve this constraint are cached within redis, as
+    generate_allowed_comparisons does.
+    """
+
+    # caching namespace
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    batch = int(options[OPT_BATCH])
+
+    # cache layout of the duplexes
+    layout = get_layout(cache, namespace)
+
+    # register the comparison script (EVALSHA, or EVAL when the script is not
+    # cached by redis yet)
+    compare = cache.register_script(LUA_ALLOWED_COMPARISONS)
+
+    # queue of the targets, or of their scheduled units (see scheduler),
+    # claimed in adaptive chunks
+    scheduled = options[OPT_SCHEDULE] == SCHEDULE_COST
+    queue = scheduler.get_key(namespace) if scheduled else str(namespace + ":targets")
+    chunk = queues.Chunk(batch)
+
+    # per-worker summary statistics
+    statistics_targets = 0
+    statistics_targets_with_duplex_pairs_within_range = 0
+    statistics_duplex_pairs = 0
+    statistics_duplex_pairs_binding_within_range = 0
+    statistics_claims = 0
+    statistics_time_claim = 0
+    statistics_time_process = 0
+    statistics_time_flush = 0
+
+    # work until there are available targets :)
+    while True:
+
+        time_claim = time.time()
+        units = queues.claim(cache, queue, chunk.size, ordered=scheduled)
+        statistics_time_claim += time.time() - time_claim
+
+        if not units:
+            if queues.wait(cache, queue):
+                continue
+            break
+
+        time_process = time.time()
+        statistics_claims += 1
+
+        items = [
+            item
+            for unit in units
+            for item in (scheduler.get_items(unit) if scheduled else [(unit, None, None)])
+        ]
+
+        logger.debug(
+            "    Worker %d: Computing allowed triplexes for %d targets",
+            core, len(items))
+
+        try:
+            statistics = compare(
+                keys=[target for target, first, last in items],
+                args=[
+                    str(namespace + ":target" + ":genes"),
+                    str(namespace + ":targets:with_mirna_pair_in_allowed_binding_range"),
+                    SEED_MIN_DISTANCE,
+                    SEED_MAX_DISTANCE,
+                    layout,
+                    LAYOUT_BUCKET,
+                    pairstore.get_key(namespace),
+                    pairstore.PAIRS_FORMAT,
+                    options[OPT_PAIRS],
+                    scheduler.get_parts_key(namespace)
+                ] + [
+                    "" if first is None else str(first) + " " + str(last)
+                    for target, first, last in items
+                ]
+            )
+
+        except redis.ConnectionError:
+            logger.error("    Redis cache not running. Exiting")
+            sys.exit(1)
+
+        time_flush = time.time()
+        statistics_time_process += time_flush - time_process
+
+        # acknowledge the targets (NOTE that targets compared by the script
+        # are claimed again if this worker dies before acknowledging them)
+        pipe = cache.pipeline(transaction=False)
+        queues.ack(pipe, queue, units)
+        flush(pipe)
+
+        statistics_time_flush += time.time() - time_flush
+
+        # size the next chunk after the processing time of this one
+        chunk.update(len(units), time.time() - time_process)
+
+        # ranges of a split target count as one target
+        statistics_targets += sum(1 for target, first, last in items if not first)
+        statistics_duplex_pairs += statistics[0]
+        statistics_targets_with_duplex_pairs_within_range += statistics[1]
+        statistics_duplex_pairs_binding_within_range += statistics[2]
+
+    metrics.count("filtrate_targets", statistics_targets)
+    metrics.count("filtrate_targets_within_range",
+        statistics_targets_with_duplex_pairs_within_range)
+    metrics.count("filtrate_pairs", statistics_duplex_pairs)
+    metrics.count("filtrate_pairs_within_range",
+        statistics_duplex_pairs_binding_within_range)
+    metrics.save(cache)
+
+    if busy is not None:
+        busy[core] = statistics_time_process + statistics_time_flush
+
     logger.info(
         "  Worker %d: Examined %d targets and %d duplex pairs. Found %d targets with miRNA pairs binding within range, and %d putatively cooperating miRNA pairs",
         core, statistics_targets, statistics_duplex_pairs,
         statistics_targets_with_duplex_pairs_within_range,
         statistics_duplex_pairs_binding_within_range
     )
+    logger.info(
+        "  Worker %d: Claimed %d chunks (%d items at last) in %.2f seconds, processed them in %.2f seconds, and flushed them in %.2f seconds",
+        core, statistics_claims, chunk.size, statistics_time_claim,
+        statistics_time_process, statistics_time_flush
+    )
+
+
+
+# server-side version of the sweep engine (see duplex_pairs_by_sweep).
+# For each target in KEYS, sort its duplexes by binding start position, sweep
+# the window of duplexes binding within the allowed range, and cache the
+# allowed duplex pairs, the target genes, and the targets, as
+# generate_allowed_comparisons does.
+# ARGV holds the target genes set, the allowed targets set, the minimum and
+# maximum seed distances, the cache layout and bucket size of the duplexes
+# (see get_duplex_fields), and the pair store, its record format, and the
+# duplex pair output (see pairstore), the hash of the packed duplex pairs of
+# the ranges of split targets, and the range of duplexes of each target in
+# KEYS ("FIRST LAST", or empty for the whole target, see scheduler). Duplexes
+# with the same binding start position are sorted by id. Return the number of
+# examined duplex pairs, and the number of targets and duplex pairs binding
+# within the allowed range.
+# NOTE that duplex hashes and sets are not declared in KEYS, as they are only
+# known once read within the script. This is allowed by standalone redis
+# instances, but not by redis clusters
+LUA_ALLOWED_COMPARISONS = """
+local target_genes = ARGV[1]
+local targets_within_range = ARGV[2]
+local min_distance = tonumber(ARGV[3])
+local max_distance = tonumber(ARGV[4])
+local lean = (ARGV[5] == "lean")
+local bucket_size = tonumber(ARGV[6])
+local pairs_key = ARGV[7]
+local pairs_format = ARGV[8]
+local pairs_list = (ARGV[9] ~= "packed")
+local pairs_packed = (ARGV[9] ~= "list")
+local parts_key = ARGV[10]
+
+local duplex_pairs = 0
+local duplex_pairs_within_range = 0
+local targets_with_duplex_pairs_within_range = 0
+
+-- return the binding start position and the target gene of the given duplex
+local function get_fields(duplex)
+    if lean then
+        local namespace, line = string.match(duplex, "^(.*):duplex:line(%d+)$")
+        local bucket = namespace .. ":duplexes:bucket" .. math.floor(tonumber(line) / bucket_size)
+        local start, gene = string.match(redis.call("HGET", bucket, line), "^([^\t]*)\t(.*)$")
+        return tonumber(start), gene
+    end
+    local fields = redis.call("HMGET", duplex, "gene_start", "ext_transcript_id")
+    return tonumber(fields[1]), fields[2]
+end
+
+-- push the given values in chunks, to respect the lua stack size
+local function push(command, key, values)
+    for i = 1, #values, 1000 do
+        redis.call(command, key, unpack(values, i, math.min(i + 999, #values)))
+    end
+end
+
+for k, target in ipairs(KEYS) do
+
+    local duplexes = redis.call("SMEMBERS", target .. ":duplexes")
+
+    local sites = {}
+    for i, duplex in ipairs(duplexes) do
+        local start, gene = get_fields(duplex)
+        local line = tonumber(string.match(duplex, ":duplex:line(%d+)$"))
+        sites[i] = {duplex, start, gene, line}
+    end
+
+    table.sort(sites, function(a, b)
+        if a[2] ~= b[2] then return a[2] < b[2] end
+        return a[1] < b[1]
+    end)
+
+    local n = #sites
+
+    -- range of the first duplex of each pair
+    local range_first, range_last = string.match(ARGV[10 + k] or "", "^(%d+) (%d+)$")
+    range_first = tonumber(range_first) or 0
+    range_last = tonumber(range_last) or n
+
+    for i = range_first + 1, range_last do
+        duplex_pairs = duplex_pairs + n - i
+    end
+
+    local kept = {}
+    local records = {}
+    local genes = {}
+    local first = 1
+
+    for i = range_first + 1, range_last do
+
+        -- the window start only moves forward, as duplexes are sorted
+        if first <= i then
+            first = i + 1
+        end
+        while first <= n and (sites[first][2] - sites[i][2]) < min_distance do
+            first = first + 1
+        end
+
+        local j = first
+        while j <= n and (sites[j][2] - sites[i][2]) <= max_distance do
+            kept[#kept + 1] = sites[i][1]
+            kept[#kept + 1] = sites[j][1]
+            records[#records + 1] = {
+                math.min(sites[i][4], sites[j][4]),
+                math.max(sites[i][4], sites[j][4]),
+                sites[j][2] - sites[i][2]
+            }
+            genes[sites[i][3]] = true
+            j = j + 1
+        end
+    end
+
+    if #kept > 0 then
+
+        if pairs_list then
+            push("LPUSH", target .. ":with_mirna_pair_in_allowed_binding_range", kept)
+        end
+
+        -- pack the sorted, unique records of the pair store
+        if pairs_packed then
+            table.sort(records, function(a, b)
+                if a[1] ~= b[1] then return a[1] < b[1] end
+                if a[2] ~= b[2] then return a[2] < b[2] end
+                return a[3] < b[3]
+            end)
+            local packed = {}
+            for k, record in ipairs(records) do
+                local previous = records[k - 1]
+                if not (previous and previous[1] == record[1]
+                        and previous[2] == record[2] and previous[3] == record[3]) then
+                    packed[#packed + 1] = struct.pack(pairs_format, record[1], record[2], record[3])
+                end
+            end
+            if ARGV[10 + k] ~= "" then
+                redis.call("HSET", parts_key,
+                    target .. "|" .. range_first .. "|" .. range_last, table.concat(packed))
+            else
+                redis.call("HSET", pairs_key, target, table.concat(packed))
+            end
+        end
+
+        local gene_list = {}
+        for gene in pairs(genes) do
+            gene_list[#gene_list + 1] = gene
+        end
+        push("SADD", target_genes, gene_list)
+
+        redis.call("SADD", targets_within_range, target)
+
+        duplex_pairs_within_range = duplex_pairs_within_range + #kept / 2
+    end
+
+    -- ranges of a split target count as one target with duplex pairs within
+    -- range, that of its first range, which also looks for a pair past its
+    -- own range
+    if range_first == 0 then
+        local found = #kept > 0
+        local i = range_last + 1
+        local j = 1
+        while not found and i <= n do
+            if j <= i then
+                j = i + 1
+            end
+            while j <= n and (sites[j][2] - sites[i][2]) < min_distance do
+                j = j + 1
+            end
+            found = j <= n and (sites[j][2] - sites[i][2]) <= max_distance
+            i = i + 1
+        end
+        if found then
+            targets_with_duplex_pairs_within_range = targets_with_duplex_pairs_within_range + 1
+        end
+    end
+end
+
+return {duplex_pairs, targets_with_duplex_pairs_within_range, duplex_pairs_within_range}
+"""
+
+
+
+# generate the allowed duplex-pair comparison list of all targets at once.
+# Load the target and binding start position of every duplex in columnar
+# arrays, sort them by target and binding start position, and find the
+# allowed duplex pairs of all targets with vectorized operations
+# TODO: this function must be source-agnostic, i.e. comparisons should be made
+# regardless the data is from microrna.org, TargetScan, etc.
+def generate_allowed_comparisons_vectorized(cache, options):
+    """
+    Takes all cached duplexes, and finds the duplex pairs whose miRNAs bind
+    a mutual target within the seed binding range outlined by Saetrom et al.
+    (2007), using vectorized NumPy operations over the whole namespace.
+    Duplex pairs that conserve this constraint are then cached for later
+    statistical validation, as generate_allowed_comparisons does.
+    """
+
+    # caching namespace
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+    batch = int(options[OPT_BATCH])
+
+    time_start = time.time()
+
+    # load all targets, and the target, binding start position, and target
+    # gene of all their duplexes. Use the snapshot of the input file when
+    # available, rather than the cache
+    # targets completed by an interrupted run are skipped
+    targets = sorted(
+        cache.smembers( (namespace + str(":targets")) ) -
+        cache.smembers(queues.get_keys(namespace + str(":targets"))[1]))
+
+    snap = get_snapshot(options)
+
+    if snap:
+        logger.info("  Using snapshot %s", snap.path)
+        duplex_targets, duplex_starts, duplex_genes, duplexes = \
+            load_duplexes_from_snapshot(snap, namespace, targets)
+    else:
+        duplex_targets, duplex_starts, duplex_genes, duplexes = \
+            load_duplexes_from_cache(cache, targets, batch,
+                get_layout(cache, namespace))
+
+    duplexes_per_target = numpy.bincount(duplex_targets, minlength=len(targets))
+
+    duplex_lines = numpy.array(
+        [get_line_number(duplex) for duplex in duplexes], dtype=numpy.int64)
+
+    # columnar representation of all duplexes, sorted by target and binding
+    # start position
+    order = numpy.lexsort((duplex_starts, duplex_targets))
+    duplex_targets = duplex_targets[order]
+    duplex_starts  = duplex_starts[order]
+    duplex_genes   = duplex_genes[order]
+    duplexes       = duplexes[order]
+    duplex_lines   = duplex_lines[order]
+
+    time_loaded = time.time()
+
+    # combine target and binding start position in one sorted key, so that
+    # binding windows never span over two targets. For each duplex, the window
+    # of the following duplexes binding within the allowed range is then found
+    # with a binary search
+    keys = (duplex_targets << 32) | duplex_starts
+
+    first = numpy.searchsorted(keys, keys + SEED_MIN_DISTANCE, side="left")
+    last  = numpy.searchsorted(keys, keys + SEED_MAX_DISTANCE, side="right")
+    windows = last - first
+
+    # expand each window into its duplex pairs
+    pairs_left = numpy.repeat(numpy.arange(len(keys)), windows)
+    pairs_right = (
+        numpy.arange(windows.sum())
+        - numpy.repeat(numpy.cumsum(windows) - windows, windows)
+        + numpy.repeat(first, windows)
+    )
+    pairs_targets = duplex_targets[pairs_left]
+
+    time_compared = time.time()
+
+    # cache all allowed duplex-pair comparisons of each target, as well as the
+    # target genes, and the targets
+    pairs_targets_unique, pairs_targets_first = numpy.unique(
+        pairs_targets, return_index=True)
+    pairs_targets_last = numpy.append(pairs_targets_first[1:], len(pairs_targets))
+
+    pipe = cache.pipeline(transaction=False)
+
+    for x, target_index in enumerate(pairs_targets_unique):
+
+        target = targets[target_index]
+        pairs = slice(pairs_targets_first[x], pairs_targets_last[x])
+
+        if options[OPT_PAIRS] != PAIRS_PACKED:
+            duplex_pairs_binding_within_range = numpy.empty(
+                2 * (pairs.stop - pairs.start), dtype=object)
+            duplex_pairs_binding_within_range[0::2] = duplexes[pairs_left[pairs]]
+            duplex_pairs_binding_within_range[1::2] = duplexes[pairs_right[pairs]]
+
+            pipe.lpush(
+                (target + ":with_mirna_pair_in_allowed_binding_range"),
+                *duplex_pairs_binding_within_range.tolist()
+            )
+        if options[OPT_PAIRS] != PAIRS_LIST:
+            pipe.hset(pairstore.get_key(namespace), target, pairstore.pack(
+                duplex_lines[pairs_left[pairs]],
+                duplex_lines[pairs_right[pairs]],
+                duplex_starts[pairs_right[pairs]] - duplex_starts[pairs_left[pairs]]))
+        pipe.sadd(str(namespace + ":target" + ":genes"),
+            *set(duplex_genes[pairs_left[pairs]].tolist()))
+        pipe.sadd((namespace + ":targets:with_mirna_pair_in_allowed_binding_range"), target)
+        queues.ack(pipe, str(namespace + ":targets"), [target])
+
+        if (x + 1) % batch == 0:
+            flush(pipe)
+
+    # all targets have been examined
+    pipe.delete( (namespace + str(":targets")) )
+    flush(pipe)
+
+    time_cached = time.time()
+
+    duplex_pairs = int((duplexes_per_target * (duplexes_per_target - 1) // 2).sum())
+
+    metrics.count("filtrate_targets", len(targets))
+    metrics.count("filtrate_targets_within_range", len(pairs_targets_unique))
+    metrics.count("filtrate_pairs", duplex_pairs)
+    metrics.count("filtrate_pairs_within_range", len(pairs_left))
+
+    logger.info(
+        "  Examined %d targets and %d duplex pairs. Found %d targets with miRNA pairs binding within range, and %d putatively cooperating miRNA pairs",
+        len(targets), duplex_pairs,
+        len(pairs_targets_unique), len(pairs_left)
+    )
+    logger.info(
+        "  Loaded %d duplexes in %.2f seconds, compared them in %.2f seconds, and cached the results in %.2f seconds",
+        len(duplexes), (time_loaded - time_start),
+        (time_compared - time_loaded), (time_cached - time_compared)
+    )
+
+
+
+# return the columnar representation of the duplexes of the given targets,
+# loaded from the cache (with the given layout): the index of each duplex's target (in the given
+# list), binding start position, target gene, and duplex id
+#
+def load_duplexes_from_cache(cache, targets, batch, layout):
+    """
+    Returns the target indexes, binding start positions, target genes, and
+    ids of all duplexes of the given targets, loaded from the cache.
+    """
+
+    target_duplexes = []
+
+    for x in range(0, len(targets), batch):
+        pipe = cache.pipeline(transaction=False)
+        for target in targets[x:(x + batch)]:
+            pipe.smembers( (target + ":duplexes") )
+        target_duplexes += [list(duplexes) for duplexes in pipe.execute()]
+
+    duplexes = [duplex for duplexes in target_duplexes for duplex in duplexes]
+
+    duplex_fields = []
+
+    for x in range(0, len(duplexes), batch):
+        duplex_fields += get_duplex_fields(cache, duplexes[x:(x + batch)],
+            [ALIGNMENT_GENE_START, TRANSCRIPT_ID_EXT], layout).values()
+
+    duplex_targets = numpy.repeat(
+        numpy.arange(len(targets), dtype=numpy.int64),
+        [len(duplexes) for duplexes in target_duplexes])
+    duplex_starts = numpy.array(
+        [int(fields[0]) for fields in duplex_fields], dtype=numpy.int64)
+    duplex_genes = numpy.array(
+        [fields[1] for fields in duplex_fields], dtype=object)
+
+    return (duplex_targets, duplex_starts, duplex_genes,
+        numpy.array(duplexes, dtype=object))
+
+
+
+# return the columnar representation of the duplexes of the given targets,
+# loaded from the snapshot of the input file: the index of each duplex's
+# target (in the given list), binding start position, target gene, and duplex
+# id
+#
+def load_duplexes_from_snapshot(snap, namespace, targets):
+    """
+    Returns the target indexes, binding start positions, target genes, and
+    ids of all duplexes of the given targets, loaded from the given snapshot.
+    """
+
+    # index of each distinct transcript's target, or -1 for transcripts whose
+    # target is not requested
+    index = {target: x for x, target in enumerate(targets)}
+
+    transcript_targets = numpy.array([
+        index.get(str(namespace + ":target:" + transcript.decode("utf-8")), -1)
+        for transcript in snap.array(TRANSCRIPT_ID + ".dict").tolist()
+    ], dtype=numpy.int64)
+
+    duplex_targets = transcript_targets[snap.array(TRANSCRIPT_ID)]
+    rows = numpy.flatnonzero(duplex_targets >= 0)
+
+    duplex_starts = numpy.asarray(
+        snap.integers(ALIGNMENT_GENE_START))[rows].astype(numpy.int64)
 
+    genes = snap.array(TRANSCRIPT_ID_EXT + ".dict")
+    duplex_genes = numpy.array([
+        gene.decode("utf-8")
+        for gene in genes[snap.array(TRANSCRIPT_ID_EXT)[rows]].tolist()
+    ], dtype=object)
+
+    duplexes = numpy.array([
+        str(namespace + ":duplex:line" + str(line))
+        for line in snap.lines()[rows].tolist()
+    ], dtype=object)
+
+    return duplex_targets[rows], duplex_starts, duplex_genes, duplexes
+
+
+
+# return the requested fields of each given duplex hash, in a single cache
+# round trip. With the lean layout, only LAYOUT_FIELDS can be requested
+#
+def get_duplex_fields(cache, duplexes, fields, layout=LAYOUT_FULL):
+    """
+    Returns a dictionary mapping each of the given duplexes to the list of
+    its requested field values, fetched in one pipelined round trip.
+    """
+
+    duplexes = list(duplexes)
+
+    pipe = cache.pipeline(transaction=False)
+
+    if layout == LAYOUT_LEAN:
+
+        for duplex in duplexes:
+            pipe.hget(*get_bucket(duplex))
+
+        columns = [LAYOUT_FIELDS.index(field) for field in fields]
+
+        return {
+            duplex: (
+                [values.split(CHAR_FIELD_SEPARATOR)[x] for x in columns]
+                if values is not None else [None] * len(fields)
+            )
+            for duplex, values in zip(duplexes, pipe.execute())
+        }
+
+    for duplex in duplexes:
+        pipe.hmget(duplex, fields)
+
+    return dict(zip(duplexes, pipe.execute()))
+
+
+
+# return the hash of each given duplex, with all its fields.
+# With the lean layout, fields which are not cached are read from the input
+# file, at the line offsets recorded by its snapshot
+#
+def get_duplex_hashes(cache, options, duplexes):
+    """
+    Returns a dictionary mapping each of the given duplexes to the dictionary
+    of all its fields.
+    """
+
+    namespace = NAMESPACES[options[OPT_NAMESPACE]][NS_LABEL]
+
+    duplexes = list(duplexes)
+
+    if get_layout(cache, namespace) != LAYOUT_LEAN:
+
+        pipe = cache.pipeline(transaction=False)
+
+        for duplex in duplexes:
+            pipe.hgetall(duplex)
+
+        return dict(zip(duplexes, pipe.execute()))
+
+    snap = get_snapshot(options)
+
+    if not snap:
+        logger.error("    No snapshot of the input file. Cannot read duplexes cached with the \"%s\" layout",
+            LAYOUT_LEAN)
+        sys.exit(1)
+
+    # snapshot rows are sorted by line number
+    rows = numpy.searchsorted(snap.lines(),
+        [get_line_number(duplex) for duplex in duplexes])
+    offsets = snap.offsets()[rows].tolist()
+
+    result = {}
+
+    # read the lines in file order
+    with open(get_input_path(options), 'rb') as src:
+        for offset, duplex in sorted(zip(offsets, duplexes)):
+            src.seek(offset)
+            result[duplex] = get_hash(src.readline().decode("utf-8"))
+
+    return result
+
+
+
+# putative triplexes have their miRNAs binding a mutual target gene within
+# 13-35 seed distance range (Saetrom et al. 2007). Before proper statistical
+# validation, a candidate triplex conserves this experimentally validated
+# property.
+# The following engines take a list of (duplex, binding start position) pairs
+# referring to the same target, and yield each (duplex1, duplex2, binding
+# distance) triple whose binding distance is within the allowed range.
+# Duplexes are sorted by binding start position (and id), and only the pairs
+# whose first duplex is within the given range of sorted duplexes are
+# compared, so that the ranges of a target can be compared independently (see
+# scheduler).
+
+
+
+# compare all duplex pairs (quadratic in the number of duplexes)
+#
+def duplex_pairs_by_combinations(duplex_starts, first=0, last=None):
+    """
+    Yields all duplex pairs whose binding distance is within the allowed
+    range, by testing every duplex pair.
+    """
+
+    duplex_starts = sorted(duplex_starts, key=lambda x: (x[1], x[0]))
+
+    for x, (duplex1, start1) in enumerate(duplex_starts[first:last], first):
+        for duplex2, start2 in duplex_starts[(x + 1):]:
+
+            # compute the binding distance
+            binding = abs(start1 - start2)
+
+            if (SEED_MAX_DISTANCE >= binding) and (binding >= SEED_MIN_DISTANCE):
+                yield duplex1, duplex2, binding
+
+
+
+# sort the duplexes by binding start position, and sweep a window over the
+# sorted duplexes: for each duplex, only the following duplexes binding
+# between SEED_MIN_DISTANCE and SEED_MAX_DISTANCE nt. downstream can pair
+# with it (linearithmic in the number of duplexes, plus the number of pairs
+# found)
+#
+def duplex_pairs_by_sweep(duplex_starts, first=0, last=None):
+    """
+    Yields all duplex pairs whose binding distance is within the allowed
+    range, by sweeping a window over the duplexes sorted by binding start
+    position.
+    """
+
+    duplex_starts = sorted(duplex_starts, key=lambda x: (x[1], x[0]))
+    starts = [start for duplex, start in duplex_starts]
+
+    for x, (duplex1, start1) in enumerate(duplex_starts[first:last], first):
+
+        # window of the duplexes binding within the allowed range
+        window_first = bisect.bisect_left(starts, start1 + SEED_MIN_DISTANCE, x + 1)
+        window_last  = bisect.bisect_right(starts, start1 + SEED_MAX_DISTANCE, window_first)
+
+        for duplex2, start2 in duplex_starts[window_first:window_last]:
+            yield duplex1, duplex2, (start2 - start1)
+
+
+
+# duplex-pair comparison engines
+comparison_engines = {
+    ENGINE_COMBINATIONS: duplex_pairs_by_combinations,
+    ENGINE_SWEEP:        duplex_pairs_by_sweep,
+}
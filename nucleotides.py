@@ -0,0 +1,251 @@
+#
+# module for managing packed nucleotide sequences
+#
+
+
+import numpy
+import struct
+from bisect import bisect_left, bisect_right
+
+
+
+# nucleotide sequences are packed with 2 bits per base (4 bases per byte, the
+# first base in the most significant bits, as in .2bit files). Bases other
+# than A, C, G, and T (e.g. N, or other IUPAC ambiguity codes) are packed as
+# A, and listed as runs of exceptions; soft-masked (lower case) bases are
+# listed as runs of masks.
+# A packed sequence is serialized as a header (length, number of exception
+# runs, number of mask runs), followed by the start, end, and base of each
+# exception run, the start and end of each mask run, and the packed bases
+PACKED_BASES  = b"ACGT"
+PACKED_HEADER = "<III"
+
+# complement of each IUPAC nucleotide code
+COMPLEMENT = bytes.maketrans(
+    b"ACGTURYSWKMBDHVNacgturyswkmbdhvn",
+    b"TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn")
+
+# transcription of DNA into RNA
+TRANSCRIPTION = bytes.maketrans(b"Tt", b"Uu")
+
+
+# 2-bit code of each (upper case) base, or 255 for exceptions
+codes = numpy.full(256, 255, dtype=numpy.uint8)
+codes[numpy.frombuffer(PACKED_BASES, dtype=numpy.uint8)] = numpy.arange(4, dtype=numpy.uint8)
+
+# bases of each byte of packed bases
+table = numpy.frombuffer(PACKED_BASES, dtype=numpy.uint8)[
+    numpy.stack([(numpy.arange(256) >> shift) & 3 for shift in (6, 4, 2, 0)], axis=1)]
+
+
+
+# return the (starts, ends) half-open runs of True values of the given boolean
+# array
+#
+def get_runs(values):
+    """
+    Returns the starts and ends of the runs of True values of the given array.
+    """
+
+    edges = numpy.flatnonzero(numpy.diff(
+        numpy.concatenate(([0], values.view(numpy.int8), [0]))))
+
+    return edges[0::2], edges[1::2]
+
+
+
+# nucleotide sequence packed with 2 bits per base.
+# A packed sequence is a view over packed bases, which can be shared by many
+# packed sequences: slicing, reverse-complementing, and transcribing a packed
+# sequence only return a new view, and only the bases of a view are unpacked
+# when it is read
+#
+class PackedSequence(object):
+    """
+    2-bit packed nucleotide sequence, supporting zero-copy slicing, reverse
+    complement, and transcription.
+    """
+
+    def __init__(self, data, size, exceptions, masks,
+            start=0, end=None, reverse=False, rna=False):
+        self.data = data
+        self.size = size
+        self.exceptions = exceptions
+        self.masks = masks
+
+        # range of the view over the packed bases, and its transformations
+        self.start = start
+        self.end = size if end is None else end
+        self.reverse = reverse
+        self.rna = rna
+
+    @classmethod
+    def pack(cls, sequence):
+        """
+        Returns the packed sequence of the given nucleotide sequence.
+        """
+
+        bases = numpy.frombuffer(str(sequence).encode("ascii"), dtype=numpy.uint8)
+
+        # soft-masked bases
+        lower = bases >= ord("a")
+        masks = get_runs(lower)
+
+        bases = numpy.where(lower, bases - 0x20, bases).astype(numpy.uint8)
+        bases_codes = codes[bases]
+
+        # runs of exceptions of the same base
+        invalid = bases_codes == 255
+        positions = numpy.flatnonzero(invalid)
+        breaks = numpy.flatnonzero(
+            (numpy.diff(positions) != 1) | (numpy.diff(bases[positions]) != 0)) + 1
+        starts = positions[numpy.concatenate(([0], breaks))] if len(positions) else positions
+        ends = positions[numpy.concatenate((breaks - 1, [len(positions) - 1]))] + 1 \
+            if len(positions) else positions
+        exceptions = (starts, ends, bases[starts].tobytes())
+
+        # 4 bases per byte
+        bases_codes[invalid] = 0
+        bases_codes = numpy.concatenate((bases_codes,
+            numpy.zeros(-len(bases_codes) % 4, dtype=numpy.uint8))).reshape(-1, 4)
+        data = ((bases_codes[:, 0] << 6) | (bases_codes[:, 1] << 4)
+            | (bases_codes[:, 2] << 2) | bases_codes[:, 3]).astype(numpy.uint8).tobytes()
+
+        return cls(data, len(bases), exceptions, masks)
+
+    @classmethod
+    def from_bytes(cls, value):
+        """
+        Returns the packed sequence of the given serialized representation,
+        without copying its packed bases.
+        """
+
+        value = memoryview(value)
+        size, exception_runs, mask_runs = struct.unpack_from(PACKED_HEADER, value)
+        position = struct.calcsize(PACKED_HEADER)
+
+        def read(count, dtype):
+            nonlocal position
+            values = numpy.frombuffer(value, dtype=dtype, count=count, offset=position)
+            position += values.nbytes
+            return values.astype(numpy.int64) if dtype != numpy.uint8 else values
+
+        exceptions = (read(exception_runs, "<u4"), read(exception_runs, "<u4"),
+            read(exception_runs, numpy.uint8).tobytes())
+        masks = (read(mask_runs, "<u4"), read(mask_runs, "<u4"))
+
+        return cls(value[position:], size, exceptions, masks)
+
+    def to_bytes(self):
+        """
+        Returns the serialized representation of the packed sequence.
+        """
+
+        # views are packed again, on their own
+        if (self.start, self.end, self.reverse, self.rna) != (0, self.size, False, False):
+            return PackedSequence.pack(str(self)).to_bytes()
+
+        starts, ends, bases = self.exceptions
+
+        return b"".join([
+            struct.pack(PACKED_HEADER, self.size, len(starts), len(self.masks[0])),
+            numpy.asarray(starts, dtype="<u4").tobytes(),
+            numpy.asarray(ends, dtype="<u4").tobytes(),
+            bases,
+            numpy.asarray(self.masks[0], dtype="<u4").tobytes(),
+            numpy.asarray(self.masks[1], dtype="<u4").tobytes(),
+            bytes(self.data)
+        ])
+
+    def view(self, start, end, reverse=None, rna=None):
+        """
+        Returns a view over the given range of the packed bases.
+        """
+        return PackedSequence(self.data, self.size, self.exceptions, self.masks,
+            start, end,
+            self.reverse if reverse is None else reverse,
+            self.rna if rna is None else rna)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+
+            # only contiguous slices are views
+            if step != 1:
+                return PackedSequence.pack(str(self)[key])
+
+            stop = max(start, stop)
+
+            if self.reverse:
+                return self.view(self.end - stop, self.end - start)
+            return self.view(self.start + start, self.start + stop)
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("packed sequence index out of range")
+
+        return str(self[key:(key + 1)])
+
+    def __str__(self):
+        return self.unpack(self.start, self.end).decode("ascii")
+
+    def __repr__(self):
+        return "PackedSequence(%r)" % str(self)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def reverse_complement(self):
+        """
+        Returns the reverse complement of the packed sequence (a view).
+        """
+        return self.view(self.start, self.end, reverse=not self.reverse)
+
+    def transcribe(self):
+        """
+        Returns the RNA transcript of the packed sequence (a view).
+        """
+        return self.view(self.start, self.end, rna=True)
+
+    def unpack(self, start, end):
+        """
+        Returns the bases of the given range of the packed bases, as seen
+        through the view.
+        """
+
+        if end <= start:
+            return b""
+
+        first = start // 4
+        last = (end + 3) // 4
+
+        bases = table[numpy.frombuffer(self.data, dtype=numpy.uint8,
+            count=(last - first), offset=first)].ravel()
+        bases = bases[(start - 4 * first):(end - 4 * first)].copy()
+
+        # exceptions, and soft-masked bases
+        starts, ends, exception_bases = self.exceptions
+        for run in range(bisect_right(ends, start), bisect_left(starts, end)):
+            bases[(max(starts[run], start) - start):(min(ends[run], end) - start)] = \
+                exception_bases[run]
+
+        starts, ends = self.masks
+        for run in range(bisect_right(ends, start), bisect_left(starts, end)):
+            section = slice(max(starts[run], start) - start, min(ends[run], end) - start)
+            bases[section] |= 0x20
+
+        result = bases.tobytes()
+
+        if self.reverse:
+            result = result.translate(COMPLEMENT)[::-1]
+        if self.rna:
+            result = result.translate(TRANSCRIPTION)
+
+        return result
@@ -0,0 +1,97 @@
+#
+# module for managing the store of duplex pairs binding within range
+#
+
+
+import numpy
+import storage
+from common import *
+
+
+
+# the duplex pairs of each target are stored as one binary value, in a hash
+# of the namespace mapping each target to its pairs. Each pair is packed as
+# a fixed-width record holding the line numbers of both duplexes (the lower
+# first) and their seed binding distance. Records are sorted, and unique
+PAIRS_KEY    = ":pairs"
+PAIRS_FORMAT = "<IIH"
+PAIRS_DTYPE  = numpy.dtype([
+    ("line1",    "<u4"),
+    ("line2",    "<u4"),
+    ("distance", "<u2")
+])
+
+
+
+# return the hash holding the duplex pairs of all targets of the given
+# namespace
+#
+def get_key(namespace):
+    """
+    Returns the key of the duplex pair store of the given namespace.
+    """
+
+    return str(namespace + PAIRS_KEY)
+
+
+
+# return the packed representation of the given duplex pairs, given as the
+# line numbers of the first and second duplex of each pair, and their seed
+# binding distance
+#
+def pack(lines1, lines2, distances):
+    """
+    Returns the sorted, unique, binary records of the given duplex pairs.
+    """
+
+    lines1 = numpy.asarray(lines1)
+    lines2 = numpy.asarray(lines2)
+
+    records = numpy.empty(len(lines1), dtype=PAIRS_DTYPE)
+    records["line1"] = numpy.minimum(lines1, lines2)
+    records["line2"] = numpy.maximum(lines1, lines2)
+    records["distance"] = distances
+
+    return numpy.unique(records).tobytes()
+
+
+
+# return the duplex pairs of the given packed representation
+#
+def unpack(value):
+    """
+    Returns the structured array (line1, line2, distance) of the given binary
+    records.
+    """
+
+    return numpy.frombuffer(value, dtype=PAIRS_DTYPE)
+
+
+
+# yield each target of the given namespace with duplex pairs binding within
+# range, and its pairs. Pairs are fetched in batches of targets, so that the
+# whole store is never held in memory
+#
+def read(cache, namespace, batch=1000):
+    """
+    Yields each target and the structured array (line1, line2, distance) of
+    its duplex pairs.
+    """
+
+    # packed records are not valid strings
+    # ==> read them with a client which does not decode responses
+    raw = storage.raw(cache)
+
+    targets = sorted(cache.smembers(
+        str(namespace + ":targets:with_mirna_pair_in_allowed_binding_range")))
+
+    for x in range(0, len(targets), batch):
+
+        pipe = raw.pipeline(transaction=False)
+
+        for target in targets[x:(x + batch)]:
+            pipe.hget(get_key(namespace), target)
+
+        for target, value in zip(targets[x:(x + batch)], pipe.execute()):
+            if value:
+                yield target, unpack(value)
@@ -0,0 +1,200 @@
+#
+# module for profiling the operations of a run, and their workers
+#
+
+
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import queues
+import resource
+import shutil
+import time
+from common import *
+from pathlib import Path
+
+
+
+# once enabled, each operation is profiled with cProfile in the process
+# launching it, and in each worker process it starts (see profile). The
+# statistics of each process are written to PROFILE_DIR/OPERATION under
+# FILE_PATH, one PROFILE_EXT file per process (see queues.get_worker), along
+# with the peak resident set size of the process (PROFILE_RSS_EXT file, in
+# KB). At the end of the operation, the statistics of all processes are
+# merged in PROFILE_DIR/OPERATION.PROFILE_EXT, with a report of the hottest
+# functions (by own time) and of the peak RSS of each process in
+# PROFILE_DIR/OPERATION.PROFILE_REPORT_EXT, and the PROFILE_TOP hottest
+# functions are logged.
+# NOTE that the threads of the asyncio annotate engine are not profiled
+PROFILE_DIR        = str(TRIPLEXER + ".profile")
+PROFILE_EXT        = ".pstats"
+PROFILE_RSS_EXT    = ".rss"
+PROFILE_REPORT_EXT = ".txt"
+PROFILE_SORT       = "tottime"
+PROFILE_TOP        = 15
+
+
+# logger
+logger = logging.getLogger("profiler")
+
+
+# profiling state of the current process: whether profiling is enabled (and
+# inherited by forked processes), the statistics directory of the running
+# operation, and the profile of the process launching it
+enabled = False
+directory = None
+profile_main = None
+
+
+
+# enable (or disable) the profiling of the operations of the current process
+#
+def enable(flag=True):
+    """
+    Enables or disables the profiling of the current process.
+    """
+
+    global enabled
+
+    enabled = flag
+
+
+
+# return the directory of the statistics of the given operation, or of all
+# operations
+#
+def get_path(operation=None):
+    """
+    Returns the directory of the profiling statistics of the given operation.
+    """
+
+    path = Path(FILE_PATH).joinpath(PROFILE_DIR)
+
+    return path.joinpath(operation) if operation else path
+
+
+
+# write the statistics of the given profile, and the peak resident set size
+# of the current process, to the directory of the running operation
+#
+def save(profile):
+    """
+    Writes the given profile and the peak RSS of the current process.
+    """
+
+    path = directory.joinpath(queues.get_worker())
+
+    profile.dump_stats(str(path) + PROFILE_EXT)
+
+    with open(str(path) + PROFILE_RSS_EXT, "w") as out:
+        out.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+
+# return the given process target, profiled if profiling is enabled
+#
+def profile(target):
+    """
+    Returns the given function, running under cProfile when profiling is
+    enabled.
+    """
+
+    if not enabled:
+        return target
+
+    @functools.wraps(target)
+    def profiled(*args, **kwargs):
+
+        # (replaces the profile inherited from the forking process)
+        worker_profile = cProfile.Profile()
+        worker_profile.enable()
+
+        try:
+            return target(*args, **kwargs)
+
+        finally:
+            worker_profile.disable()
+            save(worker_profile)
+
+    return profiled
+
+
+
+# start profiling the given operation in the current process, discarding the
+# statistics of an earlier run
+#
+def start(operation):
+    """
+    Starts profiling the given operation.
+    """
+
+    global directory, profile_main
+
+    if not enabled:
+        return
+
+    directory = get_path(operation)
+    shutil.rmtree(str(directory), ignore_errors=True)
+    directory.mkdir(parents=True)
+
+    profile_main = cProfile.Profile()
+    profile_main.enable()
+
+
+
+# stop profiling the running operation, merge the statistics of all its
+# processes, and report its hottest functions
+#
+def stop():
+    """
+    Stops profiling the running operation, and reports its hottest functions.
+    """
+
+    global directory, profile_main
+
+    if not enabled or profile_main is None:
+        return
+
+    profile_main.disable()
+    save(profile_main)
+
+    time_start = time.time()
+
+    files = sorted(directory.glob("*" + PROFILE_EXT))
+    stats = pstats.Stats(*[str(x) for x in files])
+
+    merged = str(directory) + PROFILE_EXT
+    stats.dump_stats(merged)
+
+    rss = {
+        x.stem: int(x.read_text())
+        for x in sorted(directory.glob("*" + PROFILE_RSS_EXT))
+    }
+
+    # full report, and hottest functions
+    report = io.StringIO()
+    report.write("Peak RSS by process (KB):\n")
+    for worker, kb in rss.items():
+        report.write("  %s\t%d\n" % (worker, kb))
+    report.write("\n")
+
+    stats.stream = report
+    stats.sort_stats(PROFILE_SORT).print_stats()
+
+    with open(str(directory) + PROFILE_REPORT_EXT, "w") as out:
+        out.write(report.getvalue())
+
+    top = io.StringIO()
+    stats.stream = top
+    stats.print_stats(PROFILE_TOP)
+
+    logger.info("  Profiled %d processes (peak RSS %.1f MB at most). Hottest functions:\n%s",
+        len(files), max(rss.values(), default=0) / 1024,
+        top.getvalue().split("\n\n", 1)[-1].rstrip())
+    logger.info("  Profile statistics merged in %s (report in %s) in %.2f seconds",
+        merged, str(directory) + PROFILE_REPORT_EXT, time.time() - time_start)
+
+    directory = None
+    profile_main = None
@@ -0,0 +1,274 @@
+#
+# module for managing reliable work queues
+#
+
+
+import logging
+import os
+import socket
+import storage
+import time
+from common import *
+
+
+
+# a work queue is a set of pending items (e.g. the targets of a namespace),
+# along with:
+# - a sorted set of the items claimed by workers, scored by the time their
+#   lease expires at
+# - a set of the items completed by workers
+# Claimed items are moved from the pending set to the lease set, and from the
+# lease set to the completed set once acknowledged. Items whose lease
+# expired (i.e. whose worker died) are moved back to the pending set by the
+# next claim, which finds them by score rather than by scanning all leases,
+# and completed items are never claimed again.
+# The pending items of an ordered queue are held in a list instead, and
+# claimed from its head: items whose lease expired are moved back to the head
+QUEUE_LEASES = ":leases"
+QUEUE_DONE   = ":done"
+
+# seconds a claimed item is leased for, and seconds between two claims while
+# all items are leased
+QUEUE_LEASE = 600
+QUEUE_POLL  = 1
+
+# workers claim items in chunks, sized to take about QUEUE_CHUNK seconds of
+# processing given the recent processing time per item (smoothed by
+# QUEUE_CHUNK_SMOOTHING, the weight of the last chunk)
+QUEUE_CHUNK = 1.0
+QUEUE_CHUNK_SMOOTHING = 0.5
+
+
+# logger
+logger = logging.getLogger("queues")
+
+# claim script, registered once and run by any redis client (see LUA_CLAIM)
+claim_script = None
+
+
+
+# return the id of the current worker (host name and process id)
+#
+def get_worker():
+    """
+    Returns the id of the current worker.
+    """
+
+    return str(socket.gethostname() + SEPARATOR + str(os.getpid()))
+
+
+
+# return the lease set and completed set of the given queue
+#
+def get_keys(queue):
+    """
+    Returns the keys of the lease set and of the completed set of the given
+    queue.
+    """
+
+    return str(queue + QUEUE_LEASES), str(queue + QUEUE_DONE)
+
+
+
+# claim up to count pending items of the given queue for the current worker,
+# after moving the items whose lease expired back to the pending set. Return
+# the list of claimed items (empty when there are no pending items)
+#
+def claim(cache, queue, count=1, lease=QUEUE_LEASE, ordered=False):
+    """
+    Returns up to count pending items of the given queue, leased to the
+    current worker for the given number of seconds.
+    """
+
+    global claim_script
+
+    leases, done = get_keys(queue)
+    now = time.time()
+
+    args = [count, repr(now), repr(now + lease), int(ordered)]
+
+    if storage.is_redis(cache):
+        if claim_script is None:
+            claim_script = cache.register_script(LUA_CLAIM)
+        return claim_script(keys=[queue, leases, done], args=args, client=cache)
+
+    return cache.claim(queue, leases, done, *args)
+
+
+
+# acknowledge the completion of the given items of the given queue. The
+# commands are queued in the given pipeline (or sent by the given client), so
+# that items can be acknowledged along with the results of their processing
+#
+def ack(pipe, queue, items):
+    """
+    Marks the given claimed items of the given queue as completed.
+    """
+
+    if not items:
+        return
+
+    leases, done = get_keys(queue)
+
+    pipe.zrem(leases, *items)
+    pipe.sadd(done, *items)
+
+
+
+# adaptive number of items claimed at once by a worker. Chunks shrink as soon
+# as items take longer to process, and at most double at each claim, so that
+# the first fast items do not claim the whole queue
+#
+class Chunk(object):
+    """
+    Number of items to claim at once, adapted to the processing time per
+    item of the previous chunks.
+    """
+
+    def __init__(self, maximum, minimum=1, duration=QUEUE_CHUNK):
+        self.maximum = max(int(maximum), 1)
+        self.minimum = min(max(int(minimum), 1), self.maximum)
+        self.duration = duration
+        self.size = self.minimum
+        self.item_time = None
+
+    def update(self, items, seconds):
+        """
+        Records the processing time of a chunk of the given number of items,
+        and returns the size of the next chunk.
+        """
+
+        if items:
+            item_time = seconds / items
+            if self.item_time is not None:
+                item_time = QUEUE_CHUNK_SMOOTHING * item_time \
+                    + (1 - QUEUE_CHUNK_SMOOTHING) * self.item_time
+            self.item_time = item_time
+
+            size = int(self.duration / item_time) if item_time > 0 else self.maximum
+            self.size = max(self.minimum, min(size, 2 * self.size, self.maximum))
+
+        return self.size
+
+
+
+# wait for the items claimed by other workers of the given queue, when there
+# are no pending items left: they are either completed, or claimed again
+# once their lease expires. Return False when no item of the queue is claimed
+#
+def wait(cache, queue):
+    """
+    Waits for QUEUE_POLL seconds if items of the given queue are still
+    claimed, and returns whether they were.
+    """
+
+    leases, done = get_keys(queue)
+
+    if not cache.exists(leases):
+        return False
+
+    time.sleep(QUEUE_POLL)
+
+    return True
+
+
+
+# move all claimed items of the given queue back to the pending set, e.g.
+# items claimed by the workers of an interrupted run. Return the number of
+# recovered items
+# NOTE that runs of the same operation on the same namespace must not
+# overlap, as their claimed items would be recovered
+#
+def recover(cache, queue, ordered=False):
+    """
+    Moves all claimed items of the given queue back to its pending set, and
+    returns their number.
+    """
+
+    leases, done = get_keys(queue)
+
+    items = cache.zrange(leases, 0, -1)
+
+    if items:
+        pipe = cache.pipeline(transaction=False)
+        if ordered:
+            pipe.lpush(queue, *items)
+        else:
+            pipe.sadd(queue, *items)
+        pipe.zrem(leases, *items)
+        pipe.execute()
+
+        logger.info("  Recovered %d items of %s claimed by an interrupted run",
+            len(items), queue)
+
+    return len(items)
+
+
+
+# forget the claimed and completed items of the given queue (and its pending
+# items, unless only its markers are reset), e.g. when the queue is filled
+# with new input: completed markers only let an interrupted run resume, and
+# must not hide the items of a later run
+#
+def reset(cache, queue, pending=False):
+    """
+    Removes the lease set and the completed set of the given queue, as well
+    as its pending items if requested.
+    """
+
+    leases, done = get_keys(queue)
+
+    if pending:
+        cache.delete(queue, leases, done)
+    else:
+        cache.delete(leases, done)
+
+
+
+# claim up to ARGV[1] items of the pending set KEYS[1], after moving the items
+# of the lease set KEYS[2] whose lease expired before ARGV[2] back to the
+# pending set. Items of the completed set KEYS[3] are dropped. Claimed items
+# are leased until ARGV[3]. When ARGV[4] is 1, the pending items are a list
+# (i.e. an ordered queue). Return the claimed items
+# NOTE that replicating the script's effects, rather than the script, allows
+# writes after SPOP (redis < 5)
+LUA_CLAIM = """
+redis.replicate_commands()
+
+local count = tonumber(ARGV[1])
+local ordered = (ARGV[4] == "1")
+
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", "(" .. ARGV[2])
+for _, item in ipairs(expired) do
+    redis.call("ZREM", KEYS[2], item)
+    if ordered then
+        redis.call("LPUSH", KEYS[1], item)
+    else
+        redis.call("SADD", KEYS[1], item)
+    end
+end
+
+local claimed = {}
+while #claimed < count do
+    local items
+    if ordered then
+        items = {redis.call("LPOP", KEYS[1])}
+        if not items[1] then
+            items = {}
+        end
+    else
+        items = redis.call("SPOP", KEYS[1], count - #claimed)
+    end
+    if #items == 0 then
+        break
+    end
+    for _, item in ipairs(items) do
+        if redis.call("SISMEMBER", KEYS[3], item) == 0 then
+            redis.call("ZADD", KEYS[2], ARGV[3], item)
+            claimed[#claimed + 1] = item
+        end
+    end
+end
+
+return claimed
+"""
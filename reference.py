@@ -0,0 +1,255 @@
+#
+# module for managing local reference genomes
+#
+
+
+import logging
+import mmap
+import numpy
+import struct
+from bisect import bisect_right
+from common import *
+from pathlib import Path
+from Bio.Seq import Seq
+from Bio.Alphabet import IUPAC
+
+
+
+# a reference genome is looked up by genome build (e.g. hg19) in the given
+# directory, either as a UCSC .2bit file, or as a FASTA file along with its
+# samtools .fai index. Both are memory-mapped, so that any genomic range is
+# read with a few slices
+REFERENCE_EXT_2BIT  = ".2bit"
+REFERENCE_EXT_FASTA = [".fa", ".fasta"]
+REFERENCE_EXT_FAI   = ".fai"
+
+# .2bit file signature, and bases of each 2-bit code
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_BASES = b"TCAG"
+
+
+# logger
+logger = logging.getLogger("reference")
+
+
+
+# return the reference genome of the given genome build found in the given
+# directory, or None if there is none
+#
+def find(directory, genome):
+    """
+    Returns the local reference genome of the given genome build (a .2bit
+    file, or an indexed FASTA file) found in the given directory, or None.
+    """
+
+    if not directory:
+        return None
+
+    path = Path(directory).joinpath(genome + REFERENCE_EXT_2BIT)
+
+    if path.is_file():
+        logger.info("Using reference genome %s", path)
+        return TwoBit(path)
+
+    for ext in REFERENCE_EXT_FASTA:
+
+        path = Path(directory).joinpath(genome + ext)
+
+        if path.is_file() and Path(str(path) + REFERENCE_EXT_FAI).is_file():
+            logger.info("Using reference genome %s", path)
+            return Fasta(path)
+
+    return None
+
+
+
+# local reference genome.
+# Genomic ranges follow the GenBank/EMBL 1-based counting, with inclusive
+# ends, as the UCSC DAS server. Each format (TwoBit, Fasta) defines
+# sequence(chromosome, start, end), returning the sequence of the given
+# chromosome between the given positions
+#
+class Reference(object):
+    """
+    Memory-mapped reference genome.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as src:
+            self.data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def genomic_sequence(self, bio_seqs, core):
+        """
+        Returns the list of the provided Bio.SeqRecords, updated with their
+        genomic sequences (None for records whose chromosome is not in the
+        reference genome). Drop-in replacement of ucsc.genomic_sequence.
+        """
+
+        result = []
+
+        for bio_seq in bio_seqs:
+
+            if not bio_seq:
+                result.append(None)
+                continue
+
+            try:
+                bio_seq.seq = Seq(
+                    self.sequence(
+                        bio_seq.annotations[REF_CHR],
+                        bio_seq.annotations[REF_TX_START],
+                        bio_seq.annotations[REF_TX_END]),
+                    IUPAC.unambiguous_dna)
+
+            except KeyError:
+                logger.debug("  Worker %d:   Chromosome %s of target %s not found in %s",
+                    core, bio_seq.annotations[REF_CHR], bio_seq.id, self.path.name)
+                result.append(None)
+                continue
+
+            logger.debug("  Worker %d:   Retrieved genomic sequence of target %s from %s",
+                core, bio_seq.id, self.path.name)
+
+            result.append(bio_seq)
+
+        return result
+
+
+
+# reference genome stored in a UCSC .2bit file
+# (see genome.ucsc.edu/FAQ/FAQformat.html#format7). Each sequence holds 4
+# bases per byte, and lists its blocks of Ns and of soft-masked (lower case)
+# bases
+#
+class TwoBit(Reference):
+    """
+    Memory-mapped reference genome in .2bit format.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        # the signature tells the byte order of the file
+        if struct.unpack("<I", self.data[:4])[0] == TWOBIT_SIGNATURE:
+            self.order = "<"
+        elif struct.unpack(">I", self.data[:4])[0] == TWOBIT_SIGNATURE:
+            self.order = ">"
+        else:
+            raise ValueError("Not a .2bit file: " + str(self.path))
+
+        version, count = struct.unpack(self.order + "II", self.data[4:12])
+
+        # sequence index (version 1 files have 64-bit offsets)
+        offset_format = self.order + ("Q" if version == 1 else "I")
+        offset_size = struct.calcsize(offset_format)
+
+        self.offsets = {}
+        self.headers = {}
+
+        position = 16
+        for x in range(count):
+            size = self.data[position]
+            name = self.data[(position + 1):(position + 1 + size)].decode("ascii")
+            position += 1 + size
+            self.offsets[name] = struct.unpack(offset_format,
+                self.data[position:(position + offset_size)])[0]
+            position += offset_size
+
+        # base of each 2-bit code of each byte
+        codes = numpy.arange(256, dtype=numpy.uint8)
+        self.table = numpy.frombuffer(TWOBIT_BASES, dtype=numpy.uint8)[
+            numpy.stack([(codes >> shift) & 3 for shift in (6, 4, 2, 0)], axis=1)]
+
+    def header(self, chromosome):
+        """
+        Returns the length, N blocks, mask blocks, and packed bases offset of
+        the given chromosome.
+        """
+        if chromosome not in self.headers:
+
+            position = self.offsets[chromosome]
+
+            def read(count):
+                nonlocal position
+                values = numpy.frombuffer(self.data, dtype=self.order + "u4",
+                    count=int(count), offset=position)
+                position += 4 * count
+                return values.astype(numpy.int64)
+
+            size, blocks = read(2)
+            n_blocks = (read(blocks), read(blocks))
+            blocks, = read(1)
+            mask_blocks = (read(blocks), read(blocks))
+            position += 4
+
+            self.headers[chromosome] = (int(size), n_blocks, mask_blocks, position)
+
+        return self.headers[chromosome]
+
+    def sequence(self, chromosome, start, end):
+        size, n_blocks, mask_blocks, position = self.header(chromosome)
+
+        # 0-based, half-open range
+        start = max(start - 1, 0)
+        end = min(end, size)
+        if end <= start:
+            return ""
+
+        first = start // 4
+        last = (end + 3) // 4
+
+        bases = self.table[numpy.frombuffer(self.data, dtype=numpy.uint8,
+            count=(last - first), offset=(position + first))].ravel()
+        bases = bases[(start - 4 * first):(end - 4 * first)].copy()
+
+        # Ns, and soft-masked bases
+        for (starts, sizes), apply in (
+                (n_blocks, lambda x: ord("N")),
+                (mask_blocks, lambda x: x | 0x20)):
+            for block in range(max(bisect_right(starts, start) - 1, 0), len(starts)):
+                block_start = starts[block]
+                if block_start >= end:
+                    break
+                block_end = block_start + sizes[block]
+                if block_end > start:
+                    section = slice(max(block_start, start) - start,
+                        min(block_end, end) - start)
+                    bases[section] = apply(bases[section])
+
+        return bases.tobytes().decode("ascii")
+
+
+
+# reference genome stored in a FASTA file, indexed by a samtools .fai file
+# (name, length, offset, bases per line, bytes per line)
+#
+class Fasta(Reference):
+    """
+    Memory-mapped reference genome in indexed FASTA format.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        self.index = {}
+
+        with open(str(self.path) + REFERENCE_EXT_FAI, 'r') as src:
+            for line in src:
+                fields = line.rstrip().split("\t")
+                self.index[fields[0]] = tuple(int(x) for x in fields[1:5])
+
+    def sequence(self, chromosome, start, end):
+        size, offset, line_bases, line_width = self.index[chromosome]
+
+        # 0-based, half-open range
+        start = max(start - 1, 0)
+        end = min(end, size)
+        if end <= start:
+            return ""
+
+        first = offset + (start // line_bases) * line_width + (start % line_bases)
+        last  = offset + (end // line_bases) * line_width + (end % line_bases)
+
+        return self.data[first:last].decode("ascii").replace("\n", "").replace("\r", "")
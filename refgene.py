@@ -0,0 +1,248 @@
+#
+# module for managing local refGene coordinate indexes
+#
+
+
+import gzip
+import logging
+import numpy
+import os
+import pickle
+from common import *
+from pathlib import Path
+
+
+
+# a refGene index is built from the UCSC refGene table dump of a genome
+# build (e.g. hg19.refGene.txt.gz, from goldenPath/hg19/database/refGene.txt.gz)
+# found in the reference directory. As the UCSC MySQL query, it only keeps
+# the RefSeq IDs found in the knownToRefSeq table dump of the same build, if
+# given (e.g. hg19.knownToRefSeq.txt.gz).
+# The index is saved next to cached downloads, and rebuilt when its dumps
+# change
+REFGENE_TABLE  = ".refGene"
+REFGENE_KNOWN  = ".knownToRefSeq"
+REFGENE_EXT    = [".txt", ".txt.gz"]
+REFGENE_INDEX  = ".refGene.index"
+
+# refGene table columns
+REFGENE_NAME     = 1
+REFGENE_CHROM    = 2
+REFGENE_STRAND   = 3
+REFGENE_TX_START = 4
+REFGENE_TX_END   = 5
+
+# knownToRefSeq table columns
+KNOWN_VALUE = 1
+
+
+# logger
+logger = logging.getLogger("refGene")
+
+
+
+# return the refGene index of the given genome build, built from the table
+# dumps found in the given directory, or None if there is no refGene dump
+#
+def find(directory, genome):
+    """
+    Returns the refGene index of the given genome build, loading it from its
+    saved copy, or building it from the table dumps in the given directory.
+    """
+
+    if not directory:
+        return None
+
+    table = get_dump(directory, genome + REFGENE_TABLE)
+
+    if not table:
+        return None
+
+    known = get_dump(directory, genome + REFGENE_KNOWN)
+
+    sources = [
+        (str(path), path.stat().st_size, path.stat().st_mtime_ns)
+        for path in (table, known) if path
+    ]
+
+    path = Path(FILE_PATH).joinpath(genome + REFGENE_INDEX)
+
+    # use the saved index, unless its dumps changed
+    try:
+        with open(path, 'rb') as src:
+            index = pickle.load(src)
+
+        if index.sources == sources:
+            logger.info("Using refGene index %s", path)
+            return index
+
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    logger.info("Building refGene index of %s from %s", genome, table)
+
+    index = RefGene(table, known)
+    index.sources = sources
+
+    # save the index atomically, as several workers can build it at once
+    tmp_path = Path(str(path) + "." + str(os.getpid()))
+
+    with open(tmp_path, 'wb') as dst:
+        pickle.dump(index, dst, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, path)
+
+    return index
+
+
+
+# return the table dump with the given name found in the given directory
+# (plain or gzipped), or None
+#
+def get_dump(directory, name):
+    """
+    Returns the path of the given table dump in the given directory, or None.
+    """
+
+    for ext in REFGENE_EXT:
+
+        path = Path(directory).joinpath(name + ext)
+
+        if path.is_file():
+            return path
+
+    return None
+
+
+
+# yield the columns of each row of the given table dump
+#
+def get_rows(path):
+    """
+    Yields the list of columns of each row of the given (gzipped) table dump.
+    """
+
+    opener = gzip.open if str(path).endswith(".gz") else open
+
+    with opener(path, 'rt') as src:
+        for line in src:
+            if line.strip() and not line.startswith("#"):
+                yield line.rstrip("\n").split("\t")
+
+
+
+# index of the refGene table of a genome build:
+# - by RefSeq ID, to the transcript's location (chromosome, transcription
+#   start position (1-based counting), transcription end position, strand).
+#   As the UCSC MySQL query, the first row of each RefSeq ID is kept
+# - by chromosome, to the transcripts sorted by start position, to find the
+#   transcripts overlapping a genomic range
+#
+class RefGene(object):
+    """
+    In-memory index of a refGene table dump.
+    """
+
+    def __init__(self, table, known=None):
+        self.sources = []
+
+        known_ids = None
+        if known:
+            known_ids = set(row[KNOWN_VALUE] for row in get_rows(known))
+
+        self.locations = {}
+
+        for row in get_rows(table):
+
+            name = row[REFGENE_NAME]
+
+            if name in self.locations:
+                continue
+            if known_ids is not None and name not in known_ids:
+                continue
+
+            self.locations[name] = (
+                row[REFGENE_CHROM],
+                int(row[REFGENE_TX_START]) + 1, # (1-based counting)
+                int(row[REFGENE_TX_END]),
+                row[REFGENE_STRAND]
+            )
+
+        # interval index: transcripts of each chromosome, sorted by start
+        # position, and the longest transcript of each chromosome
+        chromosomes = {}
+        for name, (chromosome, start, end, strand) in self.locations.items():
+            chromosomes.setdefault(chromosome, []).append((start, end, name))
+
+        self.intervals = {}
+        for chromosome, transcripts in chromosomes.items():
+            transcripts.sort()
+            starts = numpy.array([x[0] for x in transcripts], dtype=numpy.int64)
+            ends = numpy.array([x[1] for x in transcripts], dtype=numpy.int64)
+            self.intervals[chromosome] = (
+                starts, ends, [x[2] for x in transcripts],
+                int((ends - starts).max())
+            )
+
+    def __len__(self):
+        return len(self.locations)
+
+    def location(self, name):
+        """
+        Returns the (chromosome, start, end, strand) location of the given
+        RefSeq ID, or None.
+        """
+        return self.locations.get(name)
+
+    def overlapping(self, chromosome, start, end):
+        """
+        Returns the RefSeq IDs of the transcripts overlapping the given range
+        of the given chromosome (1-based counting, inclusive).
+        """
+        if chromosome not in self.intervals:
+            return []
+
+        starts, ends, names, longest = self.intervals[chromosome]
+
+        # only transcripts starting at most "longest" nt. before the range
+        # can overlap it
+        first = numpy.searchsorted(starts, start - longest, side="left")
+        last  = numpy.searchsorted(starts, end, side="right")
+
+        return [
+            names[first + x]
+            for x in numpy.flatnonzero(ends[first:last] >= start).tolist()
+        ]
+
+    def genomic_coordinates(self, bio_seqs, core):
+        """
+        Returns the list of the provided Bio.SeqRecords, updated with their
+        chromosome, transcription start/end positions (1-based counting) and
+        strand (None for records whose RefSeq ID is not indexed). Drop-in
+        replacement of ucsc.genomic_coordinates.
+        """
+
+        result = []
+
+        for bio_seq in bio_seqs:
+
+            data = self.locations.get(bio_seq.id) if bio_seq else None
+
+            if not data:
+                if bio_seq:
+                    logger.debug("  Worker %d:   Target %s not found in the refGene index",
+                        core, bio_seq.id)
+                result.append(None)
+                continue
+
+            bio_seq.annotations[REF_CHR]      = data[0]
+            bio_seq.annotations[REF_TX_START] = data[1]
+            bio_seq.annotations[REF_TX_END]   = data[2]
+            bio_seq.annotations[REF_STRAND]   = data[3]
+
+            logger.debug("  Worker %d:   Retrieved genomic location of target %s from the refGene index",
+                core, bio_seq.id)
+
+            result.append(bio_seq)
+
+        return result
@@ -0,0 +1,335 @@
+#
+# module for scheduling the targets compared by filtrate
+#
+
+
+import logging
+import numpy
+import pairstore
+import queues
+import storage
+from common import *
+
+
+
+# filtrate compares all duplex pairs of each target, hence the work of a
+# target grows with the square of its number of duplexes. The number of
+# duplexes of each target is recorded by read, in a hash of the namespace, and
+# the targets are scheduled as units of work of similar cost, dispatched
+# largest first through an ordered queue (see queues):
+# - targets cheaper than the unit cost are batched in one unit
+# - targets more expensive than the unit cost are split in as many units,
+#   each comparing the duplexes of a range of the target's duplexes (sorted
+#   by binding start position) with all following duplexes
+# The unit cost is set so that each worker processes SCHEDULE_UNITS units on
+# average.
+# Each unit is represented as the items it holds, joined by UNIT_SEPARATOR.
+# Each item is either a target, or a range of a target represented as
+# TARGET|FIRST|LAST (0-based, LAST excluded)
+SCHEDULE_KEY   = ":schedule"
+SCHEDULE_COSTS = ":duplexes"
+SCHEDULE_UNITS = 16
+
+UNIT_SEPARATOR  = " "
+RANGE_SEPARATOR = "|"
+
+# the packed duplex pairs of each range of a split target are stored in a
+# hash of the namespace, and merged in the pair store once all ranges are
+# compared
+SCHEDULE_PARTS = ":parts"
+
+
+# logger
+logger = logging.getLogger("scheduler")
+
+
+
+# return the ordered queue of the units of the given namespace
+#
+def get_key(namespace):
+    """
+    Returns the key of the ordered queue of units of the given namespace.
+    """
+
+    return str(namespace + ":targets" + SCHEDULE_KEY)
+
+
+
+# return the hash mapping each target of the given namespace to its number of
+# duplexes
+#
+def get_costs_key(namespace):
+    """
+    Returns the key of the hash of the number of duplexes of each target of
+    the given namespace.
+    """
+
+    return str(namespace + ":targets" + SCHEDULE_COSTS)
+
+
+
+# return the hash holding the packed duplex pairs of the ranges of split
+# targets of the given namespace
+#
+def get_parts_key(namespace):
+    """
+    Returns the key of the hash of the packed duplex pairs of each range of
+    the split targets of the given namespace.
+    """
+
+    return str(pairstore.get_key(namespace) + SCHEDULE_PARTS)
+
+
+
+# forget the units scheduled for the given namespace (pending, claimed, or
+# completed), and the duplex pairs of the ranges of its split targets, e.g.
+# when its targets are read again
+#
+def reset(cache, namespace):
+    """
+    Removes the scheduled units of the given namespace, and the duplex pairs
+    of the ranges of its split targets.
+    """
+
+    queues.reset(cache, get_key(namespace), pending=True)
+    cache.delete(get_parts_key(namespace))
+
+
+
+# return the number of duplex pairs whose first duplex is within the given
+# range of a target with the given number of duplexes
+#
+def get_pairs(duplexes, first=0, last=None):
+    """
+    Returns the number of duplex pairs compared by the given range of a
+    target.
+    """
+
+    last = duplexes if last is None else last
+
+    return (last - first) * (duplexes - 1) - (first + last - 1) * (last - first) // 2
+
+
+
+# return the (target, first, last) items of the given unit. Whole targets
+# have a range of None
+#
+def get_items(unit):
+    """
+    Returns the target, and the range of duplexes, of each item of the given
+    unit.
+    """
+
+    items = []
+
+    for item in unit.split(UNIT_SEPARATOR):
+        fields = item.split(RANGE_SEPARATOR)
+
+        if len(fields) == 3:
+            items.append((fields[0], int(fields[1]), int(fields[2])))
+        else:
+            items.append((item, None, None))
+
+    return items
+
+
+
+# return the item of the given range of the given target
+#
+def get_item(target, first=None, last=None):
+    """
+    Returns the representation of the given range of the given target.
+    """
+
+    if first is None:
+        return target
+
+    return str(target + RANGE_SEPARATOR + str(first) + RANGE_SEPARATOR + str(last))
+
+
+
+# record the number of duplexes of each target of the given namespace, in
+# batches of targets
+#
+def cache_costs(cache, namespace, batch):
+    """
+    Caches the number of duplexes of each target of the given namespace.
+    """
+
+    targets = list(cache.smembers(str(namespace + ":targets")))
+
+    for x in range(0, len(targets), batch):
+
+        pipe = cache.pipeline(transaction=False)
+        for target in targets[x:(x + batch)]:
+            pipe.scard(str(target + ":duplexes"))
+
+        costs = dict(zip(targets[x:(x + batch)], pipe.execute()))
+        if costs:
+            cache.hset(get_costs_key(namespace), mapping=costs)
+
+
+
+# return the units of the given targets, given as a dictionary mapping each
+# target to its number of duplexes, sorted by decreasing cost. Each unit is
+# returned along with its cost
+#
+def get_units(duplexes, workers, batch):
+    """
+    Returns the (cost, unit) pairs scheduling the given targets over the given
+    number of workers, largest first.
+    """
+
+    # each target costs its duplex pairs, plus its own round trips
+    costs = {
+        target: get_pairs(count) + 1
+        for target, count in duplexes.items()
+    }
+
+    unit_cost = max(sum(costs.values()) // max(workers * SCHEDULE_UNITS, 1), 1)
+
+    units = []
+    small = []
+
+    for target in sorted(costs, key=lambda x: (-costs[x], x)):
+
+        # split the target in ranges of similar cost
+        if costs[target] > 2 * unit_cost:
+            count = duplexes[target]
+            first = 0
+            cost = 0
+
+            for x in range(count):
+                cost += count - x - 1
+                if cost >= unit_cost or x == count - 1:
+                    units.append((cost, get_item(target, first, x + 1)))
+                    first = x + 1
+                    cost = 0
+
+        elif costs[target] >= unit_cost:
+            units.append((costs[target], target))
+
+        else:
+            small.append(target)
+
+    # batch the small targets, largest first
+    items = []
+    cost = 0
+
+    for target in small:
+        items.append(target)
+        cost += costs[target]
+
+        if cost >= unit_cost or len(items) == batch:
+            units.append((cost, UNIT_SEPARATOR.join(items)))
+            items = []
+            cost = 0
+
+    if items:
+        units.append((cost, UNIT_SEPARATOR.join(items)))
+
+    return sorted(units, key=lambda x: -x[0])
+
+
+
+# schedule the pending targets of the given namespace as units of work on the
+# ordered queue of the namespace, unless they were scheduled by an interrupted
+# run. Return the number of scheduled units
+# NOTE that scheduled targets are handed over to the ordered queue: they are
+# marked as completed in the queue of targets
+#
+def schedule(cache, namespace, workers, batch):
+    """
+    Schedules the pending targets of the given namespace, largest first, and
+    returns the number of scheduled units.
+    """
+
+    queue = get_key(namespace)
+    targets_queue = str(namespace + ":targets")
+
+    # units claimed by an interrupted run are processed again
+    queues.recover(cache, queue, ordered=True)
+
+    leases, done = queues.get_keys(targets_queue)
+    targets = sorted(cache.smembers(targets_queue) - cache.smembers(done))
+
+    if not targets:
+        return 0
+
+    # the number of duplexes of targets read before it was recorded is
+    # counted now
+    duplexes = dict(zip(targets, cache.hmget(get_costs_key(namespace), targets)))
+
+    missing = [target for target, count in duplexes.items() if count is None]
+    if missing:
+        pipe = cache.pipeline(transaction=False)
+        for target in missing:
+            pipe.scard(str(target + ":duplexes"))
+        duplexes.update(zip(missing, pipe.execute()))
+
+    duplexes = {target: int(count) for target, count in duplexes.items()}
+
+    units = get_units(duplexes, workers, batch)
+
+    # push the smallest units first, so that the largest unit is at the head
+    # of the queue
+    pipe = cache.pipeline()
+    for x in range(len(units), 0, -batch):
+        pipe.lpush(queue, *[unit for cost, unit in units[max(x - batch, 0):x][::-1]])
+    pipe.sadd(done, *targets)
+    pipe.delete(targets_queue)
+    pipe.execute()
+
+    logger.info(
+        "  Scheduled %d targets as %d units (%d split, largest first, %d duplex pairs at most per unit)",
+        len(targets), len(units),
+        sum(1 for cost, unit in units if RANGE_SEPARATOR in unit),
+        units[0][0] if units else 0
+    )
+
+    return len(units)
+
+
+
+# merge the packed duplex pairs of the ranges of each split target of the
+# given namespace in the pair store, once all units are processed
+#
+def merge(cache, namespace):
+    """
+    Merges the packed duplex pairs of the ranges of each split target in the
+    pair store of the given namespace.
+    """
+
+    queue = get_key(namespace)
+    leases, done = queues.get_keys(queue)
+
+    if cache.exists(queue) or cache.exists(leases):
+        logger.warning("  Units of %s are still pending. Split targets not merged",
+            namespace)
+        return
+
+    # packed records are not valid strings
+    # ==> read them with a client which does not decode responses
+    raw = storage.raw(cache)
+
+    parts = {}
+    for item, value in raw.hgetall(get_parts_key(namespace)).items():
+        item = item.decode("utf-8") if isinstance(item, bytes) else item
+        target, first, last = get_items(item)[0]
+        parts.setdefault(target, []).append((item, pairstore.unpack(value)))
+
+    if not parts:
+        return
+
+    pipe = raw.pipeline(transaction=False)
+
+    for target, values in parts.items():
+        records = numpy.concatenate([records for item, records in values])
+
+        pipe.hset(pairstore.get_key(namespace), target,
+            pairstore.pack(records["line1"], records["line2"], records["distance"]))
+        pipe.hdel(get_parts_key(namespace), *[item for item, records in values])
+
+    pipe.execute()
+
+    logger.info("  Merged the duplex pairs of %d split targets", len(parts))
@@ -0,0 +1,414 @@
+#
+# module for managing columnar snapshots of input datasets
+#
+
+
+import download
+import json
+import logging
+import numpy
+import os
+import shutil
+from array import array
+from common import *
+from pathlib import Path
+
+
+
+# a snapshot stores a parsed input file in a directory of NumPy arrays (one
+# or two per field), which are memory-mapped when loaded:
+# - integer fields are stored as fixed-width integers
+# - decimal fields are stored as fixed-width floats, along with their number
+#   of decimal digits (to restore their exact string representation)
+# - all other fields are dictionary-encoded, i.e. stored as fixed-width codes
+#   into an array of distinct values
+# Fields whose values cannot be restored from their numeric representation
+# (e.g. "007") are dictionary-encoded as well.
+# Each row also records its line number and byte offset in the input file
+SNAPSHOT_EXT  = ".snapshot"
+SNAPSHOT_META = "meta.json"
+SNAPSHOT_PART = "part"
+
+FIELD_INT   = "int"
+FIELD_FLOAT = "float"
+FIELD_STR   = "str"
+
+COLUMN_LINE   = "line"
+COLUMN_OFFSET = "offset"
+
+
+# logger
+logger = logging.getLogger("snapshot")
+
+
+
+# return the snapshot path of the given input file. Snapshots are stored
+# next to cached downloads
+#
+def get_path(in_file):
+    """
+    Returns the snapshot directory of the given input file.
+    """
+
+    return Path(FILE_PATH).joinpath(str(Path(in_file).name + SNAPSHOT_EXT))
+
+
+
+# return the snapshot of the given input file, or None if there is no valid
+# snapshot. A snapshot is valid when it was built from the same source URL
+# and file checksum. The checksum is only recomputed if the file size or
+# modification time changed since the snapshot was built, and since it was
+# downloaded (see download.get_checksum)
+#
+def load(source, in_file):
+    """
+    Returns the memory-mapped snapshot of the given input file (downloaded
+    from the given source), or None if there is no valid snapshot.
+    """
+
+    path = get_path(in_file)
+
+    try:
+        with open(path.joinpath(SNAPSHOT_META), 'r') as src:
+            meta = json.load(src)
+    except (OSError, ValueError):
+        return None
+
+    if meta["source"] != source:
+        logger.info("Snapshot %s refers to a different source. Ignored", path.name)
+        return None
+
+    stat = Path(in_file).stat()
+
+    if (meta["size"], meta["mtime"]) != (stat.st_size, stat.st_mtime_ns):
+
+        if (meta["size"] != stat.st_size) or (meta["sha256"] != download.get_checksum(in_file)):
+            logger.info("Snapshot %s is out of date. Ignored", path.name)
+            return None
+
+        # same content
+        # ==> refresh the file attributes
+        meta["mtime"] = stat.st_mtime_ns
+        write_meta(path, meta)
+
+    return Snapshot(path)
+
+
+
+# write the given snapshot metadata
+#
+def write_meta(path, meta):
+    """
+    Writes the given metadata in the given snapshot directory.
+    """
+
+    with open(path.joinpath(SNAPSHOT_META), 'w') as dst:
+        json.dump(meta, dst)
+
+
+
+# memory-mapped snapshot of an input file
+#
+class Snapshot(object):
+    """
+    Memory-mapped, columnar representation of a parsed input file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with open(self.path.joinpath(SNAPSHOT_META), 'r') as src:
+            self.meta = json.load(src)
+
+        self.kinds  = self.meta["kinds"]
+        self.fields = self.meta.get("fields", list(self.kinds))
+        self.rows   = self.meta["rows"]
+
+    def array(self, name):
+        return numpy.load(self.path.joinpath(name + ".npy"), mmap_mode="r")
+
+    def lines(self):
+        return self.array(COLUMN_LINE)
+
+    def offsets(self):
+        return self.array(COLUMN_OFFSET)
+
+    def integers(self, field):
+        """
+        Returns the values of the given integer field, as integers.
+        """
+        if self.kinds[field] == FIELD_STR:
+            return self.array(field + ".dict").astype(numpy.int64)[self.array(field)]
+        return self.array(field)
+
+    def strings(self, field, start=0, stop=None):
+        """
+        Returns the values of the given field between the given rows, as the
+        strings found in the input file.
+        """
+        stop = self.rows if stop is None else stop
+        kind = self.kinds[field]
+        values = self.array(field)[start:stop]
+
+        if kind == FIELD_STR:
+            dictionary = self.array(field + ".dict")
+            return [x.decode("utf-8") for x in dictionary[values].tolist()]
+
+        if kind == FIELD_FLOAT:
+            decimals = self.array(field + ".decimals")[start:stop]
+            return [
+                format_float(value, digits)
+                for value, digits in zip(values.tolist(), decimals.tolist())
+            ]
+
+        return [str(value) for value in values.tolist()]
+
+    def hashes(self, start=0, stop=None):
+        """
+        Yields the line number and the dictionary of all field values of each
+        row between the given rows.
+        """
+        stop = self.rows if stop is None else stop
+        columns = [self.strings(field, start, stop) for field in self.fields]
+        lines = self.lines()[start:stop].tolist()
+
+        for x, line in enumerate(lines):
+            yield line, {
+                field: column[x] for field, column in zip(self.fields, columns)
+            }
+
+
+
+# return the string representation of a decimal value with the given number of
+# decimal digits (-1 for values with no decimal point)
+#
+def format_float(value, digits):
+    """
+    Returns the string representation of a decimal value.
+    """
+
+    if digits < 0:
+        return str(int(value))
+
+    return "%.*f" % (digits, value)
+
+
+
+# collect the rows of a part of an input file, and save them as a snapshot part.
+# Parts are written by parallel workers, and then merged in one snapshot
+#
+class Writer(object):
+    """
+    Collects parsed rows, and saves them in columnar form.
+    """
+
+    def __init__(self, path, fields):
+        self.path = Path(path)
+        self.fields = fields
+        self.kinds = dict(fields)
+        self.lines = array("q")
+        self.offsets = array("q")
+        self.values = {}
+        self.decimals = {}
+        self.dictionaries = {}
+
+        for field, kind in fields:
+            self.init_field(field, kind)
+
+    def init_field(self, field, kind):
+        self.kinds[field] = kind
+        if kind == FIELD_INT:
+            self.values[field] = array("q")
+        elif kind == FIELD_FLOAT:
+            self.values[field] = array("d")
+            self.decimals[field] = array("b")
+        else:
+            self.values[field] = array("i")
+            self.dictionaries[field] = {}
+
+    def append(self, line, offset, hash):
+        self.lines.append(line)
+        self.offsets.append(offset)
+
+        for field, kind in self.kinds.items():
+            value = hash[field]
+
+            if kind == FIELD_INT:
+                if not self.append_int(field, value):
+                    self.to_dictionary(field)
+                    kind = FIELD_STR
+
+            elif kind == FIELD_FLOAT:
+                if not self.append_float(field, value):
+                    self.to_dictionary(field)
+                    kind = FIELD_STR
+
+            if kind == FIELD_STR:
+                codes = self.dictionaries[field]
+                self.values[field].append(codes.setdefault(value, len(codes)))
+
+    def append_int(self, field, value):
+        try:
+            number = int(value)
+        except ValueError:
+            return False
+        if str(number) != value:
+            return False
+        self.values[field].append(number)
+        return True
+
+    def append_float(self, field, value):
+        digits = len(value) - value.find(".") - 1 if "." in value else -1
+        try:
+            number = float(value)
+        except ValueError:
+            return False
+        if digits > 127 or format_float(number, digits) != value:
+            return False
+        self.values[field].append(number)
+        self.decimals[field].append(digits)
+        return True
+
+    def to_dictionary(self, field):
+        """
+        Switches the given numeric field to dictionary encoding.
+        """
+        if self.kinds[field] == FIELD_INT:
+            values = [str(x) for x in self.values[field]]
+        else:
+            values = [format_float(x, d)
+                for x, d in zip(self.values[field], self.decimals[field])]
+            del self.decimals[field]
+
+        self.init_field(field, FIELD_STR)
+        for value in values:
+            codes = self.dictionaries[field]
+            self.values[field].append(codes.setdefault(value, len(codes)))
+
+    def close(self):
+        """
+        Saves the collected rows.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        numpy.save(self.path.joinpath(COLUMN_LINE + ".npy"),
+            numpy.frombuffer(self.lines, dtype=numpy.int64))
+        numpy.save(self.path.joinpath(COLUMN_OFFSET + ".npy"),
+            numpy.frombuffer(self.offsets, dtype=numpy.int64))
+
+        for field, kind in self.kinds.items():
+            if kind == FIELD_INT:
+                values = numpy.frombuffer(self.values[field], dtype=numpy.int64)
+            elif kind == FIELD_FLOAT:
+                values = numpy.frombuffer(self.values[field], dtype=numpy.float64)
+                numpy.save(self.path.joinpath(field + ".decimals.npy"),
+                    numpy.frombuffer(self.decimals[field], dtype=numpy.int8))
+            else:
+                values = numpy.frombuffer(self.values[field], dtype=numpy.int32)
+                numpy.save(self.path.joinpath(field + ".dict.npy"),
+                    numpy.array([x.encode("utf-8") for x in self.dictionaries[field]],
+                        dtype=bytes))
+            numpy.save(self.path.joinpath(field + ".npy"), values)
+
+        with open(self.path.joinpath(SNAPSHOT_META), 'w') as dst:
+            json.dump({"kinds": self.kinds, "rows": len(self.lines)}, dst)
+
+
+
+# return the path of the given snapshot part of the given input file
+#
+def get_part_path(in_file, part):
+    """
+    Returns the directory of the given snapshot part of an input file.
+    """
+
+    return get_path(in_file).with_suffix(
+        str(SNAPSHOT_EXT + "." + SNAPSHOT_PART + str(part)))
+
+
+
+# merge the given snapshot parts (in input file order) into the snapshot of
+# the given input file, downloaded from the given source.
+# Dictionary-encoded fields are merged by sorting all distinct values, and
+# remapping each part's codes
+#
+def merge(source, in_file, fields, parts):
+    """
+    Merges the given snapshot parts into the snapshot of the given input file,
+    and returns it.
+    """
+
+    path = get_path(in_file)
+    tmp_path = path.with_suffix(str(SNAPSHOT_EXT + ".tmp"))
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    parts = [Snapshot(part) for part in parts]
+
+    # line numbers and offsets
+    for column in (COLUMN_LINE, COLUMN_OFFSET):
+        numpy.save(tmp_path.joinpath(column + ".npy"),
+            numpy.concatenate([part.array(column) for part in parts]))
+
+    kinds = {}
+
+    for field, kind in fields:
+
+        # a field is dictionary-encoded if it is in any part
+        if any(part.kinds[field] == FIELD_STR for part in parts):
+            kind = FIELD_STR
+
+        kinds[field] = kind
+
+        if kind == FIELD_STR:
+            dictionaries = [
+                part.array(field + ".dict") if part.kinds[field] == FIELD_STR
+                else numpy.array([x.encode("utf-8") for x in part.strings(field)],
+                    dtype=bytes)
+                for part in parts
+            ]
+            codes = [
+                part.array(field) if part.kinds[field] == FIELD_STR
+                else numpy.arange(part.rows, dtype=numpy.int32)
+                for part in parts
+            ]
+            dictionary, inverse = numpy.unique(
+                numpy.concatenate(dictionaries), return_inverse=True)
+
+            # each part's codes index its own slice of the merged dictionary
+            first = 0
+            for x, part_dictionary in enumerate(dictionaries):
+                codes[x] = inverse[first:(first + len(part_dictionary))][codes[x]]
+                first += len(part_dictionary)
+
+            numpy.save(tmp_path.joinpath(field + ".dict.npy"), dictionary)
+            numpy.save(tmp_path.joinpath(field + ".npy"),
+                numpy.concatenate(codes).astype(numpy.int32))
+
+        else:
+            numpy.save(tmp_path.joinpath(field + ".npy"),
+                numpy.concatenate([part.array(field) for part in parts]))
+            if kind == FIELD_FLOAT:
+                numpy.save(tmp_path.joinpath(field + ".decimals.npy"),
+                    numpy.concatenate([part.array(field + ".decimals") for part in parts]))
+
+    stat = Path(in_file).stat()
+
+    write_meta(tmp_path, {
+        "source": source,
+        "sha256": download.get_checksum(in_file),
+        "size":   stat.st_size,
+        "mtime":  stat.st_mtime_ns,
+        "fields": [field for field, kind in fields],
+        "kinds":  kinds,
+        "rows":   sum(part.rows for part in parts)
+    })
+
+    # replace any previous snapshot
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    for part in parts:
+        shutil.rmtree(part.path, ignore_errors=True)
+
+    return Snapshot(path)
@@ -0,0 +1,774 @@
+#
+# module for managing the intermediate results database
+#
+
+
+import collections
+import contextlib
+import logging
+import metrics
+import os
+import redis
+import sqlite3
+import threading
+from common import *
+from multiprocessing.managers import BaseManager
+
+
+
+# supported intermediate results databases, given as --db URL:
+# - HOST:PORT or redis://HOST:PORT/DB for a redis instance
+# - memory:// for an in-process database, shared by all workers of the current
+#   run through a manager process (data is lost at the end of the run)
+# - sqlite:///PATH for an on-disk SQLite database, shared by all workers
+#   through file locking
+STORAGE_REDIS  = "redis://"
+STORAGE_MEMORY = "memory://"
+STORAGE_SQLITE = "sqlite://"
+
+# seconds to wait for a locked SQLite database
+SQLITE_TIMEOUT = 600
+
+# maximum number of fields per SQLite query (below the default limit of
+# 999 host parameters of older SQLite versions)
+SQLITE_VARIABLES = 900
+
+
+# number of round trips to the database performed by this process, with any
+# client
+round_trips = 0
+
+
+# logger
+logger = logging.getLogger("storage")
+
+
+
+# error raised by non-redis databases. It extends the redis connection error,
+# so that callers can handle all databases alike
+#
+class StorageError(redis.ConnectionError):
+    """
+    Error raised by a non-redis intermediate results database.
+    """
+    pass
+
+
+
+# return a client of the intermediate results database identified by the
+# given URL
+#
+def connect(url):
+    """
+    Returns a client of the intermediate results database at the given URL.
+    Redis databases are handled by a redis.Redis client, while all other
+    databases are handled by a client exposing the subset of the redis.Redis
+    interface used by the triplexer.
+    """
+
+    if url.startswith(STORAGE_MEMORY):
+        return Backend(MemoryStore.start())
+
+    if url.startswith(STORAGE_SQLITE):
+        return Backend(SQLiteStore(url[len(STORAGE_SQLITE):]))
+
+    if url.startswith(STORAGE_REDIS):
+        return Client.from_url(url, decode_responses=True)
+
+    return Client(
+        decode_responses=True,
+        host=url.split(SEPARATOR)[0],
+        port=url.split(SEPARATOR)[1],
+        db=0)
+
+
+
+# keep a record of a round trip to the database, and of its latency in the
+# "cache_seconds" histogram of the metrics
+#
+@contextlib.contextmanager
+def round_trip():
+    """
+    Counts and times a round trip to the database.
+    """
+
+    global round_trips
+    round_trips += 1
+
+    with metrics.timer("cache_seconds"):
+        yield
+
+
+
+# return whether the given client refers to a redis database
+#
+def is_redis(cache):
+    """
+    Returns True if the given client refers to a redis database.
+    """
+
+    return isinstance(cache, redis.Redis)
+
+
+
+# return a client of the same database as the given client, whose responses
+# are not decoded (e.g. to read binary values). Non-redis databases return
+# binary values as they are
+#
+def raw(cache):
+    """
+    Returns a client of the database of the given client, returning binary
+    values undecoded.
+    """
+
+    if not is_redis(cache):
+        return cache
+
+    pool = cache.connection_pool
+    kwargs = dict(pool.connection_kwargs, decode_responses=False)
+
+    return Client(connection_pool=redis.ConnectionPool(
+        connection_class=pool.connection_class, **kwargs))
+
+
+
+# client of a redis database, recording each round trip (a command, or a
+# pipeline) and its latency (see round_trip)
+#
+class Client(redis.Redis):
+    """
+    Client of a redis database, recording its round trips.
+    """
+
+    def execute_command(self, *args, **options):
+        with round_trip():
+            return super(Client, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ClientPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint)
+
+
+
+# pipeline of a redis database client, recording its round trips. Empty
+# pipelines send nothing
+#
+class ClientPipeline(redis.client.Pipeline):
+    """
+    Pipeline of a redis database, recording its round trips.
+    """
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super(ClientPipeline, self).execute(raise_on_error)
+        with round_trip():
+            return super(ClientPipeline, self).execute(raise_on_error)
+
+
+
+# client of a non-redis database.
+# Each command is sent to the underlying store as a list of one command,
+# while pipelines send all their queued commands at once. Each call is
+# recorded as a round trip, as for redis clients
+#
+class Backend(object):
+    """
+    Client of a non-redis intermediate results database, mimicking the
+    redis.Redis interface (with decoded responses).
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(
+                "'%s' is not supported by this database" % name)
+        return lambda *args, **kwargs: self.execute([(name, args, kwargs)])[0]
+
+    def execute(self, commands):
+        try:
+            with round_trip():
+                return self.store.execute(commands)
+        except (sqlite3.Error, EOFError, OSError) as error:
+            raise StorageError(str(error))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self)
+
+
+
+# pipeline of a non-redis database client
+#
+class Pipeline(object):
+    """
+    Queues commands, and sends them to the database in one call.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(
+                "'%s' is not supported by this database" % name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        return self.backend.execute(commands)
+
+
+
+# return the stored representation of the given value.
+# Redis stores strings, hence everything but binary values is converted to
+# string
+#
+def encode(value):
+    """
+    Returns the stored representation of the given value.
+    """
+
+    if isinstance(value, (bytes, str)):
+        return value
+
+    return str(value)
+
+
+
+# commands supported by non-redis databases
+#
+COMMANDS = {
+    "ping", "delete", "exists",
+    "hset", "hget", "hmget", "hgetall", "hdel",
+    "sadd", "srem", "spop", "smembers", "sismember", "scard",
+    "lpush", "lpop", "lrange", "llen",
+    "zadd", "zrem", "zrange", "zrangebyscore", "zcard",
+    "claim",
+}
+
+
+
+# return the elements of the given list between the start and end indexes
+# (both included), which count from the end of the list when negative
+#
+def get_range(values, start, end):
+    """
+    Returns the given range of the given list, as redis ranges do.
+    """
+
+    start = max(start + len(values), 0) if start < 0 else start
+    end = end + len(values) if end < 0 else end
+
+    return values[start:(end + 1)] if end >= 0 else []
+
+
+
+# return whether the given score is within the given redis score bound
+# (a number, -inf, +inf, or an exclusive bound prefixed by "("), being its
+# lower bound or its upper bound as requested
+#
+def in_score_range(score, bound, lower):
+    """
+    Returns whether the given score is within the given score bound.
+    """
+
+    bound = str(bound)
+    exclusive = bound.startswith("(")
+    limit = float(bound[1:] if exclusive else bound)
+
+    if lower:
+        return score > limit if exclusive else score >= limit
+
+    return score < limit if exclusive else score <= limit
+
+
+
+# sorted set of the in-memory store, mapping each member to its score
+#
+class SortedSet(dict):
+    """
+    Redis-like sorted set.
+    """
+
+    def members(self, min="-inf", max="+inf"):
+        """
+        Returns the members whose score is within the given bounds, ordered
+        by score.
+        """
+
+        return [
+            member
+            for member, score in sorted(self.items(), key=lambda item: (item[1], item[0]))
+            if in_score_range(score, min, True) and in_score_range(score, max, False)
+        ]
+
+
+
+# in-memory store, held by a manager process shared by all workers.
+# Commands are executed one list at a time under a lock, so that each list
+# (i.e. each pipeline) is atomic
+#
+class MemoryStore(object):
+    """
+    In-memory store of redis-like hashes, sets, and lists.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def start():
+        """
+        Starts a manager process holding a new store, and returns its proxy.
+        """
+
+        manager = MemoryStoreManager()
+        manager.start()
+
+        logger.info("Started in-memory database (pid %d)", manager._process.pid)
+
+        # keep the manager process alive as long as its proxy
+        store = manager.MemoryStore()
+        store._manager = manager
+
+        return store
+
+    def execute(self, commands):
+        with self.lock:
+            return [
+                getattr(self, name)(*args, **kwargs)
+                for name, args, kwargs in commands
+            ]
+
+    def get(self, name, kind):
+        value = self.data.get(name)
+        if value is None:
+            return kind()
+        if type(value) is not kind:
+            raise redis.ResponseError(
+                "WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def put(self, name, kind):
+        value = self.get(name, kind)
+        self.data[name] = value
+        return value
+
+    def ping(self):
+        return True
+
+    def delete(self, *names):
+        return sum(1 for name in names if self.data.pop(name, None) is not None)
+
+    def exists(self, *names):
+        return sum(1 for name in names if name in self.data)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        mapping = dict(mapping or {})
+        if key is not None:
+            mapping[key] = value
+        fields = self.put(name, dict)
+        added = len(set(mapping) - set(fields))
+        fields.update((field, encode(value)) for field, value in mapping.items())
+        return added
+
+    def hget(self, name, key):
+        return self.get(name, dict).get(key)
+
+    def hmget(self, name, keys, *args):
+        keys = ([keys] if isinstance(keys, str) else list(keys)) + list(args)
+        fields = self.get(name, dict)
+        return [fields.get(key) for key in keys]
+
+    def hgetall(self, name):
+        return dict(self.get(name, dict))
+
+    def hdel(self, name, *keys):
+        fields = self.get(name, dict)
+        deleted = sum(1 for key in keys if fields.pop(key, None) is not None)
+        if not fields:
+            self.data.pop(name, None)
+        return deleted
+
+    def sadd(self, name, *values):
+        members = self.put(name, set)
+        added = len(members)
+        members.update(encode(value) for value in values)
+        return len(members) - added
+
+    def srem(self, name, *values):
+        members = self.get(name, set)
+        removed = len(members)
+        members.difference_update(encode(value) for value in values)
+        removed -= len(members)
+        if not members:
+            self.data.pop(name, None)
+        return removed
+
+    def spop(self, name, count=None):
+        members = self.get(name, set)
+        popped = [members.pop() for x in range(min(count or 1, len(members)))]
+        if not members:
+            self.data.pop(name, None)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    def smembers(self, name):
+        return set(self.get(name, set))
+
+    def sismember(self, name, value):
+        return encode(value) in self.get(name, set)
+
+    def scard(self, name):
+        return len(self.get(name, set))
+
+    def lpush(self, name, *values):
+        values_list = self.put(name, collections.deque)
+        values_list.extendleft(encode(value) for value in values)
+        return len(values_list)
+
+    def lpop(self, name):
+        values_list = self.get(name, collections.deque)
+        value = values_list.popleft() if values_list else None
+        if not values_list:
+            self.data.pop(name, None)
+        return value
+
+    def lrange(self, name, start, end):
+        return get_range(list(self.get(name, collections.deque)), start, end)
+
+    def llen(self, name):
+        return len(self.get(name, collections.deque))
+
+    def zadd(self, name, mapping):
+        scores = self.put(name, SortedSet)
+        added = len(set(mapping) - set(scores))
+        scores.update((encode(member), float(score)) for member, score in mapping.items())
+        return added
+
+    def zrem(self, name, *values):
+        scores = self.get(name, SortedSet)
+        removed = sum(1 for value in values if scores.pop(encode(value), None) is not None)
+        if not scores:
+            self.data.pop(name, None)
+        return removed
+
+    def zrange(self, name, start, end):
+        return get_range(self.get(name, SortedSet).members(), start, end)
+
+    def zrangebyscore(self, name, min, max):
+        return self.get(name, SortedSet).members(min, max)
+
+    def zcard(self, name):
+        return len(self.get(name, SortedSet))
+
+    def claim(self, name, leases, done, count, now, deadline, ordered=0):
+        # see queues.LUA_CLAIM
+        push = self.lpush if int(ordered) else self.sadd
+        for item in self.zrangebyscore(leases, "-inf", "(" + now):
+            self.zrem(leases, item)
+            push(name, item)
+        claimed = []
+        while len(claimed) < count:
+            if int(ordered):
+                items = [item for item in [self.lpop(name)] if item is not None]
+            else:
+                items = self.spop(name, count - len(claimed))
+            if not items:
+                break
+            for item in items:
+                if not self.sismember(done, item):
+                    self.zadd(leases, {item: deadline})
+                    claimed.append(item)
+        return claimed
+
+
+
+# manager process of the in-memory store
+#
+class MemoryStoreManager(BaseManager):
+    """
+    Manager process holding an in-memory store.
+    """
+    pass
+
+MemoryStoreManager.register("MemoryStore", MemoryStore, exposed=["execute"])
+
+
+
+# on-disk SQLite store.
+# Each process opens its own connection, and executes each list of commands
+# in one immediate transaction, so that each list (i.e. each pipeline) is
+# atomic across processes
+#
+class SQLiteStore(object):
+    """
+    On-disk SQLite store of redis-like hashes, sets, and lists.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.dbs = {}
+
+        # create the database schema
+        self.connection().executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS hashes (
+                key TEXT, field TEXT, value,
+                PRIMARY KEY (key, field)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS sets (
+                key TEXT, member,
+                PRIMARY KEY (key, member)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS lists (
+                key TEXT, position INTEGER, value,
+                PRIMARY KEY (key, position)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS zsets (
+                key TEXT, member, score REAL,
+                PRIMARY KEY (key, member)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score);
+        """)
+
+    def __getstate__(self):
+        return {"path": self.path, "pid": None, "dbs": {}}
+
+    def connection(self):
+        # connections cannot be shared by forked processes, nor used by
+        # other threads
+        if self.pid != os.getpid():
+            self.dbs = {}
+            self.pid = os.getpid()
+        db = self.dbs.get(threading.get_ident())
+        if db is None:
+            db = self.dbs[threading.get_ident()] = sqlite3.connect(
+                self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        return db
+
+    def execute(self, commands):
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = [
+                getattr(self, name)(db, *args, **kwargs)
+                for name, args, kwargs in commands
+            ]
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        return result
+
+    def ping(self, db):
+        return True
+
+    def delete(self, db, *names):
+        deleted = 0
+        for name in names:
+            found = self.exists(db, name)
+            for table in ("hashes", "sets", "lists", "zsets"):
+                db.execute("DELETE FROM %s WHERE key = ?" % table, (name,))
+            deleted += found
+        return deleted
+
+    def exists(self, db, *names):
+        found = 0
+        for name in names:
+            for table in ("hashes", "sets", "lists", "zsets"):
+                if db.execute("SELECT 1 FROM %s WHERE key = ? LIMIT 1" % table,
+                        (name,)).fetchone():
+                    found += 1
+                    break
+        return found
+
+    def hset(self, db, name, key=None, value=None, mapping=None):
+        mapping = dict(mapping or {})
+        if key is not None:
+            mapping[key] = value
+        added = 0
+        for field, value in mapping.items():
+            added += not db.execute(
+                "SELECT 1 FROM hashes WHERE key = ? AND field = ?",
+                (name, field)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                (name, field, encode(value)))
+        return added
+
+    def hget(self, db, name, key):
+        row = db.execute("SELECT value FROM hashes WHERE key = ? AND field = ?",
+            (name, key)).fetchone()
+        return row[0] if row else None
+
+    def hmget(self, db, name, keys, *args):
+        keys = ([keys] if isinstance(keys, str) else list(keys)) + list(args)
+        fields = {}
+        for x in range(0, len(keys), SQLITE_VARIABLES):
+            batch = keys[x:(x + SQLITE_VARIABLES)]
+            fields.update(db.execute(
+                "SELECT field, value FROM hashes WHERE key = ? AND field IN (%s)"
+                    % ", ".join("?" * len(batch)),
+                [name] + batch).fetchall())
+        return [fields.get(key) for key in keys]
+
+    def hgetall(self, db, name):
+        return dict(db.execute("SELECT field, value FROM hashes WHERE key = ?",
+            (name,)).fetchall())
+
+    def hdel(self, db, name, *keys):
+        return sum(
+            db.execute("DELETE FROM hashes WHERE key = ? AND field = ?",
+                (name, key)).rowcount
+            for key in keys)
+
+    def sadd(self, db, name, *values):
+        return sum(
+            db.execute("INSERT OR IGNORE INTO sets VALUES (?, ?)",
+                (name, encode(value))).rowcount
+            for value in values)
+
+    def srem(self, db, name, *values):
+        return sum(
+            db.execute("DELETE FROM sets WHERE key = ? AND member = ?",
+                (name, encode(value))).rowcount
+            for value in values)
+
+    def spop(self, db, name, count=None):
+        popped = [row[0] for row in db.execute(
+            "SELECT member FROM sets WHERE key = ? LIMIT ?",
+            (name, count or 1)).fetchall()]
+        self.srem(db, name, *popped)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    def smembers(self, db, name):
+        return set(row[0] for row in db.execute(
+            "SELECT member FROM sets WHERE key = ?", (name,)).fetchall())
+
+    def sismember(self, db, name, value):
+        return bool(db.execute("SELECT 1 FROM sets WHERE key = ? AND member = ?",
+            (name, encode(value))).fetchone())
+
+    def scard(self, db, name):
+        return db.execute("SELECT count(*) FROM sets WHERE key = ?",
+            (name,)).fetchone()[0]
+
+    def lpush(self, db, name, *values):
+        head = db.execute("SELECT min(position) FROM lists WHERE key = ?",
+            (name,)).fetchone()[0] or 0
+        db.executemany("INSERT INTO lists VALUES (?, ?, ?)", [
+            (name, head - x - 1, encode(value))
+            for x, value in enumerate(values)])
+        return self.llen(db, name)
+
+    def lpop(self, db, name):
+        row = db.execute(
+            "SELECT position, value FROM lists WHERE key = ? ORDER BY position LIMIT 1",
+            (name,)).fetchone()
+        if not row:
+            return None
+        db.execute("DELETE FROM lists WHERE key = ? AND position = ?",
+            (name, row[0]))
+        return row[1]
+
+    def lrange(self, db, name, start, end):
+        # negative indexes count from the end of the list
+        if start < 0 or end < 0:
+            length = self.llen(db, name)
+            start = max(start + length, 0) if start < 0 else start
+            end = end + length if end < 0 else end
+        if end < start:
+            return []
+        return [row[0] for row in db.execute(
+            "SELECT value FROM lists WHERE key = ? ORDER BY position LIMIT ? OFFSET ?",
+            (name, end - start + 1, start)).fetchall()]
+
+    def llen(self, db, name):
+        return db.execute("SELECT count(*) FROM lists WHERE key = ?",
+            (name,)).fetchone()[0]
+
+    def zadd(self, db, name, mapping):
+        added = 0
+        for member, score in mapping.items():
+            added += not db.execute(
+                "SELECT 1 FROM zsets WHERE key = ? AND member = ?",
+                (name, encode(member))).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)",
+                (name, encode(member), float(score)))
+        return added
+
+    def zrem(self, db, name, *values):
+        return sum(
+            db.execute("DELETE FROM zsets WHERE key = ? AND member = ?",
+                (name, encode(value))).rowcount
+            for value in values)
+
+    def zrange(self, db, name, start, end):
+        return get_range([row[0] for row in db.execute(
+            "SELECT member FROM zsets WHERE key = ? ORDER BY score, member",
+            (name,)).fetchall()], start, end)
+
+    def zrangebyscore(self, db, name, min, max):
+        conditions = ["key = ?"]
+        values = [name]
+        for bound, operators in ((min, (">", ">=")), (max, ("<", "<="))):
+            bound = str(bound)
+            if bound.lstrip("(+-") == "inf":
+                continue
+            exclusive = bound.startswith("(")
+            conditions.append("score %s ?" % operators[0 if exclusive else 1])
+            values.append(float(bound[1:] if exclusive else bound))
+        return [row[0] for row in db.execute(
+            "SELECT member FROM zsets WHERE %s ORDER BY score, member" % " AND ".join(conditions),
+            values).fetchall()]
+
+    def zcard(self, db, name):
+        return db.execute("SELECT count(*) FROM zsets WHERE key = ?",
+            (name,)).fetchone()[0]
+
+    def claim(self, db, name, leases, done, count, now, deadline, ordered=0):
+        # see queues.LUA_CLAIM
+        push = self.lpush if int(ordered) else self.sadd
+        for item in self.zrangebyscore(db, leases, "-inf", "(" + now):
+            self.zrem(db, leases, item)
+            push(db, name, item)
+        claimed = []
+        while len(claimed) < count:
+            if int(ordered):
+                items = [item for item in [self.lpop(db, name)] if item is not None]
+            else:
+                items = self.spop(db, name, count - len(claimed))
+            if not items:
+                break
+            for item in items:
+                if not self.sismember(db, done, item):
+                    self.zadd(db, leases, {item: deadline})
+                    claimed.append(item)
+        return claimed
@@ -0,0 +1,161 @@
+#
+# common fixtures of the triplexer tests
+#
+
+
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import microrna_org
+import storage
+from cli import *
+from common import *
+
+
+
+# namespace of the test duplexes
+NAMESPACE = NAMESPACES["test"][NS_LABEL]
+
+# seconds to wait for a local redis-server to accept connections
+REDIS_STARTUP = 10
+
+
+
+# return a free local TCP port
+#
+def get_port():
+    """
+    Returns a free local TCP port.
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+
+# URL of a local redis-server, started for the test (skipped if redis-server
+# is not installed)
+#
+@pytest.fixture
+def redis_url(tmp_path):
+    """
+    Starts a local redis-server, and returns its URL.
+    """
+
+    if shutil.which("redis-server") is None:
+        pytest.skip("redis-server not installed")
+
+    port = get_port()
+    server = subprocess.Popen(
+        ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no",
+            "--dir", str(tmp_path)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = str("127.0.0.1" + SEPARATOR + str(port))
+    cache = storage.connect(url)
+
+    time_start = time.time()
+    while True:
+        try:
+            cache.ping()
+            break
+        except storage.redis.ConnectionError:
+            if time.time() - time_start > REDIS_STARTUP:
+                server.kill()
+                raise
+            time.sleep(0.05)
+
+    yield url
+
+    server.terminate()
+    server.wait()
+
+
+
+# client of the local redis-server
+#
+@pytest.fixture
+def cache(redis_url):
+    """
+    Returns a client of a local redis-server.
+    """
+
+    return storage.connect(redis_url)
+
+
+
+# client of each supported database
+#
+@pytest.fixture(params=["redis", "memory", "sqlite"])
+def any_cache(request, tmp_path):
+    """
+    Returns a client of each supported database.
+    """
+
+    if request.param == "redis":
+        return storage.connect(request.getfixturevalue("redis_url"))
+
+    if request.param == "memory":
+        return storage.connect(storage.STORAGE_MEMORY)
+
+    return storage.connect(storage.STORAGE_SQLITE + "/" + str(tmp_path.joinpath("cache.db")))
+
+
+
+# cache the given number of random duplexes per target (with the given
+# layout), as read does. Binding start positions are drawn around a few
+# anchors, so that duplexes bind exactly SEED_MIN_DISTANCE and
+# SEED_MAX_DISTANCE nt. apart (and one nt. closer or farther), or at the same
+# position
+#
+def populate(cache, sizes, layout=LAYOUT_FULL, seed=1):
+    """
+    Caches random duplexes of targets of the given sizes.
+    """
+
+    rng = random.Random(seed)
+
+    cache.hset(str(NAMESPACE + ":layout"), OPT_LAYOUT, layout)
+
+    pipe = cache.pipeline(transaction=False)
+    line_number = 1
+
+    for x, size in enumerate(sizes):
+
+        anchors = [rng.randint(1, 5000) for y in range(max(size // 8, 1))]
+
+        for y in range(size):
+            start = rng.choice(anchors) + rng.choice([
+                0, SEED_MIN_DISTANCE - 1, SEED_MIN_DISTANCE, SEED_MIN_DISTANCE + 1,
+                SEED_MAX_DISTANCE - 1, SEED_MAX_DISTANCE, SEED_MAX_DISTANCE + 1,
+                rng.randint(0, 100)])
+
+            microrna_org.cache_duplex(pipe, NAMESPACE, layout, {
+                microrna_org.TRANSCRIPT_ID: "uc%06d.1" % x,
+                microrna_org.TRANSCRIPT_ID_EXT: "NM_%06d" % rng.randint(0, size),
+                microrna_org.ALIGNMENT_GENE_START: str(start),
+            }, line_number)
+
+            line_number += 1
+
+    pipe.execute()
+
+
+
+@pytest.fixture(name="populate")
+def populate_fixture():
+    """
+    Returns the function caching random duplexes.
+    """
+
+    return populate
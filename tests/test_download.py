@@ -0,0 +1,240 @@
+#
+# tests of the resumable downloads of namespace source files, against a local
+# HTTP stand-in
+#
+
+
+import hashlib
+import os
+import random
+import threading
+
+import download
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# content of the stand-in source file
+CONTENT = bytes(random.Random(1).choices(range(256), k=100000))
+
+# bytes already downloaded by an interrupted download
+PARTIAL = 30000
+
+
+
+# HTTP stand-in of a source file server. The first path component selects
+# how requests with a Range header are answered:
+# - range:  a 206 response from the requested offset
+# - ignore: a 200 response with the whole file
+# - before: a 206 response from 1000 bytes before the requested offset
+# - after:  a 206 response from 1000 bytes after the requested offset
+# - drop:   as range, but the first response is cut halfway
+#
+class SourceHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in of a source file server.
+    """
+
+    requests = []
+
+    def do_GET(self):
+        mode = self.path.split("/")[1]
+        requested = self.headers.get("Range")
+        SourceHandler.requests.append(requested)
+
+        start = 0
+        if requested and mode != "ignore":
+            start = int(requested[len("bytes="):-1])
+            start += {"before": -1000, "after": 1000}.get(mode, 0)
+
+        body = CONTENT[start:]
+
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range",
+                "bytes %d-%d/%d" % (start, len(CONTENT) - 1, len(CONTENT)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if mode == "drop" and len(SourceHandler.requests) == 1:
+            body = body[:(len(body) // 2)]
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+# URL of the stand-in source file server, whose received Range headers are
+# recorded in SourceHandler.requests
+#
+@pytest.fixture
+def server_url():
+    """
+    Starts the stand-in source file server, and returns its URL.
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SourceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    SourceHandler.requests = []
+
+    yield "http://127.0.0.1:%d/" % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+
+# write the partial file of an interrupted download of the given file
+#
+def write_partial(path):
+    """
+    Writes the first PARTIAL bytes of the source file as a partial download.
+    """
+
+    with open(str(path) + download.DOWNLOAD_EXT_PART, 'wb') as dst:
+        dst.write(CONTENT[:PARTIAL])
+
+
+
+# a partial download is resumed with a Range request, and all its chunks are
+# streamed from the beginning of the file. The complete download is verified
+# and recorded
+#
+def test_stream_resumes_partial_download(server_url, tmp_path):
+    """
+    Resumes an interrupted download.
+    """
+
+    path = tmp_path.joinpath("source.tsv")
+    write_partial(path)
+
+    chunks = list(download.stream(server_url + "range/source.tsv", path,
+        hashlib.sha256(CONTENT).hexdigest()))
+
+    assert b"".join(chunks) == CONTENT
+    assert SourceHandler.requests == ["bytes=%d-" % PARTIAL]
+    assert path.read_bytes() == CONTENT
+    assert not os.path.exists(str(path) + download.DOWNLOAD_EXT_PART)
+    assert download.read_meta(path)["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+    assert download.is_cached(path)
+
+
+
+# responses of servers which ignore the Range request, or return the bytes
+# preceding it too, skip the bytes that were already downloaded
+#
+@pytest.mark.parametrize("mode", ["ignore", "before"])
+def test_stream_skips_downloaded_bytes(server_url, tmp_path, mode):
+    """
+    Resumes a download from a server which does not honor the requested
+    range.
+    """
+
+    path = tmp_path.joinpath("source.tsv")
+    write_partial(path)
+
+    chunks = list(download.stream(server_url + mode + "/source.tsv", path))
+
+    assert b"".join(chunks) == CONTENT
+    assert path.read_bytes() == CONTENT
+
+
+
+# a response which would leave a gap in the file is an error
+#
+def test_stream_rejects_range_after_downloaded_bytes(server_url, tmp_path):
+    """
+    Fails a download whose response starts after the downloaded bytes.
+    """
+
+    path = tmp_path.joinpath("source.tsv")
+    write_partial(path)
+
+    with pytest.raises(download.DownloadError):
+        list(download.stream(server_url + "after/source.tsv", path))
+
+    assert not path.exists()
+
+
+
+# a dropped connection is resumed from the bytes received so far
+#
+def test_stream_resumes_dropped_connection(server_url, tmp_path, monkeypatch):
+    """
+    Resumes a download whose connection dropped.
+    """
+
+    monkeypatch.setattr(download.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(download, "DOWNLOAD_CHUNK", 1000)
+
+    path = tmp_path.joinpath("source.tsv")
+
+    chunks = list(download.stream(server_url + "drop/source.tsv", path))
+
+    assert b"".join(chunks) == CONTENT
+    assert path.read_bytes() == CONTENT
+    assert SourceHandler.requests[0] is None
+    assert SourceHandler.requests[1] == "bytes=%d-" % (len(CONTENT) // 2)
+    assert len(SourceHandler.requests) == 2
+
+
+
+# a download which does not match the expected checksum is dropped
+#
+def test_stream_checksum_mismatch(server_url, tmp_path):
+    """
+    Fails a download whose checksum does not match the expected one.
+    """
+
+    path = tmp_path.joinpath("source.tsv")
+    write_partial(path)
+
+    with pytest.raises(download.DownloadError):
+        list(download.stream(server_url + "range/source.tsv", path, "0" * 64))
+
+    assert not path.exists()
+    assert not os.path.exists(str(path) + download.DOWNLOAD_EXT_PART)
+    assert not download.is_cached(path)
+
+
+
+# a complete download is only hashed again when its size or modification time
+# change, and is no longer trusted when its content changes
+#
+def test_is_cached_hashes_changed_files_only(server_url, tmp_path, monkeypatch):
+    """
+    Trusts the recorded checksum of an unchanged download.
+    """
+
+    path = tmp_path.joinpath("source.tsv")
+    list(download.stream(server_url + "range/source.tsv", path))
+
+    hashed = []
+    checksum = download.checksum
+    monkeypatch.setattr(download, "checksum",
+        lambda path: hashed.append(path) or checksum(path))
+
+    assert download.is_cached(path)
+    assert download.get_checksum(path) == hashlib.sha256(CONTENT).hexdigest()
+    assert not hashed
+
+    # same content, different modification time
+    # ==> hashed once, then trusted again
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert download.is_cached(path)
+    assert download.is_cached(path)
+    assert len(hashed) == 1
+
+    # different content, same size
+    path.write_bytes(CONTENT[::-1])
+
+    assert not download.is_cached(path)
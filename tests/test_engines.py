@@ -0,0 +1,101 @@
+#
+# tests of the duplex-pair comparison engines
+#
+
+
+import random
+
+import microrna_org
+from common import *
+
+
+
+# return the duplex pairs found by the given engine
+#
+def get_pairs(engine, duplex_starts, first=0, last=None):
+    """
+    Returns the sorted duplex pairs found by the given engine.
+    """
+
+    return sorted(engine(duplex_starts, first, last))
+
+
+
+# duplexes binding exactly SEED_MIN_DISTANCE and SEED_MAX_DISTANCE nt. apart
+# are paired, those one nt. closer or farther are not
+#
+def test_sweep_range_bounds():
+    """
+    The sweep engine keeps the duplex pairs binding within the inclusive
+    seed distance range.
+    """
+
+    duplex_starts = [
+        ("d0", 100),
+        ("d1", 100 + SEED_MIN_DISTANCE - 1),
+        ("d2", 100 + SEED_MIN_DISTANCE),
+        ("d3", 100 + SEED_MAX_DISTANCE),
+        ("d4", 100 + SEED_MAX_DISTANCE + 1),
+    ]
+
+    pairs = get_pairs(microrna_org.duplex_pairs_by_sweep, duplex_starts)
+
+    assert ("d0", "d2", SEED_MIN_DISTANCE) in pairs
+    assert ("d0", "d3", SEED_MAX_DISTANCE) in pairs
+    assert ("d0", "d1", SEED_MIN_DISTANCE - 1) not in pairs
+    assert ("d0", "d4", SEED_MAX_DISTANCE + 1) not in pairs
+    assert pairs == get_pairs(microrna_org.duplex_pairs_by_combinations, duplex_starts)
+
+
+
+# the sweep engine finds the same pairs as the brute-force engine, on random
+# duplexes with ties at the same position, and at both bounds of the range
+#
+def test_sweep_matches_combinations():
+    """
+    The sweep and combinations engines find the same duplex pairs.
+    """
+
+    rng = random.Random(1)
+
+    for trial in range(300):
+
+        anchors = [rng.randint(0, 500) for x in range(rng.randint(1, 6))]
+
+        duplex_starts = [
+            ("duplex:line%d" % x, rng.choice(anchors) + rng.choice([
+                0, SEED_MIN_DISTANCE - 1, SEED_MIN_DISTANCE, SEED_MIN_DISTANCE + 1,
+                SEED_MAX_DISTANCE - 1, SEED_MAX_DISTANCE, SEED_MAX_DISTANCE + 1,
+                rng.randint(0, 60)]))
+            for x in range(rng.randint(0, 60))
+        ]
+        rng.shuffle(duplex_starts)
+
+        assert get_pairs(microrna_org.duplex_pairs_by_sweep, duplex_starts) == \
+            get_pairs(microrna_org.duplex_pairs_by_combinations, duplex_starts)
+
+
+
+# the ranges of a split target (see scheduler) find the pairs of the whole
+# target, with both engines
+#
+def test_ranges_match_whole_target():
+    """
+    The duplex pairs of the ranges of a target are those of the whole target.
+    """
+
+    rng = random.Random(2)
+
+    duplex_starts = [
+        ("duplex:line%d" % x, rng.randint(0, 400)) for x in range(200)
+    ]
+
+    bounds = [0] + sorted(rng.sample(range(1, 200), 6)) + [200]
+
+    for engine in microrna_org.comparison_engines.values():
+
+        pairs = []
+        for first, last in zip(bounds, bounds[1:]):
+            pairs += get_pairs(engine, duplex_starts, first, last)
+
+        assert sorted(pairs) == get_pairs(engine, duplex_starts)
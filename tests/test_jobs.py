@@ -0,0 +1,144 @@
+#
+# tests of the distribution of filtrate to workers on other hosts
+#
+
+
+import multiprocessing
+import os
+import signal
+import time
+
+import jobs
+import microrna_org
+import pairstore
+import pytest
+import scheduler
+import storage
+from cli import *
+from common import *
+from conftest import NAMESPACE
+
+
+# target sizes: a large target is split across units by the scheduler
+SIZES = [200, 30, 20, 10, 5, 1]
+
+# seconds to wait for the workers to register their heartbeat
+WORKERS_STARTUP = 20
+
+
+
+# run the worker mode against the given cache, with one process, until
+# interrupted
+#
+def serve(redis_url):
+    """
+    Runs the jobs published on the given cache.
+    """
+
+    launch = {
+        MICRORNA_ORG: {
+            OPT_FILTRATE: microrna_org.compare_targets,
+        }
+    }
+
+    jobs.serve(storage.connect(redis_url), {
+        OPT_DB: redis_url,
+        OPT_EXE: "1",
+        OPT_REF: None,
+        OPT_ANNOTATIONS: None,
+    }, launch)
+
+
+
+# run filtrate with the given number of local processes, published to the
+# workers if requested, and return the cached duplex pairs, target genes, and
+# targets with duplex pairs within range
+#
+def filtrate(cache, redis_url, exe, publish):
+    """
+    Returns the results of filtrate.
+    """
+
+    microrna_org.filtrate(cache, {
+        OPT_NAMESPACE: "test",
+        OPT_DB: redis_url,
+        OPT_EXE: str(exe),
+        OPT_BATCH: "10",
+        OPT_ENGINE: ENGINE_SWEEP,
+        OPT_SCHEDULE: SCHEDULE_COST,
+        OPT_PAIRS: PAIRS_PACKED,
+        OPT_PUBLISH: publish,
+    })
+
+    return {
+        "targets": cache.smembers(str(NAMESPACE + ":targets:with_mirna_pair_in_allowed_binding_range")),
+        "genes": cache.smembers(str(NAMESPACE + ":target" + ":genes")),
+        "packed": {
+            key: sorted(pairstore.unpack(value).tolist())
+            for key, value in storage.raw(cache).hgetall(pairstore.get_key(NAMESPACE)).items()
+        },
+    }
+
+
+
+# a coordinator without local processes hands all its work over to two
+# workers, which leave no heartbeat once interrupted
+#
+def test_workers_complete_published_filtrate(cache, redis_url, populate):
+    """
+    Workers run the filtrate job published by a coordinator.
+    """
+
+    populate(cache, SIZES)
+    expected = filtrate(cache, redis_url, 1, False)
+
+    cache.flushall()
+    populate(cache, SIZES)
+
+    workers = [
+        multiprocessing.Process(target=serve, args=(redis_url,))
+        for x in range(2)
+    ]
+    [p.start() for p in workers]
+
+    try:
+        time_start = time.time()
+        while len(jobs.get_workers(cache)) < len(workers):
+            assert time.time() - time_start < WORKERS_STARTUP
+            time.sleep(0.1)
+
+        assert jobs.get_capacity(cache) == len(workers)
+
+        result = filtrate(cache, redis_url, 0, True)
+
+    finally:
+        [os.kill(p.pid, signal.SIGTERM) for p in workers]
+        [p.join() for p in workers]
+        [p.close() for p in workers]
+
+    assert expected["packed"]
+    assert result == expected
+
+    assert not cache.exists(jobs.JOBS_KEY)
+    assert not cache.exists(jobs.JOBS_WORKERS)
+    assert not cache.keys(jobs.get_running_key("*"))
+
+
+
+# a coordinator without local processes nor live workers fails instead of
+# waiting forever for its queue to drain
+#
+def test_published_filtrate_without_workers(cache, redis_url, populate, monkeypatch):
+    """
+    A published job fails when no worker is left to run it.
+    """
+
+    monkeypatch.setattr(jobs, "JOBS_TIMEOUT", 1)
+
+    populate(cache, SIZES)
+
+    with pytest.raises(SystemExit):
+        filtrate(cache, redis_url, 0, True)
+
+    assert not cache.exists(jobs.JOBS_KEY)
+    assert cache.llen(scheduler.get_key(NAMESPACE))
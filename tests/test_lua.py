@@ -0,0 +1,165 @@
+#
+# tests of the server-side (lua) and vectorized (numpy) filtrate engines,
+# against the sweep engine
+#
+
+
+import logging
+
+import microrna_org
+import pairstore
+import pytest
+import scheduler
+import storage
+from cli import *
+from common import *
+from conftest import NAMESPACE
+
+
+
+# target sizes: a large target is split across units by the scheduler
+SIZES = [300, 40, 25, 12, 3, 1, 0]
+
+
+
+# compare the duplexes of all targets with the given engine, in this process
+# (over the scheduled units of the targets, except with the numpy engine,
+# which compares all targets at once), and return the duplex pairs (listed, and packed), target genes, and targets
+# with duplex pairs within range
+#
+def filtrate(cache, populate, engine, layout):
+    """
+    Returns the results of filtrate with the given engine.
+    """
+
+    cache.flushall()
+    populate(cache, SIZES, layout)
+
+    options = {
+        OPT_NAMESPACE: "test",
+        OPT_BATCH: "10",
+        OPT_ENGINE: engine,
+        OPT_SCHEDULE: SCHEDULE_COST,
+        OPT_PAIRS: PAIRS_BOTH,
+    }
+
+    if engine == ENGINE_NUMPY:
+        microrna_org.generate_allowed_comparisons_vectorized(cache, options)
+
+    else:
+        assert scheduler.schedule(cache, NAMESPACE, 4, 10) > 0
+        assert any(scheduler.RANGE_SEPARATOR in unit
+            for unit in cache.lrange(scheduler.get_key(NAMESPACE), 0, -1))
+
+        worker = microrna_org.generate_allowed_comparisons
+        if engine == ENGINE_LUA:
+            worker = microrna_org.generate_allowed_comparisons_lua
+
+        worker(cache, options, 0)
+        scheduler.merge(cache, NAMESPACE)
+
+    targets = cache.smembers(str(NAMESPACE + ":targets:with_mirna_pair_in_allowed_binding_range"))
+
+    # listed pairs are pushed as (duplex1, duplex2) at the head of the list
+    listed = {}
+    for target in targets:
+        values = cache.lrange(str(target + ":with_mirna_pair_in_allowed_binding_range"), 0, -1)[::-1]
+        listed[target] = sorted(zip(values[0::2], values[1::2]))
+
+    packed = {
+        key.decode("utf-8"): sorted(pairstore.unpack(value).tolist())
+        for key, value in storage.raw(cache).hgetall(pairstore.get_key(NAMESPACE)).items()
+    }
+
+    return {
+        "targets": targets,
+        "genes": cache.smembers(str(NAMESPACE + ":target" + ":genes")),
+        "listed": listed,
+        "packed": packed,
+    }
+
+
+
+# the lua engine caches the same results as the sweep engine, with both
+# cache layouts, including the ranges of split targets
+#
+@pytest.mark.parametrize("layout", [LAYOUT_FULL, LAYOUT_LEAN])
+def test_lua_matches_sweep(cache, populate, layout):
+    """
+    The lua and sweep engines cache the same duplex pairs.
+    """
+
+    expected = filtrate(cache, populate, ENGINE_SWEEP, layout)
+    result = filtrate(cache, populate, ENGINE_LUA, layout)
+
+    assert expected["targets"]
+    assert result == expected
+
+
+
+# the numpy engine caches the same results as the sweep engine, with both
+# cache layouts, when reading the duplexes from the cache
+#
+@pytest.mark.parametrize("layout", [LAYOUT_FULL, LAYOUT_LEAN])
+def test_numpy_matches_sweep(cache, populate, monkeypatch, layout):
+    """
+    The numpy and sweep engines cache the same duplex pairs.
+    """
+
+    monkeypatch.setattr(microrna_org, "get_snapshot", lambda options: None)
+
+    expected = filtrate(cache, populate, ENGINE_SWEEP, layout)
+    result = filtrate(cache, populate, ENGINE_NUMPY, layout)
+
+    assert expected["targets"]
+    assert result == expected
+
+
+
+# the ranges of a split target count as one target with duplex pairs within
+# range, with both engines
+#
+@pytest.mark.parametrize("engine", [ENGINE_SWEEP, ENGINE_LUA])
+def test_split_targets_counted_once(cache, populate, caplog, engine):
+    """
+    The worker counts the targets with duplex pairs within range once.
+    """
+
+    caplog.set_level(logging.INFO, logger="microrna.org")
+
+    result = filtrate(cache, populate, engine, LAYOUT_FULL)
+
+    found = [
+        int(record.getMessage().split("Found ")[1].split()[0])
+        for record in caplog.records
+        if "targets with miRNA pairs binding within range" in record.getMessage()
+    ]
+
+    assert found == [len(result["targets"])]
+
+
+
+# the worker reads the duplexes of a whole chunk of targets at once, in a
+# constant number of round trips
+#
+def test_round_trips_per_claim(cache, populate, caplog):
+    """
+    The worker performs a constant number of round trips per claimed chunk.
+    """
+
+    # the first claim also loads the claim script in redis
+    filtrate(cache, populate, ENGINE_SWEEP, LAYOUT_LEAN)
+
+    caplog.clear()
+    caplog.set_level(logging.INFO, logger="microrna.org")
+
+    filtrate(cache, populate, ENGINE_SWEEP, LAYOUT_LEAN)
+
+    # claim, duplexes, duplex fields, and results
+    most = [
+        int(record.getMessage().split("(")[1].split()[0])
+        for record in caplog.records
+        if "at most per claim" in record.getMessage()
+    ]
+
+    assert most == [4]
@@ -0,0 +1,143 @@
+#
+# tests of the packed nucleotide sequences
+#
+
+
+import random
+
+import nucleotides
+import pytest
+from Bio.Seq import Seq
+
+
+
+# sequences with runs of exceptions (N, and other IUPAC codes, next to each
+# other and at both ends), soft-masked runs (over exceptions too), and lengths
+# that are not a multiple of 4 bases
+SEQUENCES = [
+    "",
+    "A",
+    "ACG",
+    "ACGTACGT",
+    "NNNNACGTNNNN",
+    "ACNNRRYNACGTN",
+    "acgtACGTnnnnACGTacg",
+    "NNacGTRykNNNtt",
+    "tttttttttt",
+]
+
+
+
+# return a random sequence of the given length, with runs of bases,
+# exceptions, and soft-masked bases
+#
+def get_sequence(rng, length):
+    """
+    Returns a random nucleotide sequence.
+    """
+
+    bases = []
+    while len(bases) < length:
+        base = rng.choice("ACGTACGTACGTNRY")
+        if rng.random() < 0.3:
+            base = base.lower()
+        bases.extend(base * rng.randint(1, 12))
+
+    return "".join(bases[:length])
+
+
+
+# return the reverse complement of the given sequence
+#
+def reverse_complement(sequence):
+    """
+    Returns the reverse complement of the given sequence.
+    """
+
+    return str(Seq(sequence).reverse_complement())
+
+
+
+# packed sequences are unpacked, and serialized and deserialized, as they
+# were, exceptions and soft-masked bases included
+#
+@pytest.mark.parametrize("sequence", SEQUENCES + [
+    get_sequence(random.Random(seed), 1000 + seed) for seed in range(5)])
+def test_pack_round_trip(sequence):
+    """
+    Packs and unpacks nucleotide sequences.
+    """
+
+    packed = nucleotides.PackedSequence.pack(sequence)
+
+    assert str(packed) == sequence
+    assert len(packed) == len(sequence)
+
+    unpacked = nucleotides.PackedSequence.from_bytes(packed.to_bytes())
+
+    assert str(unpacked) == sequence
+    assert unpacked.to_bytes() == packed.to_bytes()
+
+
+
+# exceptions of different bases are recorded as separate runs, and bases
+# packed in their place are restored
+#
+def test_exception_runs():
+    """
+    Records the runs of exceptions of the same base.
+    """
+
+    packed = nucleotides.PackedSequence.pack("ANNRRNAnn")
+
+    starts, ends, bases = packed.exceptions
+
+    assert list(starts) == [1, 3, 5, 7]
+    assert list(ends) == [3, 5, 6, 9]
+    assert bases == b"NRNN"
+    assert list(packed.masks[0]) == [7]
+    assert list(packed.masks[1]) == [9]
+    assert str(packed) == "ANNRRNAnn"
+
+
+
+# slices, reverse complements, and transcripts are views, whose bases
+# (exceptions and soft-masked bases included) are those of the unpacked
+# sequence, at any offset and in any order
+#
+def test_views():
+    """
+    Slices, reverse-complements, and transcribes packed sequences.
+    """
+
+    rng = random.Random(1)
+    sequence = get_sequence(rng, 500)
+    packed = nucleotides.PackedSequence.pack(sequence)
+
+    for x in range(200):
+        start = rng.randint(-20, 520)
+        end = rng.randint(-20, 520)
+
+        view = packed[start:end]
+        assert str(view) == sequence[start:end]
+        assert view.data is packed.data
+
+        # reverse complement of a slice, and slice of a reverse complement
+        assert str(view.reverse_complement()) == reverse_complement(sequence[start:end])
+        assert str(packed.reverse_complement()[start:end]) == \
+            reverse_complement(sequence)[start:end]
+
+        # back to the forward strand
+        assert str(view.reverse_complement().reverse_complement()) == sequence[start:end]
+
+        # serialized views are packed on their own
+        assert str(nucleotides.PackedSequence.from_bytes(
+            view.reverse_complement().to_bytes())) == reverse_complement(sequence[start:end])
+
+    assert str(packed.transcribe()[10:60]) == sequence[10:60].replace("T", "U").replace("t", "u")
+    assert str(packed[::3]) == sequence[::3]
+    assert packed[7] == sequence[7]
+    assert packed[-1] == sequence[-1]
+
+    with pytest.raises(IndexError):
+        packed[len(sequence)]
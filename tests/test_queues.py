@@ -0,0 +1,50 @@
+#
+# tests of the reliable work queues, on all supported databases
+#
+
+
+import pytest
+import queues
+
+
+
+# items whose lease expired are claimed again, unless completed, while items
+# whose lease is still running are not
+#
+@pytest.mark.parametrize("ordered", [False, True])
+def test_claim_expired_leases(any_cache, ordered):
+    """
+    Claims the pending items, and the claimed items whose lease expired.
+    """
+
+    queue = "test:queue"
+    items = ["a", "b", "c", "d"]
+
+    if ordered:
+        any_cache.lpush(queue, *reversed(items))
+    else:
+        any_cache.sadd(queue, *items)
+
+    leases, done = queues.get_keys(queue)
+
+    # expired leases
+    expired = queues.claim(any_cache, queue, 2, lease=-1, ordered=ordered)
+    assert len(expired) == 2
+    assert any_cache.zcard(leases) == 2
+
+    queues.ack(any_cache, queue, expired[:1])
+    assert any_cache.zcard(leases) == 1
+
+    # running leases, on the pending items and the expired one
+    claimed = queues.claim(any_cache, queue, 10, ordered=ordered)
+    assert sorted(claimed) == sorted(set(items) - set(expired[:1]))
+    if ordered:
+        assert claimed[0] == expired[1]
+
+    assert queues.claim(any_cache, queue, 10, ordered=ordered) == []
+    assert any_cache.exists(leases)
+
+    # leases of an interrupted run
+    assert queues.recover(any_cache, queue, ordered=ordered) == len(claimed)
+    assert not any_cache.exists(leases)
+    assert sorted(queues.claim(any_cache, queue, 10, ordered=ordered)) == sorted(claimed)
@@ -0,0 +1,58 @@
+#
+# tests of the non-redis intermediate results databases, against redis
+#
+
+
+import pytest
+import storage
+
+
+
+# list ranges, with both positive and negative indexes, in and out of bounds
+RANGES = [
+    (0, -1), (0, 0), (2, 5), (3, 100), (100, 200), (5, 2),
+    (-3, -1), (-100, 2), (-2, -5), (1, -2), (0, -100), (-1, 0),
+]
+
+
+
+# the non-redis databases return the same list ranges as redis
+#
+@pytest.mark.parametrize("url", [storage.STORAGE_MEMORY, storage.STORAGE_SQLITE])
+def test_lrange_matches_redis(cache, tmp_path, url):
+    """
+    Returns list ranges as redis does.
+    """
+
+    if url == storage.STORAGE_SQLITE:
+        url += "/" + str(tmp_path.joinpath("cache.db"))
+
+    other = storage.connect(url)
+
+    values = [str(x) for x in range(10)]
+    cache.lpush("list", *values)
+    other.lpush("list", *values)
+
+    for start, end in RANGES:
+        assert other.lrange("list", start, end) == cache.lrange("list", start, end), (start, end)
+
+    assert other.lrange("missing", 0, -1) == []
+
+
+
+# fields are read individually, including missing and repeated fields, and
+# fields beyond the number of variables of one SQLite query
+#
+def test_hmget(any_cache):
+    """
+    Returns the requested fields of a hash.
+    """
+
+    fields = {"field%d" % x: str(x) for x in range(2000)}
+    any_cache.hset("hash", mapping=fields)
+
+    keys = ["field1999", "missing", "field0", "field0"] + sorted(fields)
+
+    assert any_cache.hmget("hash", keys) == [fields.get(key) for key in keys]
+    assert any_cache.hmget("hash", "field5", "field6") == ["5", "6"]
+    assert any_cache.hmget("missing", ["field0"]) == [None]
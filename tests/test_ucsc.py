@@ -0,0 +1,373 @@
+#
+# tests of the UCSC crawl functions, against local stand-ins of the UCSC
+# MySQL interface and DAS server
+#
+
+
+import sqlite3
+import threading
+import time
+
+import pymysql
+import pytest
+import ucsc
+from common import *
+from Bio.SeqRecord import SeqRecord
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+
+# genomic locations of the stand-in refGene table: (name, chrom, txStart,
+# txEnd, strand), 0-based starts as in the UCSC tables. NM_000003 has two
+# locations, NM_000004 is not linked to knownToRefSeq
+REFGENE = [
+    ("NM_000001", "chr1", 99, 200, "+"),
+    ("NM_000002", "chr1", 150, 260, "-"),
+    ("NM_000003", "chr2", 999, 1010, "+"),
+    ("NM_000003", "chr5", 9, 20, "+"),
+    ("NM_000004", "chrX", 0, 10, "+"),
+]
+
+
+
+# DB-API stand-in of a UCSC MySQL connection, backed by an in-memory SQLite
+# database. Each executed query is recorded
+#
+class Connection(object):
+    """
+    Stand-in of a pymysql connection to a UCSC genome build database.
+    """
+
+    def __init__(self, error=None):
+        self.db = sqlite3.connect(":memory:")
+        self.db.executescript("""
+            create table refGene(name, chrom, txStart int, txEnd int, strand);
+            create table knownToRefSeq(name, value);
+        """)
+        self.db.executemany("insert into refGene values (?, ?, ?, ?, ?)", REFGENE)
+        self.db.executemany("insert into knownToRefSeq values (?, ?)", [
+            ("uc" + name, name) for name, chrom, start, end, strand in REFGENE
+            if name != "NM_000004"
+        ])
+        self.error = error
+        self.queries = []
+
+    def cursor(self):
+        return Cursor(self)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        pass
+
+
+
+class Cursor(object):
+    """
+    Stand-in of a pymysql cursor.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query, args=()):
+        if self.connection.error:
+            raise self.connection.error
+        self.connection.queries.append(list(args))
+        self.rows = self.connection.db.execute(
+            query.replace("%s", "?"), list(args)).fetchall()
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+
+# return a record of the given RefSeq ID and genome build, as annotate
+# creates them
+#
+def get_record(refseq, genome="hg19"):
+    """
+    Returns a record of the given RefSeq ID.
+    """
+
+    bio_seq = SeqRecord(seq="", id=refseq)
+    bio_seq.annotations[REF_GENOME] = genome
+
+    return bio_seq
+
+
+
+# connection of the stand-in UCSC MySQL interface, used by the crawl
+# functions of the test
+#
+@pytest.fixture
+def connection(monkeypatch):
+    """
+    Returns the stand-in connection used by ucsc.genomic_coordinates.
+    """
+
+    connection = Connection()
+    monkeypatch.setattr(ucsc, "get_connection", lambda database: connection)
+
+    return connection
+
+
+
+# records are resolved UCSC_BATCH at a time, with one query per batch, and
+# keep the first location of their RefSeq ID
+#
+def test_genomic_coordinates_batches(connection, monkeypatch):
+    """
+    Resolves the records in batched queries.
+    """
+
+    monkeypatch.setattr(ucsc, "UCSC_BATCH", 2)
+
+    bio_seqs = [get_record("NM_00000%d" % x) for x in [1, 2, 3, 4, 1]] + [None]
+
+    result = ucsc.genomic_coordinates(bio_seqs, 0)
+
+    assert len(connection.queries) == 3
+    assert [sorted(query) for query in connection.queries] == \
+        [["NM_000001", "NM_000002"], ["NM_000003", "NM_000004"], ["NM_000001"]]
+
+    assert result[0].annotations[REF_CHR] == "chr1"
+    assert result[0].annotations[REF_TX_START] == 100
+    assert result[0].annotations[REF_TX_END] == 200
+    assert result[1].annotations[REF_STRAND] == "-"
+    assert result[2].annotations[REF_CHR] in ("chr2", "chr5")
+    assert result[3] is None
+    assert result[4].annotations[REF_TX_START] == 100
+    assert result[5] is None
+
+
+
+# failed queries leave their records unresolved, or are raised if strict
+#
+def test_genomic_coordinates_errors(monkeypatch):
+    """
+    Handles the errors of the UCSC MySQL interface.
+    """
+
+    connection = Connection(pymysql.OperationalError(2013, "Lost connection"))
+    monkeypatch.setattr(ucsc, "get_connection", lambda database: connection)
+
+    bio_seqs = [get_record("NM_000001"), get_record("NM_000002")]
+
+    assert ucsc.genomic_coordinates(bio_seqs, 0) == [None, None]
+
+    with pytest.raises(pymysql.Error):
+        ucsc.genomic_coordinates(bio_seqs, 0, strict=True)
+
+
+
+# return the base of the stand-in genome at the given 1-based position
+#
+def get_base(chromosome, position):
+    """
+    Returns the base of the stand-in genome at the given position.
+    """
+
+    return "acgt"[(position * 7 + len(chromosome) + position // 3) % 4]
+
+
+
+# HTTP stand-in of the UCSC DAS server, answering each request with the
+# sequences of its segments, split over several lines as the DAS server
+# does. Requests of the genome build "fail" are answered with an error
+#
+class DASHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in of the UCSC DAS server.
+    """
+
+    requests = []
+
+    def do_GET(self):
+        path, query = self.path.split("?", 1)
+        segments = unquote(query).split(";")
+        DASHandler.requests.append(segments)
+
+        if "/fail/" in path:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = ['<?xml version="1.0" standalone="no"?>\n<DASDNA>\n']
+        for segment in segments:
+            chromosome, bounds = segment[len("segment="):].split(SEPARATOR)
+            start, end = [int(x) for x in bounds.split(ucsc.DAS_SEPARATOR)]
+            sequence = "".join(get_base(chromosome, x) for x in range(start, end + 1))
+            body.append(
+                '<SEQUENCE id="%s" start="%d" stop="%d" version="1.00">\n'
+                '<DNA length="%d">\n%s\n</DNA>\n</SEQUENCE>\n' % (
+                    chromosome, start, end, len(sequence),
+                    "\n".join(sequence[x:(x + 50)] for x in range(0, len(sequence), 50))))
+        body.append("</DASDNA>\n")
+        body = "".join(body).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+# stand-in DAS server, used by the crawl functions of the test
+#
+@pytest.fixture
+def das(monkeypatch):
+    """
+    Starts the stand-in DAS server, and returns the requests it receives.
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DASHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    DASHandler.requests = []
+    monkeypatch.setattr(ucsc, "DAS_HOST",
+        "http://127.0.0.1:%d/das/" % server.server_address[1])
+
+    yield DASHandler.requests
+
+    server.shutdown()
+    server.server_close()
+
+
+
+# return a record of the given genomic range, as annotated by
+# genomic_coordinates
+#
+def get_located_record(refseq, chromosome, start, end, genome="hg19"):
+    """
+    Returns a record of the given genomic range.
+    """
+
+    bio_seq = get_record(refseq, genome)
+    bio_seq.annotations[REF_CHR]      = chromosome
+    bio_seq.annotations[REF_TX_START] = start
+    bio_seq.annotations[REF_TX_END]   = end
+    bio_seq.annotations[REF_STRAND]   = "+"
+
+    return bio_seq
+
+
+
+# the sequences of several segments are parsed from one streamed response
+#
+def test_get_das_sequences(das):
+    """
+    Parses the sequences of all segments of a DAS response.
+    """
+
+    segments = [("chr1", 1, 120), ("chr2", 50, 60), ("chrX", 7, 7)]
+
+    result = ucsc.get_das_sequences("hg19", segments)
+
+    assert len(das) == 1
+    assert result == {
+        (chromosome, start, end):
+            "".join(get_base(chromosome, x) for x in range(start, end + 1))
+        for chromosome, start, end in segments
+    }
+
+
+
+# overlapping and adjacent ranges are merged in one segment, and requested
+# DAS_BATCH segments at a time. Each record gets its own range
+#
+def test_genomic_sequence_segments(das, monkeypatch):
+    """
+    Retrieves the sequences of the records through merged segments.
+    """
+
+    monkeypatch.setattr(ucsc, "DAS_BATCH", 2)
+
+    bio_seqs = [
+        get_located_record("NM_000001", "chr1", 100, 200),
+        get_located_record("NM_000002", "chr1", 150, 260),
+        get_located_record("NM_000003", "chr1", 261, 300),
+        get_located_record("NM_000004", "chr1", 400, 450),
+        get_located_record("NM_000005", "chr2", 10, 20),
+        None,
+    ]
+
+    assert [segment[:4] for segment in ucsc.get_segments(bio_seqs)] == [
+        ("hg19", "chr1", 100, 300),
+        ("hg19", "chr1", 400, 450),
+        ("hg19", "chr2", 10, 20),
+    ]
+
+    result = ucsc.genomic_sequence(bio_seqs, 0)
+
+    assert [len(segments) for segments in das] == [2, 1]
+    assert result[5] is None
+
+    for bio_seq in result[:5]:
+        assert str(bio_seq.seq) == "".join(
+            get_base(bio_seq.annotations[REF_CHR], x) for x in range(
+                bio_seq.annotations[REF_TX_START],
+                bio_seq.annotations[REF_TX_END] + 1))
+
+
+
+# failed requests leave their records without sequence, or are raised if
+# strict
+#
+def test_genomic_sequence_errors(das):
+    """
+    Handles the errors of the DAS server.
+    """
+
+    bio_seqs = [get_located_record("NM_000001", "chr1", 100, 200, "fail")]
+
+    assert ucsc.genomic_sequence(bio_seqs, 0) == [None]
+
+    with pytest.raises(ucsc.requests.HTTPError):
+        ucsc.genomic_sequence(bio_seqs, 0, strict=True)
+
+
+
+# each MySQL query and each DAS request takes a token of the rate limit of
+# the process, however many crawl steps send them
+#
+def test_requests_rate_limited(connection, das, monkeypatch):
+    """
+    Takes a token of the rate limit per UCSC request.
+    """
+
+    monkeypatch.setattr(ucsc, "UCSC_BATCH", 2)
+    monkeypatch.setattr(ucsc, "DAS_BATCH", 1)
+
+    bucket = ucsc.limit(20)
+
+    try:
+        time_start = time.monotonic()
+
+        ucsc.genomic_coordinates([get_record("NM_00000%d" % x) for x in [1, 2, 3]], 0)
+        ucsc.genomic_sequence([
+            get_located_record("NM_000001", "chr1", 100, 200),
+            get_located_record("NM_000002", "chr2", 100, 200),
+        ], 0)
+
+        time_elapsed = time.monotonic() - time_start
+
+    finally:
+        ucsc.limit(None)
+
+    assert bucket.taken == len(connection.queries) + len(das) == 4
+
+    # the first token is available at once, the others every 1/20 seconds
+    assert time_elapsed >= 3 / 20
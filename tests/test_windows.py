@@ -0,0 +1,131 @@
+#
+# tests of the binding-site windows fetched by annotate with --window
+#
+
+
+import random
+
+import annotations
+import microrna_org
+import nucleotides
+import pytest
+from common import *
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+
+
+# return the base of the stand-in genome at the given 1-based position
+#
+def get_base(chromosome, position):
+    """
+    Returns the base of the stand-in genome at the given position.
+    """
+
+    return "acgtNACGT"[(position * 7 + len(chromosome) + position // 3) % 9]
+
+
+
+# return the retrieved record of the given window, with its sequence packed
+# if requested
+#
+def get_window_record(window, packed):
+    """
+    Returns the record of the given window, as retrieved by annotate.
+    """
+
+    chromosome, start, end, strand = window
+
+    sequence = "".join(get_base(chromosome, x) for x in range(start, end + 1))
+
+    bio_seq = SeqRecord(
+        nucleotides.PackedSequence.pack(sequence) if packed else Seq(sequence),
+        id=microrna_org.get_window_id(*window))
+    bio_seq.annotations[REF_CHR]      = chromosome
+    bio_seq.annotations[REF_TX_START] = start
+    bio_seq.annotations[REF_TX_END]   = end
+    bio_seq.annotations[REF_STRAND]   = strand
+
+    return bio_seq
+
+
+
+# the window of each candidate is sliced out of the merged windows which
+# cover it, whether their sequences are packed or not
+#
+@pytest.mark.parametrize("packed", [False, True])
+def test_candidate_sequences(packed):
+    """
+    Returns the sequence of the window of each candidate.
+    """
+
+    rng = random.Random(1)
+
+    candidates = {}
+    for x in range(200):
+        chromosome = rng.choice(["chr1", "chr2"])
+        start = rng.randint(1, 5000)
+        candidates["%d:%d" % (x, x + 1)] = (chromosome, start,
+            start + rng.randint(SEED_MIN_DISTANCE, 200), rng.choice("+-"))
+
+    windows = microrna_org.merge_windows(candidates.values())
+
+    assert len(windows) < len(candidates)
+
+    result = microrna_org.get_candidate_sequences(
+        dict(
+            (candidate, microrna_org.get_window_id(*window))
+            for candidate, window in candidates.items()
+        ),
+        [get_window_record(window, packed) for window in windows])
+
+    assert set(result) == set(candidates)
+
+    for candidate, (chromosome, start, end, strand) in candidates.items():
+        assert str(nucleotides.PackedSequence.from_bytes(result[candidate])) == \
+            "".join(get_base(chromosome, x) for x in range(start, end + 1))
+
+
+
+# windows read back from the annotation cache keep their packed sequence,
+# which is sliced as it is
+#
+def test_annotation_cache_packed_windows(tmp_path):
+    """
+    Returns the sequences of the annotation cache packed.
+    """
+
+    candidates = {
+        "1:2": ("chr1", 100, 100 + SEED_MIN_DISTANCE, "+"),
+        "3:4": ("chr1", 110, 110 + SEED_MAX_DISTANCE, "+"),
+        "5:6": ("chr2", 400, 400 + SEED_MAX_DISTANCE, "-"),
+    }
+
+    windows = [
+        get_window_record(window, False)
+        for window in microrna_org.merge_windows(candidates.values())
+    ]
+    for bio_seq in windows:
+        bio_seq.annotations[REF_GENOME] = "hg19"
+
+    annotation_cache = annotations.AnnotationCache(2**20, tmp_path.joinpath("annotations.db"))
+    annotation_cache.put(windows)
+
+    annotated = annotation_cache.get("hg19", [bio_seq.id for bio_seq in windows])
+
+    assert set(annotated) == set(bio_seq.id for bio_seq in windows)
+    for bio_seq in windows:
+        assert isinstance(annotated[bio_seq.id].seq, nucleotides.PackedSequence)
+        assert str(annotated[bio_seq.id].seq) == str(bio_seq.seq)
+        assert len(annotated[bio_seq.id]) == len(bio_seq)
+
+    result = microrna_org.get_candidate_sequences(
+        dict(
+            (candidate, microrna_org.get_window_id(*window))
+            for candidate, window in candidates.items()
+        ),
+        list(annotated.values()))
+
+    for candidate, (chromosome, start, end, strand) in candidates.items():
+        assert str(nucleotides.PackedSequence.from_bytes(result[candidate])) == \
+            "".join(get_base(chromosome, x) for x in range(start, end + 1))
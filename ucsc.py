@@ -4,27 +4,45 @@
 
 
 import logging
+import metrics
+import os
 import pymysql
-import re
 import requests
-from bs4 import BeautifulSoup
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
 from common import *
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import IUPAC
 
 
-# UCSC MySQL interface
-UCSC_HOST = "genome-euro-mysql.soe.ucsc.edu"
-UCSC_USER = "genome"
-UCSC_PASS = None
-UCSC_PORT = 3306
+# UCSC MySQL interface (can be replaced by a local mirror through the
+# UCSC_HOST, UCSC_PORT, UCSC_USER, and UCSC_PASS environment variables)
+UCSC_HOST = os.environ.get("UCSC_HOST", "genome-euro-mysql.soe.ucsc.edu")
+UCSC_USER = os.environ.get("UCSC_USER", "genome")
+UCSC_PASS = os.environ.get("UCSC_PASS")
+UCSC_PORT = int(os.environ.get("UCSC_PORT", 3306))
 
+# number of RefSeq IDs resolved per query
+UCSC_BATCH = 500
 
-# UCSC DAS server
-DAS_HOST  = "http://genome.ucsc.edu/cgi-bin/das/"
+
+# UCSC DAS server (can be replaced by a local mirror through the UCSC_DAS
+# environment variable)
+DAS_HOST  = os.environ.get("UCSC_DAS", "http://genome.ucsc.edu/cgi-bin/das/")
 DAS_QUERY = "/dna?segment="
 DAS_SEPARATOR = ","
+DAS_SEGMENT_SEPARATOR = ";segment="
+
+# number of segments requested per DAS query, and maximum length of a
+# segment merged from several ranges
+DAS_BATCH = 100
+DAS_SEGMENT_MAX = 5000000
+DAS_TIMEOUT = 300
+
+# errors of failed UCSC requests (which can be retried)
+UCSC_ERRORS = (pymysql.Error, requests.RequestException, ElementTree.ParseError)
 
 
 # genomic attributes of a RefSeq identifier
@@ -37,117 +55,364 @@ logger = logging.getLogger("UCSC")
 
 
 
+# open MySQL connections (by genome build) and HTTP session of the current
+# thread. Each worker process, and each thread of a worker process, keeps its
+# own connections (connections cannot be shared by forked processes, nor used
+# by concurrent threads), and reuses them for all its queries
+local = threading.local()
+
+# all open MySQL connections of the current process, whatever their thread
+connections = []
+connections_lock = threading.Lock()
+connections_pid = None
+
+
+
+# return the connections and session of the current thread
+#
+def get_local():
+    """
+    Returns the MySQL connections and HTTP session of the current thread.
+    """
+
+    if getattr(local, "pid", None) != os.getpid():
+        local.pid = os.getpid()
+        local.connections = {}
+        local.session = None
+
+    return local
+
+
+
+# return an open connection of the current thread to the given genome build
+# database of the UCSC MySQL interface
+#
+def get_connection(database):
+    """
+    Returns a pooled connection of the current thread to the given UCSC
+    genome build database.
+    """
+
+    global connections_pid
+
+    thread_connections = get_local().connections
+    db = thread_connections.get(database)
+
+    if db is None:
+        db = pymysql.connect(host=UCSC_HOST, port=UCSC_PORT,
+            user=UCSC_USER, password=UCSC_PASS,
+            database=database)
+        thread_connections[database] = db
+
+        with connections_lock:
+            if connections_pid != os.getpid():
+                connections.clear()
+                connections_pid = os.getpid()
+            connections.append(db)
+
+    else:
+        db.ping(reconnect=True)
+
+    return db
+
+
+
+# close all connections of the current process
+#
+def close_connections():
+    """
+    Closes all pooled connections of the current process.
+    """
+
+    with connections_lock:
+        if connections_pid == os.getpid():
+            for db in connections:
+                try:
+                    db.close()
+                except pymysql.Error:
+                    pass
+
+        connections.clear()
+
+    get_local().connections.clear()
+
+
+
 # query the UCSC via MySQL interface to retrieve the genomic location of the
-# provided Bio.SeqRecord, given its RefSeq ID and genome build annotation.
-# Return the updated record as result. Updates are found in its annotations:
+# provided Bio.SeqRecords, given their RefSeq IDs and genome build
+# annotation. Records are resolved UCSC_BATCH at a time, with one query per
+# batch over a pooled connection, within the rate limit of the process (see
+# limit). The latency of each query is recorded in the "mysql_seconds"
+# histogram of the metrics.
+# Return the list of updated records (None for records that could not be
+# resolved), or raise the query errors if strict. Updates are found in their
+# annotations:
 # - chromosome location
 # - transcription start site (1-based counting)
 # - transcription end site
 # - strand
 #
-def genomic_coordinates(bio_seq, core):
+def genomic_coordinates(bio_seqs, core, strict=False):
     """
-    Returns an updated Bio.SeqRecord containing the provided RefSeq identifier
-    and genome build, chromosome, transcription start/end positions (1-based
-    counting) and strand.
+    Returns the list of the provided Bio.SeqRecords, updated with their
+    chromosome, transcription start/end positions (1-based counting) and
+    strand, given their RefSeq identifier and genome build (None for records
+    which could not be resolved).
     Relies on UCSC MySQL interface (genome.ucsc.edu/goldenpath/help/mysql.html).
     """
 
-    query = "select g.chrom, g.txStart, g.txEnd, g.strand \
-        from refGene g, knownToRefSeq r where g.name = '%s' \
-        AND r.value = g.name;"%(bio_seq.id)
+    result = [None] * len(bio_seqs)
+
+    # group the records by genome build, as each build has its own database
+    builds = {}
+    for x, bio_seq in enumerate(bio_seqs):
+        if bio_seq:
+            builds.setdefault(bio_seq.annotations[REF_GENOME], []).append(x)
+
+    for database, indexes in builds.items():
+        for first in range(0, len(indexes), UCSC_BATCH):
+
+            batch = indexes[first:(first + UCSC_BATCH)]
+            ids = sorted(set(bio_seqs[x].id for x in batch))
 
-    result = None
+            query = "select g.name, g.chrom, g.txStart, g.txEnd, g.strand \
+                from refGene g, knownToRefSeq r where g.name in (%s) \
+                AND r.value = g.name;"%(", ".join(["%s"] * len(ids)))
 
-    db = pymysql.connect(host=UCSC_HOST, port=UCSC_PORT,
-        user=UCSC_USER, password=UCSC_PASS,
-        database=bio_seq.annotations[REF_GENOME])
+            try:
+                throttle()
+                cursor = get_connection(database).cursor()
 
-    cursor = db.cursor()
+                with metrics.timer("mysql_seconds"):
+                    cursor.execute(query, ids)
+                    rows = cursor.fetchall()
 
-    try:
-        cursor.execute(query)
-        data = cursor.fetchone()
+                # keep the first location of each RefSeq ID
+                locations = {}
+                for data in rows:
+                    locations.setdefault(data[0], data[1:])
 
-        # initialize the Bio.SeqRecord object
-        result = bio_seq
+                cursor.close()
 
-        # update the annotations of the given Bio.SeqRecord object
-        result.annotations[REF_CHR]      = data[0]
-        result.annotations[REF_TX_START] = (data[1] + 1) # (1-based counting)
-        result.annotations[REF_TX_END]   = data[2]
-        result.annotations[REF_STRAND]   = data[3]
+            except pymysql.Error as error:
+                get_local().connections.pop(database, None)
+                metrics.count("annotate_mysql_errors")
+                if strict:
+                    raise
+                logger.error("  Worker %d:   Unable to query the UCSC MySQL interface: %s",
+                    core, str(error))
+                continue
 
-        logger.debug("  Worker %d:   Retrieved genomic location of target %s from UCSC",
-            core, bio_seq.id)
+            # fan the locations out to the records
+            for x in batch:
 
-    except:
-        logger.debug("  Worker %d:   Unable to fetch the genomic location of target %s from UCSC",
-            core, bio_seq.id)
+                bio_seq = bio_seqs[x]
+                data = locations.get(bio_seq.id)
 
-    db.close()
+                if not data:
+                    logger.debug("  Worker %d:   Unable to fetch the genomic location of target %s from UCSC",
+                        core, bio_seq.id)
+                    continue
+
+                # update the annotations of the given Bio.SeqRecord object
+                bio_seq.annotations[REF_CHR]      = data[0]
+                bio_seq.annotations[REF_TX_START] = (data[1] + 1) # (1-based counting)
+                bio_seq.annotations[REF_TX_END]   = data[2]
+                bio_seq.annotations[REF_STRAND]   = data[3]
+                metrics.count("annotate_located")
+
+                logger.debug("  Worker %d:   Retrieved genomic location of target %s from UCSC",
+                    core, bio_seq.id)
+
+                result[x] = bio_seq
 
     return result
 
 
 
-# update the sequence of the given Bio.SeqRecord.
+# return the HTTP session of the current thread, kept alive across all its
+# DAS queries
+#
+def get_session():
+    """
+    Returns the persistent HTTP session of the current thread.
+    """
+
+    thread = get_local()
+
+    if thread.session is None:
+        thread.session = requests.Session()
+
+    return thread.session
+
+
+
+# update the sequence of each given Bio.SeqRecord.
 # Use the UCSC DAS server (follows GenBank/EMBL 1-based counting).
+# The genomic ranges of all records are merged, when they overlap or are
+# adjacent on the same chromosome, and the merged ranges are requested
+# DAS_BATCH segments at a time over a persistent session. Each record's
+# sequence is then sliced out of its merged range.
+# Return the list of updated records (None for records whose sequence could
+# not be retrieved), or raise the request errors if strict
 #
-def genomic_sequence(bio_seq, core):
+def genomic_sequence(bio_seqs, core, strict=False):
     """
-    Updates the provided Bio.SeqRecord object with its genomic sequence.
+    Returns the list of the provided Bio.SeqRecords, updated with their
+    genomic sequences (None for records whose sequence could not be
+    retrieved).
     Relies on UCSC DAS server (http://genome.ucsc.edu/cgi-bin/das/), which
     follows the GenBank/EMBL 1-based counting,
     """
 
-    query = str(
-        DAS_HOST + bio_seq.annotations[REF_GENOME] +
-        DAS_QUERY + bio_seq.annotations[REF_CHR] +
-        SEPARATOR + str(bio_seq.annotations[REF_TX_START]) +
-        DAS_SEPARATOR + str(bio_seq.annotations[REF_TX_END]))
+    result = [None] * len(bio_seqs)
+
+    # merge the ranges of all records, by genome build and chromosome
+    segments = {}
+    for genome, chromosome, start, end, indexes in get_segments(bio_seqs):
+        segments.setdefault(genome, []).append(
+            (chromosome, start, end, indexes))
+
+    for genome, genome_segments in segments.items():
+        for first in range(0, len(genome_segments), DAS_BATCH):
 
-    result = None
+            batch = genome_segments[first:(first + DAS_BATCH)]
 
-    try:
-        response = requests.get(query)
+            try:
+                sequences = get_das_sequences(genome,
+                    [segment[:3] for segment in batch])
 
-        if response.status_code == 200:
+            except (requests.RequestException, ElementTree.ParseError) as error:
+                metrics.count("annotate_das_errors")
+                if strict:
+                    raise
+                logger.error("  Worker %d:   Unable to fetch data from UCSC DAS server: %s",
+                    core, str(error))
+                continue
 
-            # The UCSC DAS server wraps the genomic sequence in an XML tree
-            # that looks like the following:
-            #
-            # <DASDNA>
-            #   <SEQUENCE>
-            #     <DNA>
-            #     The sequence...
-            #     </DNA>
-            #   </SEQUENCE>
-            # </DASDNA>
+            for chromosome, start, end, indexes in batch:
 
-            # extract sequence from XML tree
-            soup = BeautifulSoup(response.content, 'html.parser')
+                sequence = sequences.get((chromosome, start, end))
 
-            # create a Bio.Seq object
-            sequence = Seq(
-                re.sub('\n', '', soup.dna.string),
-                IUPAC.unambiguous_dna)
+                for x in indexes:
 
-            # updated the provided Bio.SeqRecord object with the retrieved
-            # sequence
-            bio_seq.seq = sequence
+                    bio_seq = bio_seqs[x]
 
-            logger.debug("  Worker %d:   Retrieved genomic sequence of target %s from DAS server",
-                core, bio_seq.id)
+                    if sequence is None:
+                        logger.debug("  Worker %d:   Unable to fetch the genomic sequence of target %s from DAS server",
+                            core, bio_seq.id)
+                        continue
 
-            result = bio_seq
+                    # create a Bio.Seq object from the record's range
+                    bio_seq.seq = Seq(
+                        sequence[
+                            (bio_seq.annotations[REF_TX_START] - start):
+                            (bio_seq.annotations[REF_TX_END] - start + 1)
+                        ],
+                        IUPAC.unambiguous_dna)
+
+                    logger.debug("  Worker %d:   Retrieved genomic sequence of target %s from DAS server",
+                        core, bio_seq.id)
+
+                    result[x] = bio_seq
+
+    return result
+
+
+
+# return the merged genomic ranges of the given Bio.SeqRecords, as (genome
+# build, chromosome, start, end, record indexes) tuples. Ranges of the same
+# chromosome are merged when they overlap or are adjacent, as long as the
+# merged range is shorter than DAS_SEGMENT_MAX
+#
+def get_segments(bio_seqs):
+    """
+    Returns the merged genomic ranges (1-based, inclusive) of the given
+    Bio.SeqRecords, and the indexes of the records within each range.
+    """
+
+    ranges = sorted(
+        (bio_seq.annotations[REF_GENOME], bio_seq.annotations[REF_CHR],
+            bio_seq.annotations[REF_TX_START], bio_seq.annotations[REF_TX_END], x)
+        for x, bio_seq in enumerate(bio_seqs) if bio_seq
+    )
+
+    segments = []
+
+    for genome, chromosome, start, end, x in ranges:
+
+        if segments and segments[-1][:2] == [genome, chromosome] \
+                and start <= (segments[-1][3] + 1) \
+                and (max(end, segments[-1][3]) - segments[-1][2]) < DAS_SEGMENT_MAX:
+            segments[-1][3] = max(segments[-1][3], end)
+            segments[-1][4].append(x)
 
         else:
-            logger.debug("  Worker %d:   Unable to fetch the genomic sequence of target %s. DAS server returned Error code %s",
-                core, bio_seq.id, str(response.content))
+            segments.append([genome, chromosome, start, end, [x]])
+
+    return [tuple(segment) for segment in segments]
+
+
+
+# request the given (chromosome, start, end) segments of the given genome
+# build from the UCSC DAS server, in one query, and return a dictionary
+# mapping each segment to its sequence.
+# The UCSC DAS server wraps each genomic sequence in an XML tree that looks
+# like the following:
+#
+# <DASDNA>
+#   <SEQUENCE id="chr1" start="1000" stop="2000">
+#     <DNA>
+#     The sequence...
+#     </DNA>
+#   </SEQUENCE>
+#   ...
+# </DASDNA>
+#
+# The response is parsed while it is streamed, and each sequence element is
+# discarded once read, so that no full tree is built. The request waits for
+# the rate limit of the process (see limit), and its latency, parsing
+# included, is recorded in the "das_seconds" histogram
+#
+def get_das_sequences(genome, segments):
+    """
+    Returns the genomic sequences of the given (chromosome, start, end)
+    segments of the given genome build, fetched from the UCSC DAS server in
+    one request.
+    """
+
+    query = str(
+        DAS_HOST + genome + DAS_QUERY +
+        DAS_SEGMENT_SEPARATOR.join(
+            chromosome + SEPARATOR + str(start) + DAS_SEPARATOR + str(end)
+            for chromosome, start, end in segments))
+
+    result = {}
+
+    throttle()
+
+    with metrics.timer("das_seconds"), \
+        get_session().get(query, stream=True, timeout=DAS_TIMEOUT) as response:
+
+        if response.status_code != 200:
+            raise requests.HTTPError(
+                "DAS server returned Error code " + str(response.status_code))
+
+        response.raw.decode_content = True
 
-    except:
-        logger.error("Ubable to fetch data from UCSC DAS server")
+        for event, element in ElementTree.iterparse(response.raw):
+
+            if element.tag == "SEQUENCE":
+
+                dna = element.find("DNA")
+
+                result[(
+                    element.get("id"),
+                    int(element.get("start")),
+                    int(element.get("stop"))
+                )] = "".join((dna.text or "").split()) if dna is not None else None
+
+                element.clear()
 
     return result
 
@@ -189,3 +454,86 @@ def transcript_sequence_in_range(bio_seq, start, end):
 #
 #    return result
 
+
+
+# token bucket limiting the rate of the requests sent to the UCSC, to respect
+# its usage policy (see genome.ucsc.edu/conditions.html). The bucket holds up
+# to capacity tokens, refilled at rate tokens per second; each request takes
+# a token, and waits for one when the bucket is empty. A rate of 0 does not
+# limit requests. Shared by the threads of a process, and counting the
+# requests they send
+#
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limit.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = time.monotonic()
+        self.taken = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for the bucket to refill if it is empty.
+        """
+
+        while True:
+
+            with self.lock:
+
+                if self.rate <= 0:
+                    self.taken += 1
+                    return
+
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.time) * self.rate)
+                self.time = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.taken += 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+
+# rate limit of the UCSC requests (MySQL queries and DAS requests) of this
+# process, if any (see limit)
+bucket = None
+
+
+
+# limit the UCSC requests of this process to the given rate (requests per
+# second, 0 for no limit), or remove the limit if None. Return the token
+# bucket counting the requests
+#
+def limit(rate):
+    """
+    Sets the rate limit of the UCSC requests of this process.
+    """
+
+    global bucket
+
+    bucket = TokenBucket(rate) if rate is not None else None
+
+    return bucket
+
+
+
+# wait for the rate limit of this process (if any) to allow a UCSC request
+#
+def throttle():
+    """
+    Takes a token of the rate limit of this process, if any.
+    """
+
+    if bucket is not None:
+        bucket.acquire()